@@ -0,0 +1,503 @@
+import calendar
+import csv
+import json
+import os
+import random
+import re
+import shutil
+import string
+import subprocess
+import time
+from math import cos, radians
+
+# Used to estimate the ground area covered by range map rasters in a dry run.
+METRES_PER_DEGREE_LAT = 110574
+METRES_PER_DEGREE_LON_AT_EQUATOR = 111320
+# The resolution of the Hansen GFC data.
+GFC_NATIVE_SCALE = 30
+
+
+def _generate_task_id():
+    """Generate a random ID for an emulated task, in the same format as GEE task IDs.
+
+    :return: A 24-character string.
+    """
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=24))
+
+
+def _split_gcs_path(gcs_path):
+    """Split a GCS path into a bucket name and an object prefix.
+
+    :param gcs_path: A path of the form gs://<bucket>/<prefix>.
+    :return: A tuple (bucket_name, prefix).
+    """
+    bucket_name, _, prefix = gcs_path[len('gs://'):].partition('/')
+    return bucket_name, prefix.strip('/')
+
+
+def _parse_timestamp(timestamp):
+    """Parse an RFC 3339 timestamp in UTC, as used by the GEE API.
+
+    :param timestamp: A timestamp, e.g. "2021-03-01T12:00:00.123Z", or None.
+    :return: Seconds since the epoch, or None.
+    """
+    if not timestamp:
+        return None
+    seconds = calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+    fraction_str = timestamp[19:].rstrip('Z')
+    if fraction_str.startswith('.'):
+        seconds += float(fraction_str)
+    return seconds
+
+
+class GeeBackend(object):
+    """Carries out pipeline operations using Google Earth Engine, Google Cloud
+    Storage and their command-line tools. This is the default backend."""
+
+    is_local = False
+
+    def authenticate(self):
+        """Log in to Google Cloud and Google Earth Engine, but only if there aren't
+        credentials for them already, and initialise Earth Engine."""
+        import ee
+
+        active_accounts = subprocess.run(
+            'gcloud auth list --filter=status:ACTIVE --format="value(account)"',
+            shell=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        if not active_accounts.strip():
+            os.system('gcloud auth login')
+
+        try:
+            ee.Initialize()
+        except ee.EEException:
+            ee.Authenticate()
+            ee.Initialize()
+
+    def get_home_folder_path(self):
+        """If the current user already has a GEE home folder, get a path to it. If
+        not, create one and return a path to it.
+
+        :return: A GEE path to the user's home folder.
+        """
+        import ee
+
+        earth_engine_ls_output = os.popen('earthengine ls').read()
+        if "users" in earth_engine_ls_output:
+            # User already has a home folder. Get a path to it.
+            gee_home_folder_path = earth_engine_ls_output.split('assets/')[1][:-1]
+        else:
+            # User does not already have a home folder. Create one.
+            # Generate a random suffix. (Home folder names must be unique.)
+            random_suffix = ''.join(random.choices(string.digits, k=10))
+            gee_home_folder_path = 'users/forest_loss_tool_user_' + random_suffix
+            ee.data.createAssetHome(gee_home_folder_path)
+
+        return gee_home_folder_path
+
+    def create_image_collection(self, asset_id):
+        """Create an empty ImageCollection asset.
+
+        :param asset_id: GEE asset ID of the new ImageCollection.
+        """
+        import ee
+
+        ee.data.createAsset({'type': 'ImageCollection'}, asset_id)
+
+    def upload_to_bucket(self, local_dir_path, gcs_dir_path):
+        """Copy every file in a local directory to a GCS directory.
+
+        :param local_dir_path: Path to the local directory.
+        :param gcs_dir_path: A path of the form gs://<bucket>/<prefix>.
+        """
+        os.system('gsutil -m cp -r "%s" %s' % (local_dir_path + '/' + '*',
+                                               gcs_dir_path + '/'))
+
+    def ingest_image(self, gcs_file_path, asset_id):
+        """Start a task to create an Image asset from a GeoTIFF in GCS.
+
+        :param gcs_file_path: GCS path to the GeoTIFF.
+        :param asset_id: GEE asset ID of the new Image.
+        :return: The ID of the task, or None if the earthengine tool didn't report
+            it.
+        """
+        output = subprocess.run('earthengine upload image --asset_id %s %s' %
+                                (asset_id, gcs_file_path), shell=True,
+                                stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        print(output, end='')
+        match = re.search(r'task with ID: (\S+)', output)
+        return match.group(1) if match else None
+
+    def empty_bucket(self, gcs_dir_path):
+        """Delete everything under a GCS path.
+
+        :param gcs_dir_path: A path of the form gs://<bucket>[/<prefix>].
+        """
+        os.system('gsutil -m rm %s' % gcs_dir_path + '/' + '**')
+
+    def copy_from_bucket(self, gcs_dir_path, local_dir_path):
+        """Copy everything under a GCS path to a local directory.
+
+        :param gcs_dir_path: A path of the form gs://<bucket>[/<prefix>].
+        :param local_dir_path: Path to the local directory.
+        """
+        os.system('gsutil -m cp %s/** %s' % (gcs_dir_path, local_dir_path))
+
+    def read_from_bucket(self, gcs_dir_path):
+        """Read and concatenate the contents of every file directly under a GCS
+        path.
+
+        :param gcs_dir_path: A path of the form gs://<bucket>/<prefix>.
+        :return: The concatenated contents as a string.
+        """
+        return subprocess.run('gsutil cat "%s/*"' % gcs_dir_path, shell=True,
+                              stdout=subprocess.PIPE, check=True,
+                              universal_newlines=True).stdout
+
+    def list_bucket_dirs(self, gcs_dir_path):
+        """List the directories directly under a GCS path.
+
+        :param gcs_dir_path: A path of the form gs://<bucket>/<prefix>.
+        :return: A list of the names of the directories.
+        """
+        output = subprocess.run('gsutil ls "%s/"' % gcs_dir_path, shell=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout
+        return [line.rstrip('/').rsplit('/', 1)[-1] for line in output.splitlines()
+                if line.endswith('/')]
+
+    def list_tasks(self):
+        """List the tasks in the user's account.
+
+        :return: A list of dictionaries with the keys "id", "state", "description",
+            "start_time", "end_time" and "error_message". The times are in seconds
+            since the epoch and are None if the task hasn't started or finished. The
+            error message is None unless the task failed.
+        """
+        import ee
+
+        tasks = []
+        for operation in ee.data.listOperations():
+            metadata = operation['metadata']
+            tasks.append({'id': os.path.basename(operation['name']),
+                          'state': metadata['state'],
+                          'description': metadata.get('description', ''),
+                          'start_time': _parse_timestamp(metadata.get('startTime')),
+                          'end_time': _parse_timestamp(metadata.get('endTime')),
+                          'error_message': operation.get('error', {}).get('message')})
+        return tasks
+
+    def wait_for_task(self, task_id):
+        """Block until a task has finished.
+
+        :param task_id: The ID of the task.
+        """
+        os.system('earthengine task wait %s' % task_id)
+
+
+class LocalBackend(object):
+    """Emulates the GEE and GCS operations used by the pipeline using a local
+    directory. Assets are stored under "assets", buckets under "gcs" and tasks are
+    recorded in "tasks.jsonl". Tasks run synchronously, so they've always finished
+    by the time they're listed. Range analysis is carried out by local_calculator.
+    """
+
+    is_local = True
+
+    def __init__(self, root_dir_path, local_gfc_paths=None):
+        """Initialise a LocalBackend backed by the directory at root_dir_path.
+
+        :param root_dir_path: Path to a directory. It's created if it doesn't exist.
+        :param local_gfc_paths: An optional dictionary with the keys
+            "treecover2000_path", "lossyear_path" and "dem_path", overriding the
+            paths to local GFC data and DEM in the configuration file.
+        """
+        self._root_dir_path = root_dir_path
+        self._local_gfc_paths = local_gfc_paths or {}
+        self._tasks_file_path = os.path.join(root_dir_path, 'tasks.jsonl')
+        os.makedirs(root_dir_path, exist_ok=True)
+
+    def _asset_path(self, asset_id):
+        return os.path.join(self._root_dir_path, 'assets', *asset_id.split('/'))
+
+    def _gcs_path(self, gcs_path):
+        bucket_name, prefix = _split_gcs_path(gcs_path)
+        return os.path.join(self._root_dir_path, 'gcs', bucket_name,
+                            *filter(None, prefix.split('/')))
+
+    def _record_task(self, task_type, description, state='COMPLETED', start_time=None,
+                     end_time=None, error_message=None):
+        task_id = _generate_task_id()
+        task = {'id': task_id, 'state': state, 'description': description,
+                'type': task_type, 'start_time': start_time, 'end_time': end_time,
+                'error_message': error_message}
+        with open(self._tasks_file_path, 'a') as tasks_file:
+            tasks_file.write(json.dumps(task) + '\n')
+
+        return task_id
+
+    def get_home_folder_path(self):
+        home_folder_path = 'users/local_emulator'
+        os.makedirs(self._asset_path(home_folder_path), exist_ok=True)
+        return home_folder_path
+
+    def create_image_collection(self, asset_id):
+        os.makedirs(self._asset_path(asset_id), exist_ok=True)
+
+    def upload_to_bucket(self, local_dir_path, gcs_dir_path):
+        dest_dir_path = self._gcs_path(gcs_dir_path)
+        os.makedirs(dest_dir_path, exist_ok=True)
+        for filename in os.listdir(local_dir_path):
+            shutil.copy(os.path.join(local_dir_path, filename), dest_dir_path)
+
+    def ingest_image(self, gcs_file_path, asset_id):
+        src_path = self._gcs_path(gcs_file_path)
+        dest_path = self._asset_path(asset_id) + '.tif'
+        if not os.path.exists(src_path):
+            return self._record_task('INGEST_IMAGE', 'Ingest image: "%s"' % asset_id,
+                                     'FAILED', error_message='File not found: %s' %
+                                     gcs_file_path)
+
+        shutil.copy(src_path, dest_path)
+        return self._record_task('INGEST_IMAGE', 'Ingest image: "%s"' % asset_id)
+
+    def empty_bucket(self, gcs_dir_path):
+        shutil.rmtree(self._gcs_path(gcs_dir_path), ignore_errors=True)
+
+    def copy_from_bucket(self, gcs_dir_path, local_dir_path):
+        src_dir_path = self._gcs_path(gcs_dir_path)
+        if not os.path.isdir(src_dir_path):
+            return
+        for dir_path, _, filenames in os.walk(src_dir_path):
+            for filename in filenames:
+                shutil.copy(os.path.join(dir_path, filename), local_dir_path)
+
+    def read_from_bucket(self, gcs_dir_path):
+        src_dir_path = self._gcs_path(gcs_dir_path)
+        if not os.path.isdir(src_dir_path):
+            return ''
+        contents = []
+        for filename in sorted(os.listdir(src_dir_path)):
+            with open(os.path.join(src_dir_path, filename)) as src_file:
+                contents.append(src_file.read())
+        return ''.join(contents)
+
+    def list_bucket_dirs(self, gcs_dir_path):
+        src_dir_path = self._gcs_path(gcs_dir_path)
+        if not os.path.isdir(src_dir_path):
+            return []
+        return sorted(name for name in os.listdir(src_dir_path)
+                      if os.path.isdir(os.path.join(src_dir_path, name)))
+
+    def list_tasks(self):
+        if not os.path.exists(self._tasks_file_path):
+            return []
+        with open(self._tasks_file_path) as tasks_file:
+            return [json.loads(line) for line in tasks_file]
+
+    def wait_for_task(self, task_id):
+        pass
+
+    def run_range_analysis(self, range_map_asset_id, min_alt, max_alt, sci_name,
+                           sisid, breeding, gfc_final_yr, bucket_name,
+                           file_name_prefix, description, scale=600,
+                           zone_img_id=None):
+        """Compute tree cover loss estimates for a range map and write them to the
+        emulated results bucket in the same format as a GEE table export. The
+        estimates are computed at the resolution of the local GFC data, so scale is
+        ignored, except that it's recorded in the results.
+
+        :param range_map_asset_id: Emulated GEE asset ID of the range map Image.
+        :param min_alt: The minimum altitude of the species.
+        :param max_alt: The maximum altitude of the species.
+        :param sci_name: The scientific name of the species.
+        :param sisid: The SIS ID of the species.
+        :param breeding: 0 for a non-breeding range, 1 for a breeding range.
+        :param gfc_final_yr: The final year covered by the GFC dataset.
+        :param bucket_name: The name of the results bucket.
+        :param file_name_prefix: The results file is written to this path in the
+            bucket, with ".csv" appended.
+        :param description: The description of the emulated export task.
+        :param scale: The scale in metres at which GEE would carry out the analysis.
+        :param zone_img_id: Optional path to a local raster of integer zone codes.
+            If given, the estimates are broken down by zone: one row is written for
+            each zone within the range, with the zone code in a "zone" column.
+        :return: The ID of the emulated export task.
+        """
+        from local_calculator import compute_range_results, \
+            compute_zonal_range_results
+
+        start_time = time.time()
+        range_raster_path = self._asset_path(range_map_asset_id) + '.tif'
+        if not os.path.exists(range_raster_path):
+            return self._record_task('EXPORT_FEATURES', description, 'FAILED',
+                                     error_message='Image asset "%s" not found.' %
+                                     range_map_asset_id)
+
+        if zone_img_id:
+            zone_results_dicts = compute_zonal_range_results(
+                range_raster_path, min_alt, max_alt, gfc_final_yr,
+                zone_path=zone_img_id, **self._local_gfc_paths)
+            if not zone_results_dicts:
+                zone_results_dicts = {0: compute_range_results(
+                    range_raster_path, min_alt, max_alt, gfc_final_yr,
+                    **self._local_gfc_paths)}
+            results_dicts = [dict(results_dict, zone=zone) for zone, results_dict
+                             in sorted(zone_results_dicts.items())]
+        else:
+            results_dicts = [compute_range_results(range_raster_path, min_alt,
+                                                   max_alt, gfc_final_yr,
+                                                   **self._local_gfc_paths)]
+        for results_dict in results_dicts:
+            results_dict['sci_name'] = sci_name
+            results_dict['sisid'] = sisid
+            results_dict['breeding'] = breeding
+            results_dict['scale'] = scale
+
+        results_file_path = self._gcs_path('gs://%s/%s' % (bucket_name,
+                                                           file_name_prefix)) + '.csv'
+        os.makedirs(os.path.dirname(results_file_path), exist_ok=True)
+        with open(results_file_path, 'w', newline='') as results_file:
+            dw = csv.DictWriter(results_file,
+                                fieldnames=['system:index'] + list(results_dicts[0]) +
+                                ['.geo'])
+            dw.writeheader()
+            for row_no, results_dict in enumerate(results_dicts):
+                dw.writerow(dict(results_dict, **{'system:index': str(row_no),
+                                                  '.geo': ''}))
+
+        return self._record_task('EXPORT_FEATURES', description,
+                                 start_time=start_time, end_time=time.time())
+
+
+class DryRunBackend(object):
+    """Records the GEE and GCS operations the pipeline would carry out, without
+    carrying any of them out, so that the cost of a run can be estimated before any
+    quota is spent."""
+
+    is_local = True
+
+    def __init__(self):
+        self.no_tasks = 0
+        self.no_assets = 0
+        self.no_bytes_uploaded = 0
+        self.no_pixels_reduced = 0
+        self.no_output_pixels = 0
+        self._raster_areas_m2 = {}
+
+    def report(self):
+        """Summarise the operations recorded so far.
+
+        :return: A dictionary.
+        """
+        return {'tasks': self.no_tasks,
+                'assets': self.no_assets,
+                'bytes_uploaded': self.no_bytes_uploaded,
+                'estimated_pixels_reduced': self.no_pixels_reduced,
+                'estimated_output_pixels': self.no_output_pixels}
+
+    def write_report(self, report_file_path):
+        """Write the report returned by report to a JSON file.
+
+        :param report_file_path: Path to write the report to.
+        """
+        with open(report_file_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=1)
+
+    def get_home_folder_path(self):
+        return 'users/dry_run'
+
+    def create_image_collection(self, asset_id):
+        self.no_assets += 1
+
+    def upload_to_bucket(self, local_dir_path, gcs_dir_path):
+        import rasterio
+
+        for filename in os.listdir(local_dir_path):
+            file_path = os.path.join(local_dir_path, filename)
+            self.no_bytes_uploaded += os.path.getsize(file_path)
+            with rasterio.open(file_path) as raster:
+                self._raster_areas_m2[gcs_dir_path + '/' + filename] = \
+                    _estimate_raster_area_m2(raster)
+
+    def ingest_image(self, gcs_file_path, asset_id):
+        self.no_tasks += 1
+        self.no_assets += 1
+        self._raster_areas_m2[asset_id] = self._raster_areas_m2.pop(gcs_file_path,
+                                                                    None)
+
+    def empty_bucket(self, gcs_dir_path):
+        pass
+
+    def copy_from_bucket(self, gcs_dir_path, local_dir_path):
+        pass
+
+    def read_from_bucket(self, gcs_dir_path):
+        return ''
+
+    def list_bucket_dirs(self, gcs_dir_path):
+        return []
+
+    def list_tasks(self):
+        return []
+
+    def wait_for_task(self, task_id):
+        pass
+
+    def run_range_analysis(self, range_map_asset_id, min_alt, max_alt, sci_name,
+                           sisid, breeding, gfc_final_yr, bucket_name,
+                           file_name_prefix, description, scale=600,
+                           zone_img_id=None):
+        """Record an export task and estimate the number of pixels GEE would reduce
+        for it. See LocalBackend.run_range_analysis for the other parameters.
+
+        :param scale: The scale in metres at which the analysis is carried out.
+        """
+        self.no_tasks += 1
+
+        area_m2 = self._raster_areas_m2.get(range_map_asset_id)
+        if area_m2 is None:
+            return
+
+        # One Image per year of loss plus one for the tree cover in 2000.
+        no_gfc_imgs = gfc_final_yr - 2000 + 1
+        self.no_output_pixels += int(no_gfc_imgs * area_m2 / scale ** 2)
+        self.no_pixels_reduced += int(no_gfc_imgs * area_m2 / GFC_NATIVE_SCALE ** 2)
+
+
+def _estimate_raster_area_m2(raster):
+    """Estimate the ground area of the bounding box of a raster.
+
+    :param raster: An open rasterio dataset in EPSG:4326 or in an equal-area CRS in
+        metres.
+    :return: The area in square metres.
+    """
+    bounds = raster.bounds
+    if raster.crs is not None and not raster.crs.is_geographic:
+        return abs(bounds.right - bounds.left) * abs(bounds.top - bounds.bottom)
+
+    mid_lat = (bounds.bottom + bounds.top) / 2
+    width_m = abs(bounds.right - bounds.left) * \
+        METRES_PER_DEGREE_LON_AT_EQUATOR * cos(radians(mid_lat))
+    height_m = abs(bounds.top - bounds.bottom) * METRES_PER_DEGREE_LAT
+    return width_m * height_m
+
+
+_BACKEND = GeeBackend()
+
+
+def get_backend():
+    """Get the backend which pipeline operations are carried out with.
+
+    :return: A GeeBackend, LocalBackend or DryRunBackend.
+    """
+    return _BACKEND
+
+
+def set_backend(backend):
+    """Set the backend which pipeline operations are carried out with.
+
+    :param backend: A GeeBackend, LocalBackend or DryRunBackend.
+    """
+    global _BACKEND
+    _BACKEND = backend
@@ -0,0 +1,430 @@
+"""Benchmark the pipeline on synthetic range maps at configurable scale. Every stage
+is timed separately and the timings are written to a JSON file so that runs can be
+compared to catch performance regressions.
+
+Example:
+    python benchmark.py generate bench-inputs --no-species 5000
+    python benchmark.py run bench-inputs --output bench-5000.json
+    python benchmark.py compare baseline.json bench-5000.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Proportions of rows with each code. These roughly follow the BOTW layer.
+SEASON_PROBS = {'1': 0.7, '2': 0.12, '3': 0.12, '4': 0.04, '5': 0.02}
+PRESENCE_PROBS = {'1': 0.85, '2': 0.03, '3': 0.05, '4': 0.03, '5': 0.02, '6': 0.02}
+ORIGIN_PROBS = {'1': 0.9, '2': 0.05, '3': 0.03, '6': 0.02}
+FOREST_DEPENDENCY_PROBS = {'High': 0.25, 'Medium': 0.3, 'Low': 0.25,
+                           'Non-forest': 0.2}
+# Range polygon sizes and complexity. The radius in degrees and the number of
+# vertices are drawn from lognormal distributions with these medians.
+MEDIAN_RADIUS_DEG = 1.5
+MAX_RADIUS_DEG = 25
+MEDIAN_NO_VERTICES = 300
+MAX_NO_VERTICES = 50000
+# Probability that a row is a multipolygon (e.g. an archipelago) and the maximum
+# number of parts.
+MULTIPOLYGON_PROB = 0.15
+MAX_NO_PARTS = 20
+
+LAYER_NAME = 'All_Species'
+RANGES_FILENAME = 'ranges.gpkg'
+FOREST_DEP_FILENAME = 'forest_dependency.xlsx'
+ALT_LIMS_FILENAME = 'altitude_limits.csv'
+GLS_FILENAME = 'generation_lengths.csv'
+GFC_FILENAMES = {'treecover2000_path': 'treecover2000.tif',
+                 'lossyear_path': 'lossyear.tif',
+                 'dem_path': 'dem.tif'}
+# The synthetic GFC and DEM rasters are generated and written this many rows at a
+# time, a multiple of their block height, as a global raster at a fine resolution
+# doesn't fit in memory.
+SYNTHETIC_GFC_BLOCK_ROWS = 1024
+
+# The tracing spans each stage's time is taken from. The rasterisation workers don't
+# trace, so when range maps are rasterised in parallel, rasterising and compressing
+# are timed together as "rasterise".
+STAGE_SPAN_NAMES = OrderedDict([('index', ['index']),
+                                ('read', ['read']),
+                                ('validate', ['validate']),
+                                ('filter', ['filter']),
+                                ('simplify', ['simplify']),
+                                ('dissolve', ['dissolve']),
+                                ('rasterise', ['rasterise', 'rasterise.parallel']),
+                                ('compress', ['compress']),
+                                ('upload', ['upload', 'wait.uploads']),
+                                ('analyse', ['analyse', 'wait.analyse']),
+                                ('postprocess', ['postprocess'])])
+STAGES = list(STAGE_SPAN_NAMES)
+# A stage is reported as a regression if it's this much slower than the baseline.
+REGRESSION_TOLERANCE = 0.1
+
+
+def _choose(rng, probs, size):
+    return rng.choice(list(probs), size=size, p=list(probs.values()))
+
+
+def _generate_polygon(rng, centre, radius, no_vertices):
+    """Generate a star-shaped polygon with a rough, coastline-like boundary.
+
+    :param rng: A NumPy random Generator.
+    :param centre: The (longitude, latitude) of the centre of the polygon.
+    :param radius: The approximate radius of the polygon in degrees.
+    :param no_vertices: The number of vertices.
+    :return: A shapely Polygon.
+    """
+    from shapely.geometry import Polygon
+
+    angles = np.sort(rng.uniform(0, 2 * np.pi, no_vertices))
+    # A random walk gives a boundary which is rough at every scale.
+    walk = np.cumsum(rng.normal(0, 1, no_vertices))
+    walk -= np.linspace(0, walk[-1], no_vertices)
+    radii = radius * np.exp(0.3 * walk / max(1, np.abs(walk).max()))
+    xs = centre[0] + radii * np.cos(angles)
+    ys = np.clip(centre[1] + radii * np.sin(angles), -89, 89)
+    return Polygon(zip(xs, ys))
+
+
+def generate_synthetic_inputs(out_dir_path, no_species, seed=0,
+                              gfc_resolution=None):
+    """Generate a synthetic range map geodatabase and matching forest dependency,
+    altitude limits and generation lengths tables.
+
+    :param out_dir_path: Path to a directory to write the inputs to.
+    :param no_species: The number of species.
+    :param seed: Seed for the random number generator.
+    :param gfc_resolution: If given, synthetic global "treecover2000", "lossyear"
+        and DEM rasters with this resolution in degrees are also generated, so that
+        the local analysis does real work.
+    """
+    import geopandas as gpd
+    import pandas as pd
+    from shapely.geometry import MultiPolygon
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir_path, exist_ok=True)
+
+    sisids = np.arange(22670000, 22670000 + no_species)
+    sci_names = ['Synthetica species%d' % n for n in range(no_species)]
+
+    rows = []
+    for sisid, sci_name in zip(sisids, sci_names):
+        centre = (rng.uniform(-180, 180), rng.uniform(-50, 60))
+        # Migratory species have separate breeding and non-breeding rows.
+        no_rows = rng.choice([1, 2, 3, 4], p=[0.55, 0.25, 0.15, 0.05])
+        for _ in range(no_rows):
+            radius = min(MAX_RADIUS_DEG, MEDIAN_RADIUS_DEG * rng.lognormal(0, 1))
+            no_vertices = int(min(MAX_NO_VERTICES,
+                                  max(10, MEDIAN_NO_VERTICES * rng.lognormal(0, 1.2))))
+            row_centre = (centre[0] + rng.normal(0, radius),
+                          centre[1] + rng.normal(0, radius / 2))
+            if rng.uniform() < MULTIPOLYGON_PROB:
+                no_parts = rng.integers(2, MAX_NO_PARTS + 1)
+                parts = [_generate_polygon(rng,
+                                           (row_centre[0] + rng.normal(0, radius),
+                                            row_centre[1] + rng.normal(0, radius)),
+                                           radius / no_parts,
+                                           max(10, no_vertices // no_parts))
+                         for _ in range(no_parts)]
+                geometry = MultiPolygon(parts)
+            else:
+                geometry = _generate_polygon(rng, row_centre, radius, no_vertices)
+            rows.append((sisid, sci_name, geometry))
+
+    no_rows = len(rows)
+    ranges_gdf = gpd.GeoDataFrame({
+        'SISID': [row[0] for row in rows],
+        'SCINAME': [row[1] for row in rows],
+        'PRESENCE': _choose(rng, PRESENCE_PROBS, no_rows),
+        'ORIGIN': _choose(rng, ORIGIN_PROBS, no_rows),
+        'SEASONAL': _choose(rng, SEASON_PROBS, no_rows),
+    }, geometry=[row[2] for row in rows], crs='EPSG:4326')
+    ranges_gdf.to_file(os.path.join(out_dir_path, RANGES_FILENAME), layer=LAYER_NAME,
+                       driver='GPKG')
+
+    pd.DataFrame({'SIS ID': sisids,
+                  'Forest dependency': _choose(rng, FOREST_DEPENDENCY_PROBS,
+                                               no_species)}) \
+        .to_excel(os.path.join(out_dir_path, FOREST_DEP_FILENAME), index=False)
+
+    min_alts = rng.choice([0, 200, 500, 1000, 1500], size=no_species)
+    max_alts = min_alts + rng.choice([500, 1000, 2000, 4000], size=no_species)
+    alt_lims_df = pd.DataFrame({'sci_name': sci_names, 'min_alt': min_alts,
+                                'max_alt': max_alts, 'source': 'synthetic'},
+                               dtype=object)
+    # Some species have unknown altitude limits.
+    alt_lims_df.loc[rng.uniform(size=no_species) < 0.2, 'min_alt'] = 'NA'
+    alt_lims_df.loc[rng.uniform(size=no_species) < 0.2, 'max_alt'] = 'NA'
+    alt_lims_df.to_csv(os.path.join(out_dir_path, ALT_LIMS_FILENAME), index=False)
+
+    pd.DataFrame({'sci_name': sci_names,
+                  'gl': np.round(rng.lognormal(np.log(4), 0.5, no_species), 2)}) \
+        .to_csv(os.path.join(out_dir_path, GLS_FILENAME), index=False, header=False)
+
+    if gfc_resolution:
+        _generate_synthetic_gfc(out_dir_path, gfc_resolution, rng)
+
+
+def _generate_synthetic_gfc(out_dir_path, resolution, rng):
+    """Generate synthetic global "treecover2000", "lossyear" and DEM rasters, a
+    strip of SYNTHETIC_GFC_BLOCK_ROWS rows at a time.
+
+    :param out_dir_path: Path to a directory to write the rasters to.
+    :param resolution: The resolution of the rasters in degrees.
+    :param rng: A NumPy random Generator.
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    width = int(round(360 / resolution))
+    height = int(round(180 / resolution))
+    transform = from_origin(-180, 90, resolution, resolution)
+
+    layers = {'treecover2000_path': (0, 101, np.uint8),
+              'lossyear_path': (0, 20, np.uint8),
+              'dem_path': (-100, 5000, np.int16)}
+    for key, (low, high, dtype) in layers.items():
+        with rasterio.open(os.path.join(out_dir_path, GFC_FILENAMES[key]), 'w',
+                           driver='GTiff', width=width, height=height, count=1,
+                           dtype=np.dtype(dtype).name, crs='EPSG:4326',
+                           transform=transform, compress='lzw', tiled=True) as dst:
+            for row_off in range(0, height, SYNTHETIC_GFC_BLOCK_ROWS):
+                no_rows = min(SYNTHETIC_GFC_BLOCK_ROWS, height - row_off)
+                dst.write(rng.integers(low, high, (no_rows, width), dtype=dtype), 1,
+                          window=Window(0, row_off, width, no_rows))
+
+
+def _sum_spans(trace_file_path):
+    """Add up the wall-clock time and counters of the spans in a trace by name.
+
+    :param trace_file_path: Path to a trace written by tracing.enable_tracing.
+    :return: A dictionary mapping span names to dictionaries with the keys "calls",
+        "wall_s" and "counters".
+    """
+    span_totals = {}
+    with open(trace_file_path) as trace_file:
+        for line in trace_file:
+            record = json.loads(line)
+            if record['type'] != 'span':
+                continue
+            span_total = span_totals.setdefault(record['name'], {'calls': 0,
+                                                                 'wall_s': 0.0,
+                                                                 'counters': {}})
+            span_total['calls'] += 1
+            span_total['wall_s'] += record['wall_s']
+            for counter_name, amount in record['counters'].items():
+                span_total['counters'][counter_name] = \
+                    span_total['counters'].get(counter_name, 0) + amount
+    return span_totals
+
+
+def _get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True,
+                              universal_newlines=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__))) \
+            .stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _get_span_total(span_totals, span_name, key='wall_s'):
+    """Get a total from the dictionary returned by _sum_spans.
+
+    :param span_totals: A dictionary returned by _sum_spans.
+    :param span_name: The name of the spans.
+    :param key: "calls", "wall_s" or the name of a counter.
+    :return: The total, or 0 if there were no such spans.
+    """
+    span_total = span_totals.get(span_name, {'calls': 0, 'wall_s': 0.0,
+                                             'counters': {}})
+    if key in ('calls', 'wall_s'):
+        return span_total[key]
+    return span_total['counters'].get(key, 0)
+
+
+def run_benchmark(inputs_dir_path, memory_budget_mb=None):
+    """Run the pipeline on synthetic inputs against the local emulator backend,
+    through the same functions as a real run, and time each stage using the
+    pipeline's tracing spans.
+
+    :param inputs_dir_path: Path to a directory written by
+        generate_synthetic_inputs.
+    :param memory_budget_mb: The memory budget used to choose how many range maps
+        to pre-process at a time. Defaults to the one in the configuration file.
+    :return: A dictionary of results which can be serialised as JSON.
+    """
+    import gfc_calculator
+    import preprocessor
+    import runs
+    import tile_cache
+    from backends import LocalBackend, set_backend
+    from postprocessor import _populate_gl_dict, collect_results
+    from task_tracking import EXPORT, clear_tracked_tasks, wait_for_tracked_tasks
+    from tracing import disable_tracing, enable_tracing, span
+
+    memory_budget_mb = memory_budget_mb or preprocessor.PREPROCESSING_MEMORY_BUDGET_MB
+    work_dir_path = tempfile.mkdtemp(prefix='gfc-benchmark-')
+    trace_file_path = os.path.join(work_dir_path, 'trace.jsonl')
+
+    local_gfc_paths = {key: os.path.join(inputs_dir_path, filename)
+                       for key, filename in GFC_FILENAMES.items()
+                       if os.path.exists(os.path.join(inputs_dir_path, filename))}
+    set_backend(LocalBackend(os.path.join(work_dir_path, 'emulator'),
+                             local_gfc_paths))
+    # Keep the run's working directory out of the repository, and index the layer,
+    # validate the geometries and decode the GFC data from scratch, rather than
+    # timing cache lookups.
+    runs.RUNS_DIR_PATH = os.path.join(work_dir_path, 'runs')
+    runs.set_run(runs.Run('benchmark'))
+    clear_tracked_tasks()
+    preprocessor.PREPROCESSING_MEMORY_BUDGET_MB = memory_budget_mb
+    preprocessor.LAYER_INDEX_DIR_PATH = os.path.join(work_dir_path, 'layer-indexes')
+    preprocessor.GEOMETRY_CACHE_DIR_PATH = os.path.join(work_dir_path,
+                                                        'geometry-cache')
+    preprocessor._VALIDATED_GEOMETRIES = None
+    tile_cache.TILE_CACHE_DIR_PATH = os.path.join(work_dir_path, 'tile-cache')
+    tile_cache._TILE_CACHE = None
+
+    enable_tracing(trace_file_path)
+    try:
+        range_map_ic_gee_path = preprocessor.preprocess(
+            os.path.join(inputs_dir_path, RANGES_FILENAME), LAYER_NAME,
+            os.path.join(inputs_dir_path, FOREST_DEP_FILENAME))
+        with span('analyse'):
+            gfc_calculator.analyse(os.path.join(inputs_dir_path, ALT_LIMS_FILENAME),
+                                   range_map_ic_gee_path)
+        with span('wait.analyse'):
+            wait_for_tracked_tasks(EXPORT)
+        with span('postprocess'):
+            collect_results(_populate_gl_dict(os.path.join(inputs_dir_path,
+                                                           GLS_FILENAME)))
+
+        disable_tracing()
+        span_totals = _sum_spans(trace_file_path)
+    finally:
+        disable_tracing()
+        shutil.rmtree(work_dir_path, ignore_errors=True)
+
+    stage_seconds = OrderedDict(
+        (stage, sum(_get_span_total(span_totals, span_name)
+                    for span_name in span_names))
+        for stage, span_names in STAGE_SPAN_NAMES.items())
+    counts = OrderedDict([
+        ('rows', _get_span_total(span_totals, 'read', 'rows')),
+        ('chunks', _get_span_total(span_totals, 'preprocess.chunk', 'calls')),
+        ('filtered_rows', _get_span_total(span_totals, 'filter', 'rows')),
+        ('ranges', _get_span_total(span_totals, 'dissolve', 'ranges')),
+        ('vertices', _get_span_total(span_totals, 'preprocess.chunk', 'vertices')),
+        ('pixels', _get_span_total(span_totals, 'rasterise', 'pixels') +
+         _get_span_total(span_totals, 'rasterise.parallel', 'pixels')),
+        ('bytes_uploaded', _get_span_total(span_totals, 'compress', 'bytes_written') +
+         _get_span_total(span_totals, 'rasterise.parallel', 'bytes_written')),
+        ('simplified_vertices', _get_span_total(span_totals, 'simplify', 'vertices') -
+         _get_span_total(span_totals, 'simplify', 'vertices_removed')),
+    ])
+
+    return OrderedDict([
+        ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('git_commit', _get_git_commit()),
+        ('python', sys.version.split()[0]),
+        ('platform', platform.platform()),
+        ('inputs_dir_path', os.path.abspath(inputs_dir_path)),
+        ('local_gfc', bool(local_gfc_paths)),
+        ('memory_budget_mb', memory_budget_mb),
+        ('no_rasterisation_workers', preprocessor.NO_RASTERISATION_WORKERS),
+        ('counts', counts),
+        ('stage_seconds', stage_seconds),
+        ('total_seconds', sum(stage_seconds.values())),
+    ])
+
+
+def compare_benchmark_results(baseline, current, tolerance=REGRESSION_TOLERANCE):
+    """Compare the stage timings of two benchmark runs.
+
+    :param baseline: A dictionary returned by run_benchmark.
+    :param current: A dictionary returned by run_benchmark.
+    :param tolerance: A stage is a regression if it's slower than the baseline by
+        more than this fraction.
+    :return: A list of the stages which regressed.
+    """
+    regressions = []
+    print('%-12s %10s %10s %8s' % ('stage', 'baseline', 'current', 'ratio'))
+    for stage in STAGES + ['total']:
+        if stage == 'total':
+            baseline_s, current_s = baseline['total_seconds'], current['total_seconds']
+        else:
+            baseline_s = baseline['stage_seconds'].get(stage, 0.0)
+            current_s = current['stage_seconds'].get(stage, 0.0)
+        ratio = current_s / baseline_s if baseline_s else float('nan')
+        flag = ''
+        if baseline_s and ratio > 1 + tolerance:
+            regressions.append(stage)
+            flag = ' REGRESSION'
+        print('%-12s %10.2f %10.2f %8.2f%s' % (stage, baseline_s, current_s, ratio,
+                                               flag))
+
+    # Counts which were added after the baseline was recorded are ignored.
+    if any(current['counts'].get(name) != count
+           for name, count in baseline['counts'].items()):
+        print('Warning: the runs processed different amounts of work, so the timings '
+              'may not be comparable.')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = arg_parser.add_subparsers(dest='command')
+
+    generate_parser = subparsers.add_parser('generate',
+                                            help='Generate synthetic inputs')
+    generate_parser.add_argument('out_dir_path')
+    generate_parser.add_argument('--no-species', type=int, default=1000)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--gfc-resolution', type=float,
+                                 help='Also generate synthetic GFC and DEM rasters '
+                                      'with this resolution in degrees')
+
+    run_parser = subparsers.add_parser('run', help='Time every stage of the pipeline')
+    run_parser.add_argument('inputs_dir_path')
+    run_parser.add_argument('--output', default='benchmark_results.json')
+    run_parser.add_argument('--memory-budget-mb', type=float)
+
+    compare_parser = subparsers.add_parser('compare',
+                                           help='Compare two benchmark results files')
+    compare_parser.add_argument('baseline_path')
+    compare_parser.add_argument('current_path')
+    compare_parser.add_argument('--tolerance', type=float,
+                                default=REGRESSION_TOLERANCE)
+
+    args = arg_parser.parse_args()
+
+    if args.command == 'generate':
+        generate_synthetic_inputs(args.out_dir_path, args.no_species, args.seed,
+                                  args.gfc_resolution)
+    elif args.command == 'run':
+        results = run_benchmark(args.inputs_dir_path, args.memory_budget_mb)
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=1)
+        print(json.dumps(results['stage_seconds'], indent=1))
+    elif args.command == 'compare':
+        with open(args.baseline_path) as baseline_file, \
+                open(args.current_path) as current_file:
+            regressions = compare_benchmark_results(json.load(baseline_file),
+                                                    json.load(current_file),
+                                                    args.tolerance)
+        sys.exit(1 if regressions else 0)
+    else:
+        arg_parser.print_help()
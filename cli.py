@@ -1,31 +1,287 @@
 import argparse
+import sys
 
-from main import main
+from progress import RunCancelled
 
-arg_parser = argparse.ArgumentParser()
-arg_parser.add_argument('range_map_geodatabase_path',
+# The modules which run the stages are only imported once the arguments have been
+# parsed, as some of them take a while to import, so that --help and the status
+# subcommand return straight away.
+
+SUBCOMMANDS = ('run', 'preprocess', 'analyse', 'postprocess', 'merge', 'status')
+
+
+def _add_preprocess_args(parser):
+    parser.add_argument('--aoi',
+                        help='Only analyse species with a range map which intersects '
+                             'this area of interest: a path to a vector file or a '
+                             'bounding box "min_lon,min_lat,max_lon,max_lat"')
+    parser.add_argument('--clip-to-aoi', action='store_true',
+                        help='Clip the range maps to the area of interest')
+    parser.add_argument('--range-rasters',
+                        help='Analyse the range map rasters in this directory, the '
+                             'bands of this VRT or the masks in this mask store '
+                             'instead of the range maps in the geodatabase, which is '
+                             'ignored')
+    parser.add_argument('--range-raster-manifest',
+                        help='Path to CSV file saying which species and season each '
+                             'range map raster is for. Optional for a mask store')
+
+
+def _add_analyse_args(parser):
+    parser.add_argument('--zone-raster',
+                        help='Also break the results down by the integer zone codes '
+                             '(e.g. country codes) in this GEE Image asset, or in this '
+                             'local raster when emulating')
+
+
+def _add_postprocess_args(parser):
+    parser.add_argument('--generation-length-distributions-table-path',
+                        help='Path to CSV file containing species generation length '
+                             'distributions')
+    parser.add_argument('--results-store-path',
+                        help='Path to a directory to write a Parquet results store to')
+
+
+def _add_run_args(parser, run_id_required=False, shardable=True):
+    parser.add_argument('--run-id', required=run_id_required,
+                        help='Name everything the run creates after this ID. Every '
+                             'shard of a run must be given the same ID')
+    if shardable:
+        parser.add_argument('--shard',
+                            help='Only analyse shard i of N, given as "i/N", e.g. to '
+                                 'spread a run over several machines')
+    parser.add_argument('--emulator-dir-path',
+                        help='Emulate Google Earth Engine and Google Cloud Storage '
+                             'in this directory instead of using them')
+    parser.add_argument('--trace-file-path',
+                        help='Record the time and resources used by every stage in '
+                             'this JSON-lines file')
+
+
+def _add_resume_args(parser):
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on from where an earlier attempt at the run given '
+                             'by --run-id stopped')
+
+
+def _run(args):
+    from main import main
+
+    main(args.range_map_geodatabase_path,
+         args.layer_name,
+         args.forest_dependency_spreadsheet_path,
+         args.global_canopy_cover_threshold,
+         args.aoo_canopy_cover_threshold,
+         args.altitude_limits_table_path,
+         args.generation_lengths_table_path,
+         args.generation_length_distributions_table_path,
+         args.results_store_path,
+         args.emulator_dir_path,
+         args.dry_run,
+         args.trace_file_path,
+         args.aoi,
+         args.clip_to_aoi,
+         args.zone_raster,
+         args.run_id,
+         args.shard,
+         args.range_rasters,
+         args.range_raster_manifest,
+         args.resume)
+
+
+def _preprocess(args):
+    from main import end_run, run_preprocess_stage, start_run, validate_run_args
+
+    validate_run_args(args.run_id, args.shard, args.resume, args.aoi,
+                      args.range_rasters, args.range_raster_manifest)
+
+    try:
+        run = start_run(args.run_id, args.shard, args.emulator_dir_path,
+                        trace_file_path=args.trace_file_path)
+        run_preprocess_stage(args.range_map_geodatabase_path, args.layer_name,
+                             args.forest_dependency_spreadsheet_path, args.aoi,
+                             args.clip_to_aoi, args.range_rasters,
+                             args.range_raster_manifest, args.resume,
+                             args.altitude_limits_table_path)
+    finally:
+        end_run(args.trace_file_path)
+    print('To analyse the range maps, run:\n  python cli.py analyse --run-id %s%s '
+          '...' % (run.run_id, ' --shard %s' % args.shard if args.shard else ''))
+
+
+def _analyse(args):
+    from main import end_run, run_analyse_stage, start_run
+
+    try:
+        start_run(args.run_id, args.shard, args.emulator_dir_path,
+                  trace_file_path=args.trace_file_path)
+        run_analyse_stage(args.altitude_limits_table_path,
+                          args.global_canopy_cover_threshold,
+                          args.aoo_canopy_cover_threshold,
+                          args.zone_raster,
+                          resume=args.resume)
+    finally:
+        end_run(args.trace_file_path)
+
+
+def _postprocess(args):
+    from main import end_run, run_postprocess_stage, start_run
+
+    try:
+        start_run(args.run_id, args.shard, args.emulator_dir_path,
+                  trace_file_path=args.trace_file_path)
+        run_postprocess_stage(args.generation_lengths_table_path,
+                              args.generation_length_distributions_table_path,
+                              args.results_store_path)
+    finally:
+        end_run(args.trace_file_path)
+
+
+def _merge(args):
+    from main import end_run, start_run
+    from postprocessor import merge_shards
+
+    try:
+        start_run(args.run_id, emulator_dir_path=args.emulator_dir_path,
+                  trace_file_path=args.trace_file_path)
+        merge_shards(args.run_id,
+                     args.generation_lengths_table_path,
+                     args.generation_length_distributions_table_path,
+                     args.results_store_path,
+                     args.allow_partial)
+    finally:
+        end_run(args.trace_file_path)
+
+
+def _status(args):
+    from runs import parse_shard
+    from status import print_status
+
+    if args.tasks:
+        # Only the task listing needs the backend, and so credentials.
+        from backends import LocalBackend, get_backend, set_backend
+        if args.emulator_dir_path:
+            set_backend(LocalBackend(args.emulator_dir_path))
+        else:
+            get_backend().authenticate()
+
+    print_status(args.run_id, parse_shard(args.shard) if args.shard else None,
+                 args.tasks)
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Estimate forest habitat loss within species\' ranges. Run the whole '
+                'pipeline with "run", or one stage at a time with "preprocess", '
+                '"analyse" and "postprocess". Combine the results of the shards of a '
+                'run with "merge". If no subcommand is given, "run" is assumed.')
+subparsers = arg_parser.add_subparsers(dest='subcommand')
+
+run_parser = subparsers.add_parser('run', help='Run the whole pipeline')
+run_parser.add_argument('range_map_geodatabase_path',
                         help='Path to ESRI file geodatabase containing species range '
                              'maps')
-arg_parser.add_argument('layer_name',
+run_parser.add_argument('layer_name',
                         help='Name of layer in geodatabase containing range maps')
-arg_parser.add_argument('forest_dependency_spreadsheet_path',
+run_parser.add_argument('forest_dependency_spreadsheet_path',
                         help='Path to Excel spreadsheet containing forest dependency '
                              'information')
-arg_parser.add_argument('altitude_limits_table_path',
+run_parser.add_argument('altitude_limits_table_path',
                         help='Path to CSV file containing species altitude limits')
-arg_parser.add_argument('generation_lengths_table_path',
+run_parser.add_argument('generation_lengths_table_path',
                         help='Path to CSV file containing species generation lengths')
-arg_parser.add_argument('global_canopy_cover_threshold',
+run_parser.add_argument('global_canopy_cover_threshold',
                         help='Global canopy cover threshold')
-arg_parser.add_argument('aoo_canopy_cover_threshold',
+run_parser.add_argument('aoo_canopy_cover_threshold',
                         help='AOO canopy cover threshold')
+run_parser.add_argument('--dry-run', action='store_true',
+                        help='Report the tasks, assets, uploads and pixel reductions '
+                             'a run would need without using Google Earth Engine')
+_add_preprocess_args(run_parser)
+_add_analyse_args(run_parser)
+_add_postprocess_args(run_parser)
+_add_run_args(run_parser)
+_add_resume_args(run_parser)
+run_parser.set_defaults(handler=_run)
+
+preprocess_parser = subparsers.add_parser(
+    'preprocess', help='Pre-process range maps and upload them to GEE')
+preprocess_parser.add_argument('range_map_geodatabase_path',
+                               help='Path to ESRI file geodatabase containing species '
+                                    'range maps')
+preprocess_parser.add_argument('layer_name',
+                               help='Name of layer in geodatabase containing range '
+                                    'maps')
+preprocess_parser.add_argument('forest_dependency_spreadsheet_path',
+                               help='Path to Excel spreadsheet containing forest '
+                                    'dependency information')
+preprocess_parser.add_argument('--altitude-limits-table-path',
+                               help='Path to CSV file containing species altitude '
+                                    'limits, to pre-clip the range maps to if that\'s '
+                                    'turned on in the configuration file')
+_add_preprocess_args(preprocess_parser)
+_add_run_args(preprocess_parser)
+_add_resume_args(preprocess_parser)
+preprocess_parser.set_defaults(handler=_preprocess)
+
+analyse_parser = subparsers.add_parser(
+    'analyse', help='Analyse the range maps a run has pre-processed')
+analyse_parser.add_argument('altitude_limits_table_path',
+                            help='Path to CSV file containing species altitude limits')
+analyse_parser.add_argument('global_canopy_cover_threshold',
+                            help='Global canopy cover threshold')
+analyse_parser.add_argument('aoo_canopy_cover_threshold',
+                            help='AOO canopy cover threshold')
+_add_analyse_args(analyse_parser)
+_add_run_args(analyse_parser, run_id_required=True)
+_add_resume_args(analyse_parser)
+analyse_parser.set_defaults(handler=_analyse)
+
+postprocess_parser = subparsers.add_parser(
+    'postprocess', help='Download and post-process the results of a run')
+postprocess_parser.add_argument('generation_lengths_table_path',
+                                help='Path to CSV file containing species generation '
+                                     'lengths')
+_add_postprocess_args(postprocess_parser)
+_add_run_args(postprocess_parser, run_id_required=True)
+postprocess_parser.set_defaults(handler=_postprocess)
+
+merge_parser = subparsers.add_parser(
+    'merge', help='Combine the results of every shard of a sharded run')
+merge_parser.add_argument('generation_lengths_table_path',
+                          help='Path to CSV file containing species generation '
+                               'lengths')
+merge_parser.add_argument('--allow-partial', action='store_true',
+                          help='Merge the shards which have finished even if others '
+                               'are missing or unfinished')
+_add_postprocess_args(merge_parser)
+_add_run_args(merge_parser, run_id_required=True, shardable=False)
+merge_parser.set_defaults(handler=_merge)
+
+status_parser = subparsers.add_parser(
+    'status', help='Show the runs on this machine, or the progress of one')
+status_parser.add_argument('run_id', nargs='?',
+                           help='The run to show the progress of. If not given, the '
+                                'runs on this machine are listed')
+status_parser.add_argument('--shard',
+                           help='Only show shard i of N, given as "i/N"')
+status_parser.add_argument('--tasks', action='store_true',
+                           help='Also count the run\'s GEE tasks by state, which needs '
+                                'credentials')
+status_parser.add_argument('--emulator-dir-path',
+                           help='Count the tasks of the emulator in this directory')
+status_parser.set_defaults(handler=_status)
+
+argv = sys.argv[1:]
+# Before there were subcommands, the arguments of "run" were given on their own.
+if argv and argv[0] not in SUBCOMMANDS and argv[0] not in ('-h', '--help'):
+    argv.insert(0, 'run')
+args = arg_parser.parse_args(argv)
 
-args = arg_parser.parse_args()
+if args.subcommand is None:
+    arg_parser.print_help()
+    sys.exit(2)
 
-main(args.range_map_geodatabase_path,
-     args.layer_name,
-     args.forest_dependency_spreadsheet_path,
-     args.global_canopy_cover_threshold,
-     args.aoo_canopy_cover_threshold,
-     args.altitude_limits_table_path,
-     args.generation_lengths_table_path)
+try:
+    args.handler(args)
+except RunCancelled:
+    sys.exit(1)
@@ -0,0 +1,218 @@
+# A model of how long GEE takes to analyse a range map, used to submit the most
+# expensive ranges first so that a few enormous ranges don't hold up the end of a run.
+#
+# The predicted cost of a range is a linear function of its features. Every time
+# a run finishes, the predicted and actual durations of its tasks are appended to
+# TASK_COSTS_FP and the model is refitted to all of the logged tasks.
+
+import json
+import os
+import time
+from math import radians, sin
+
+import numpy as np
+
+COST_MODEL_FP = 'out/cost_model.json'
+TASK_COSTS_FP = 'out/task_costs.jsonl'
+
+FEATURE_NAMES = ['intercept', 'range_pixels', 'bbox_area_km2', 'alt_range_pixels']
+# Used until enough tasks have been logged to fit the model. Only the order of the
+# predictions matters for scheduling, so these just need to be plausible.
+DEFAULT_COEFFICIENTS = {'intercept': 60.0,
+                        'range_pixels': 1e-3,
+                        'bbox_area_km2': 1e-5,
+                        'alt_range_pixels': 0.0}
+MIN_NO_TASKS_TO_FIT = 20
+# Only the most recently logged tasks are used to fit the model.
+MAX_NO_TASKS_TO_FIT = 100000
+# The altitude band of a species is expressed as a fraction of this range.
+ALT_SPAN = 5000
+# Radius of the authalic sphere in kilometres.
+EARTH_RADIUS_KM = 6371.0072
+# A task is only matched with a prediction if it started no earlier than this many
+# seconds before the prediction was made, to allow for clock differences.
+CLOCK_TOLERANCE_S = 300
+# The states of tasks which finished successfully, as reported by GEE and by the
+# local emulator.
+FINISHED_STATES = ('SUCCEEDED', 'COMPLETED')
+
+# Predictions for tasks submitted by this process which haven't been logged yet,
+# keyed by task description.
+_pending_predictions = {}
+
+
+def compute_bbox_area_km2(bounds, equal_area=False):
+    """Compute the area of a bounding box in EPSG:4326 or in an equal-area CRS.
+
+    :param bounds: A tuple (min_lon, min_lat, max_lon, max_lat), or (min_x, min_y,
+        max_x, max_y) in metres if equal_area is True.
+    :param equal_area: Whether bounds are in an equal-area CRS rather than
+        EPSG:4326.
+    :return: The area in square kilometres.
+    """
+    if equal_area:
+        min_x, min_y, max_x, max_y = bounds
+        return abs(max_x - min_x) * abs(max_y - min_y) / 1e6
+
+    min_lon, min_lat, max_lon, max_lat = bounds
+    return EARTH_RADIUS_KM ** 2 * radians(max_lon - min_lon) * \
+        abs(sin(radians(max_lat)) - sin(radians(min_lat)))
+
+
+def estimate_range_area_km2(bbox_area_km2, no_range_pixels, no_pixels):
+    """Estimate the area of a range from its range map raster, assuming that its
+    pixels all have the same area.
+
+    :param bbox_area_km2: The area of the bounding box of the range map.
+    :param no_range_pixels: The number of pixels within the range.
+    :param no_pixels: The number of pixels in the range map raster.
+    :return: The area in square kilometres.
+    """
+    return bbox_area_km2 * no_range_pixels / max(no_pixels, 1)
+
+
+def create_features(no_range_pixels, bbox_area_km2, min_alt, max_alt):
+    """Create the features of a range map which its cost is predicted from.
+
+    :param no_range_pixels: The number of pixels within the range in the range map
+        raster, or None if unknown.
+    :param bbox_area_km2: The area of the bounding box of the range map, or None if
+        unknown.
+    :param min_alt: The minimum altitude of the species.
+    :param max_alt: The maximum altitude of the species.
+    :return: A dictionary mapping feature names to values, or None if the features
+        are unknown.
+    """
+    if no_range_pixels is None or bbox_area_km2 is None:
+        return None
+
+    alt_band_fraction = min(1.0, max(0.0, (max_alt - min_alt) / ALT_SPAN))
+    return {'intercept': 1.0,
+            'range_pixels': float(no_range_pixels),
+            'bbox_area_km2': float(bbox_area_km2),
+            'alt_range_pixels': float(no_range_pixels) * alt_band_fraction}
+
+
+def load_cost_model(cost_model_fp=COST_MODEL_FP):
+    """Load the coefficients of the cost model.
+
+    :param cost_model_fp: Path to a JSON file written by refit_cost_model.
+    :return: A dictionary mapping feature names to coefficients.
+    """
+    if not os.path.exists(cost_model_fp):
+        return dict(DEFAULT_COEFFICIENTS)
+
+    with open(cost_model_fp) as cost_model_file:
+        return json.load(cost_model_file)['coefficients']
+
+
+def predict_cost(features, coefficients):
+    """Predict how many seconds GEE will take to analyse a range map.
+
+    :param features: A dictionary returned by create_features.
+    :param coefficients: A dictionary returned by load_cost_model.
+    :return: The predicted duration in seconds, or None if features is None.
+    """
+    if features is None:
+        return None
+    return sum(coefficients.get(feature_name, 0.0) * features[feature_name]
+               for feature_name in FEATURE_NAMES)
+
+
+def record_prediction(description, features, predicted_s):
+    """Remember the predicted cost of a task which is about to be submitted, so that
+    it can be logged along with its actual cost by log_task_costs.
+
+    :param description: The description of the task.
+    :param features: A dictionary returned by create_features.
+    :param predicted_s: The predicted duration in seconds.
+    """
+    _pending_predictions[description] = {'description': description,
+                                         'submitted': time.time(),
+                                         'features': features,
+                                         'predicted_s': predicted_s}
+
+
+def log_task_costs(tasks, task_costs_fp=TASK_COSTS_FP):
+    """Append the predicted and actual durations of every finished task which was
+    submitted by this process to the task costs log.
+
+    :param tasks: A list of task dictionaries, as returned by the list_tasks method of
+        a backend.
+    :param task_costs_fp: Path to the task costs log.
+    :return: The number of tasks logged.
+    """
+    # Find the most recent finished task with each description.
+    finished_tasks = {}
+    for task in tasks:
+        if task.get('state') not in FINISHED_STATES or \
+                task.get('start_time') is None or task.get('end_time') is None:
+            continue
+        latest_task = finished_tasks.get(task['description'])
+        if latest_task is None or task['start_time'] > latest_task['start_time']:
+            finished_tasks[task['description']] = task
+
+    task_cost_dicts = []
+    for description, prediction in list(_pending_predictions.items()):
+        task = finished_tasks.get(description)
+        if task is None or \
+                task['start_time'] < prediction['submitted'] - CLOCK_TOLERANCE_S:
+            continue
+        task_cost_dicts.append(dict(prediction,
+                                    actual_s=task['end_time'] - task['start_time']))
+        del _pending_predictions[description]
+
+    if task_cost_dicts:
+        os.makedirs(os.path.dirname(task_costs_fp) or '.', exist_ok=True)
+        with open(task_costs_fp, 'a') as task_costs_file:
+            for task_cost_dict in task_cost_dicts:
+                task_costs_file.write(json.dumps(task_cost_dict) + '\n')
+
+    return len(task_cost_dicts)
+
+
+def refit_cost_model(task_costs_fp=TASK_COSTS_FP, cost_model_fp=COST_MODEL_FP):
+    """Fit the cost model to the logged task costs by least squares and save it. The
+    model isn't changed if too few tasks have been logged.
+
+    :param task_costs_fp: Path to the task costs log.
+    :param cost_model_fp: Path to write the coefficients to.
+    :return: A dictionary mapping feature names to coefficients, or None if the
+        model wasn't fitted.
+    """
+    if not os.path.exists(task_costs_fp):
+        return None
+
+    with open(task_costs_fp) as task_costs_file:
+        task_cost_dicts = [json.loads(line) for line in task_costs_file]
+    task_cost_dicts = [task_cost_dict for task_cost_dict
+                       in task_cost_dicts[-MAX_NO_TASKS_TO_FIT:]
+                       if task_cost_dict['features'] is not None]
+    if len(task_cost_dicts) < MIN_NO_TASKS_TO_FIT:
+        return None
+
+    features_arr = np.array([[task_cost_dict['features'][feature_name]
+                              for feature_name in FEATURE_NAMES]
+                             for task_cost_dict in task_cost_dicts])
+    actual_s_arr = np.array([task_cost_dict['actual_s']
+                             for task_cost_dict in task_cost_dicts])
+
+    # Scale the features so that the problem is well conditioned.
+    scales = np.abs(features_arr).max(axis=0)
+    scales[scales == 0] = 1
+    scaled_coefficients = np.linalg.lstsq(features_arr / scales, actual_s_arr,
+                                          rcond=None)[0]
+    # A bigger range can't be cheaper to analyse.
+    coefficients_arr = np.clip(scaled_coefficients / scales, 0, None)
+    coefficients = dict(zip(FEATURE_NAMES, coefficients_arr.tolist()))
+
+    predicted_s_arr = features_arr.dot(coefficients_arr)
+    os.makedirs(os.path.dirname(cost_model_fp) or '.', exist_ok=True)
+    with open(cost_model_fp, 'w') as cost_model_file:
+        json.dump({'coefficients': coefficients,
+                   'no_tasks': len(task_cost_dicts),
+                   'mean_absolute_error_s':
+                       float(np.abs(predicted_s_arr - actual_s_arr).mean())},
+                  cost_model_file, indent=1)
+
+    return coefficients
@@ -0,0 +1,517 @@
+"""Check that every engine and configuration which can compute the estimates agrees
+with a reference, and record how long each takes and how much memory it needs.
+
+The same inputs, synthetic ones written by benchmark.py or a sample of real range maps
+laid out in the same way, are run through the pipeline once per engine, each in its
+own process. The post-processed results of every engine ("2001_remaining", the
+"20XY_loss" columns, the "3gl_" columns, etc.) are compared with those of the
+reference engine, and the check fails if any differs by more than the tolerances, or
+if an engine is slower or needs more memory than its budget or its time in an
+earlier check. The reference is GEE, analysing every range at a fixed scale, unless
+another engine is given.
+
+Example:
+    python crosscheck.py run real-sample --output crosscheck.json
+    python crosscheck.py run real-sample --engines local,local-mask-store \\
+        --baseline crosscheck.json
+    python benchmark.py generate synthetic-inputs --no-species 50 --gfc-resolution 0.01
+    python crosscheck.py run synthetic-inputs --engines local,local-equal-area \\
+        --reference local
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from benchmark import ALT_LIMS_FILENAME, FOREST_DEP_FILENAME, GFC_FILENAMES, \
+    GLS_FILENAME, LAYER_NAME, RANGES_FILENAME, REGRESSION_TOLERANCE, _get_git_commit
+
+# Module attributes to override for each configuration, as "module.ATTRIBUTE".
+# Analysing every range at gfc_calculator.SCALE is how ranges were analysed before
+# the scale was chosen from their area.
+FIXED_SCALE_OVERRIDES = {'gfc_calculator.SCALES': [600]}
+EQUAL_AREA_OVERRIDES = {'preprocessor.RASTER_CRS': 'EPSG:6933',
+                        'preprocessor.RASTER_CRS_IS_GEOGRAPHIC': False,
+                        'preprocessor.PIXEL_WIDTH_STR': '1850',
+                        'preprocessor.PIXEL_HEIGHT_STR': '1850',
+                        'gfc_calculator.RASTER_CRS': 'EPSG:6933'}
+
+# "backend" is "gee" or "local". The local engine computes the estimates with
+# local_calculator from the GFC and DEM rasters in the inputs directory, or makes
+# them up from the ranges' areas if there aren't any. "range_rasters_from" names an
+# engine whose mask store is analysed instead of the geodatabase. That engine
+# exports its range masks to a mask store as well.
+ENGINES = OrderedDict([
+    ('gee', {'backend': 'gee', 'overrides': FIXED_SCALE_OVERRIDES}),
+    ('gee-adaptive-scale', {'backend': 'gee', 'overrides': {}}),
+    ('gee-equal-area', {'backend': 'gee', 'overrides': EQUAL_AREA_OVERRIDES}),
+    ('local', {'backend': 'local', 'overrides': {}}),
+    ('local-mask-store', {'backend': 'local', 'overrides': {},
+                          'range_rasters_from': 'local'}),
+    ('local-equal-area', {'backend': 'local', 'overrides': EQUAL_AREA_OVERRIDES}),
+])
+# The engine the others are compared with by default: GEE, as the local engines
+# emulate it.
+REFERENCE_ENGINE = 'gee'
+# The other GEE engines need credentials and use GEE quota, so they're only run if
+# asked for.
+DEFAULT_ENGINES = [REFERENCE_ENGINE, 'local', 'local-mask-store', 'local-equal-area']
+
+# A value is within tolerance if it differs from the reference by no more than
+# ABS_TOLERANCE plus REL_TOLERANCE times the reference. Areas are in square
+# kilometres and "3gl_percent_loss" is in percent.
+ABS_TOLERANCE = 1.0
+REL_TOLERANCE = 0.02
+# Columns which aren't estimates, so aren't compared.
+ID_COLUMNS = ['sisid', 'sci_name', 'breeding', 'scale']
+
+
+def _apply_overrides(overrides):
+    """Set module attributes, e.g. to change the configuration read from the
+    configuration file.
+
+    :param overrides: A dictionary mapping "module.ATTRIBUTE" to values.
+    """
+    for name, value in overrides.items():
+        module_name, attribute_name = name.rsplit('.', 1)
+        setattr(importlib.import_module(module_name), attribute_name, value)
+
+
+def _init_rasterisation_worker(overrides):
+    """Initialise a rasterisation worker process with an engine's overrides, which
+    it doesn't inherit if worker processes are spawned rather than forked.
+
+    :param overrides: See _apply_overrides.
+    """
+    import preprocessor
+
+    preprocessor._init_rasterisation_worker()
+    _apply_overrides(overrides)
+
+
+def _get_peak_rss_mb():
+    """Get the peak resident set size of this process and of the rasterisation
+    workers it has waited for.
+
+    :return: The larger peak resident set size in mebibytes, or None if it can't be
+        determined.
+    """
+    from tracing import get_peak_rss_mb, resource
+
+    peak_rss_mb = get_peak_rss_mb()
+    if resource is not None and peak_rss_mb is not None:
+        children_peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        peak_rss_mb = max(peak_rss_mb, children_peak_rss /
+                          (2 ** 20 if sys.platform == 'darwin' else 2 ** 10))
+    return peak_rss_mb
+
+
+def _check_gee_is_available():
+    """Check that Google Earth Engine can be used, for the GEE engines.
+
+    :raises ValueError: If it can't.
+    """
+    try:
+        import ee
+        ee.Initialize()
+    except Exception as e:
+        raise ValueError('Google Earth Engine isn\'t available, so the GEE engines '
+                         'can\'t be run (%s). Log in to it, take the reference '
+                         'results from a baseline computed with GEE or give another '
+                         'reference engine.' % e)
+
+
+def run_engine(engine_name, inputs_dir_path, run_id, work_dir_path,
+               range_rasters_path=None, export_mask_store=False):
+    """Run the pipeline on a set of inputs with one engine, in the current process,
+    and keep the post-processed results in memory.
+
+    :param engine_name: A key of ENGINES.
+    :param inputs_dir_path: Path to a directory laid out like those written by
+        benchmark.generate_synthetic_inputs.
+    :param run_id: The run ID to give the run.
+    :param work_dir_path: Path to a directory in which the local engines' emulator
+        is kept.
+    :param range_rasters_path: Path to the mask store to analyse, if the engine has
+        "range_rasters_from".
+    :param export_mask_store: Whether to export the range masks to the run's mask
+        store, for another engine to analyse.
+    :return: A dictionary with the keys "stage_seconds", "total_seconds",
+        "peak_rss_mb" and "results", which maps "<SISID>_<breeding>" to a dictionary
+        of the range's post-processed results.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    engine = ENGINES[engine_name]
+    _apply_overrides(engine['overrides'])
+    if export_mask_store:
+        _apply_overrides({'preprocessor.EXPORT_MASK_STORE': True})
+
+    import preprocessor
+    from backends import LocalBackend, set_backend
+    from gfc_calculator import BUCKET_NAME, GFC_FINAL_YR
+    from main import run_analyse_stage, run_preprocess_stage, start_run
+    from postprocessor import _populate_gl_dict, _postprocess_results_dicts, \
+        _read_results_from_bucket
+
+    if engine['overrides']:
+        preprocessor._RASTERISATION_POOL = ProcessPoolExecutor(
+            preprocessor.NO_RASTERISATION_WORKERS,
+            initializer=_init_rasterisation_worker, initargs=(engine['overrides'],))
+
+    stage_seconds = OrderedDict()
+    start = time.perf_counter()
+    if engine['backend'] == 'local':
+        emulator_dir_path = os.path.join(work_dir_path, 'emulator')
+        run = start_run(run_id, emulator_dir_path=emulator_dir_path)
+        set_backend(LocalBackend(emulator_dir_path, {
+            key: os.path.join(inputs_dir_path, filename)
+            for key, filename in GFC_FILENAMES.items()
+            if os.path.exists(os.path.join(inputs_dir_path, filename))}))
+    else:
+        run = start_run(run_id)
+
+    if range_rasters_path:
+        range_map_ic_gee_path = run_preprocess_stage(
+            range_rasters_path=range_rasters_path)
+    else:
+        range_map_ic_gee_path = run_preprocess_stage(
+            os.path.join(inputs_dir_path, RANGES_FILENAME), LAYER_NAME,
+            os.path.join(inputs_dir_path, FOREST_DEP_FILENAME),
+            altitude_limits_table_path=os.path.join(inputs_dir_path,
+                                                    ALT_LIMS_FILENAME))
+    stage_seconds['preprocess'] = time.perf_counter() - start
+
+    stage_start = time.perf_counter()
+    run_analyse_stage(os.path.join(inputs_dir_path, ALT_LIMS_FILENAME), None, None,
+                      range_map_ic_gee_path=range_map_ic_gee_path)
+    stage_seconds['analyse'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    results_dicts = _postprocess_results_dicts(
+        _read_results_from_bucket(BUCKET_NAME, run.bucket_prefix),
+        _populate_gl_dict(os.path.join(inputs_dir_path, GLS_FILENAME)),
+        GFC_FINAL_YR)
+    stage_seconds['postprocess'] = time.perf_counter() - stage_start
+
+    return OrderedDict([
+        ('stage_seconds', stage_seconds),
+        ('total_seconds', time.perf_counter() - start),
+        ('peak_rss_mb', _get_peak_rss_mb()),
+        ('results', OrderedDict(
+            ('%s_%s' % (results_dict['sisid'], results_dict['breeding']), results_dict)
+            for results_dict in results_dicts)),
+    ])
+
+
+def _run_engine_in_subprocess(engine_name, inputs_dir_path, run_id, work_dir_path,
+                              range_rasters_path=None, export_mask_store=False):
+    """Run run_engine in a new Python process, so that engines' overrides and
+    memory use don't affect each other.
+
+    :return: The dictionary returned by run_engine.
+    """
+    output_path = os.path.join(work_dir_path, 'engine_results.json')
+    args = [sys.executable, os.path.realpath(__file__), 'engine', engine_name,
+            inputs_dir_path, run_id, work_dir_path, output_path]
+    if range_rasters_path:
+        args += ['--range-rasters', range_rasters_path]
+    if export_mask_store:
+        args.append('--export-mask-store')
+    subprocess.run(args, check=True)
+    with open(output_path) as output_file:
+        return json.load(output_file, object_pairs_hook=OrderedDict)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compare_results(reference_results, results, abs_tolerance=ABS_TOLERANCE,
+                    rel_tolerance=REL_TOLERANCE):
+    """Compare an engine's results with the reference results, column by column.
+
+    :param reference_results: The "results" returned by run_engine for the
+        reference engine.
+    :param results: The "results" returned by run_engine for another engine.
+    :param abs_tolerance: See ABS_TOLERANCE.
+    :param rel_tolerance: See REL_TOLERANCE.
+    :return: A dictionary with the keys "missing_ranges" and "extra_ranges", lists
+        of the ranges only in the reference results or only in results, and
+        "columns", which maps each column to a dictionary with the keys
+        "max_abs_error", "max_rel_error" and "no_out_of_tolerance".
+    """
+    column_errors = OrderedDict()
+    for key, reference_dict in reference_results.items():
+        results_dict = results.get(key)
+        if results_dict is None:
+            continue
+        for column, reference_value in reference_dict.items():
+            if column in ID_COLUMNS:
+                continue
+            errors = column_errors.setdefault(column, OrderedDict(
+                [('max_abs_error', 0.0), ('max_rel_error', 0.0),
+                 ('no_out_of_tolerance', 0)]))
+            value = results_dict.get(column)
+            reference_float, value_float = _to_float(reference_value), \
+                _to_float(value)
+            if reference_float is None or value_float is None:
+                # E.g. "3gl_loss" is empty if there's no generation length.
+                if str(reference_value) != str(value):
+                    errors['no_out_of_tolerance'] += 1
+                continue
+
+            abs_error = abs(value_float - reference_float)
+            errors['max_abs_error'] = max(errors['max_abs_error'], abs_error)
+            if reference_float:
+                errors['max_rel_error'] = max(errors['max_rel_error'],
+                                              abs_error / abs(reference_float))
+            if abs_error > abs_tolerance + rel_tolerance * abs(reference_float):
+                errors['no_out_of_tolerance'] += 1
+
+    return OrderedDict([
+        ('missing_ranges', [key for key in reference_results if key not in results]),
+        ('extra_ranges', [key for key in results if key not in reference_results]),
+        ('columns', column_errors),
+    ])
+
+
+def run_crosscheck(inputs_dir_paths, engine_names=None,
+                   reference_engine_name=REFERENCE_ENGINE, baseline=None,
+                   abs_tolerance=ABS_TOLERANCE,
+                   rel_tolerance=REL_TOLERANCE):
+    """Run every set of inputs through every engine and compare the results of each
+    engine with those of the reference engine.
+
+    :param inputs_dir_paths: A list of paths to directories laid out like those
+        written by benchmark.generate_synthetic_inputs.
+    :param engine_names: A list of keys of ENGINES. Defaults to DEFAULT_ENGINES.
+    :param reference_engine_name: The engine the others are compared with. If it
+        isn't run, its results are taken from the baseline, e.g. so that the local
+        engines can be checked against results computed with GEE in an earlier
+        check.
+    :param baseline: Optional dictionary returned by an earlier run_crosscheck.
+    :param abs_tolerance: See ABS_TOLERANCE.
+    :param rel_tolerance: See REL_TOLERANCE.
+    :return: A dictionary of results which can be serialised as JSON.
+    """
+    engine_names = engine_names or DEFAULT_ENGINES
+    if reference_engine_name not in ENGINES:
+        raise ValueError('There\'s no engine called "%s".' % reference_engine_name)
+    for engine_name in engine_names:
+        if engine_name not in ENGINES:
+            raise ValueError('There\'s no engine called "%s".' % engine_name)
+        range_rasters_from = ENGINES[engine_name].get('range_rasters_from')
+        if range_rasters_from and range_rasters_from not in engine_names[
+                :engine_names.index(engine_name)]:
+            raise ValueError('The %s engine must be run after the %s engine.' %
+                             (engine_name, range_rasters_from))
+    if reference_engine_name not in engine_names:
+        for inputs_dir_path in inputs_dir_paths:
+            if reference_engine_name not in (baseline or {}).get('inputs', {}).get(
+                    os.path.abspath(inputs_dir_path), {}).get('engines', {}):
+                raise ValueError('The reference engine, %s, isn\'t run and its '
+                                 'results for %s aren\'t in a baseline.' %
+                                 (reference_engine_name, inputs_dir_path))
+    if any(ENGINES[engine_name]['backend'] == 'gee' for engine_name in engine_names):
+        _check_gee_is_available()
+
+    from runs import Run
+
+    # The engines whose mask stores other engines analyse.
+    mask_store_engine_names = {ENGINES[engine_name].get('range_rasters_from')
+                               for engine_name in engine_names}
+    timestamp = time.strftime('%Y%m%dT%H%M%S')
+    inputs_results = OrderedDict()
+    for input_no, inputs_dir_path in enumerate(inputs_dir_paths):
+        inputs_dir_path = os.path.abspath(inputs_dir_path)
+        engines_results = OrderedDict()
+        run_ids = {}
+        work_dir_path = tempfile.mkdtemp(prefix='gfc-crosscheck-')
+        try:
+            for engine_name in engine_names:
+                run_ids[engine_name] = 'crosscheck-%s-%d-%s' % (timestamp, input_no,
+                                                                engine_name)
+                range_rasters_from = ENGINES[engine_name].get('range_rasters_from')
+                range_rasters_path = Run(run_ids[range_rasters_from]).mask_export_fp \
+                    if range_rasters_from else None
+                engines_results[engine_name] = _run_engine_in_subprocess(
+                    engine_name, inputs_dir_path, run_ids[engine_name],
+                    work_dir_path, range_rasters_path,
+                    engine_name in mask_store_engine_names)
+        finally:
+            shutil.rmtree(work_dir_path, ignore_errors=True)
+            for run_id in run_ids.values():
+                shutil.rmtree(Run(run_id).work_dir_path, ignore_errors=True)
+
+        if reference_engine_name in engines_results:
+            reference_results = engines_results[reference_engine_name]['results']
+        else:
+            reference_results = baseline['inputs'][inputs_dir_path]['engines'][
+                reference_engine_name]['results']
+        for engine_name, engine_results in engines_results.items():
+            engine_results['errors'] = compare_results(
+                reference_results, engine_results['results'], abs_tolerance,
+                rel_tolerance)
+        inputs_results[inputs_dir_path] = OrderedDict([('engines', engines_results)])
+
+    return OrderedDict([
+        ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('git_commit', _get_git_commit()),
+        ('reference_engine', reference_engine_name),
+        ('abs_tolerance', abs_tolerance),
+        ('rel_tolerance', rel_tolerance),
+        ('inputs', inputs_results),
+    ])
+
+
+def check_crosscheck_results(crosscheck_results, baseline=None,
+                             tolerance=REGRESSION_TOLERANCE, max_seconds=None,
+                             max_memory_mb=None):
+    """Print the errors, timings and memory use of every engine and find the
+    failures.
+
+    :param crosscheck_results: A dictionary returned by run_crosscheck.
+    :param baseline: Optional dictionary returned by an earlier run_crosscheck. An
+        engine fails if it's slower or needs more memory than in the baseline by
+        more than tolerance.
+    :param tolerance: See baseline.
+    :param max_seconds: Optional budget for the time each engine takes to run
+        through a set of inputs.
+    :param max_memory_mb: Optional budget for each engine's peak resident set size.
+    :return: A list of descriptions of the failures.
+    """
+    failures = []
+    for inputs_dir_path, inputs_results in crosscheck_results['inputs'].items():
+        print(inputs_dir_path)
+        print('%-20s %-20s %12s %12s %8s' % ('engine', 'column', 'max abs err',
+                                             'max rel err', 'failed'))
+        for engine_name, engine_results in inputs_results['engines'].items():
+            errors = engine_results['errors']
+            failed_columns = []
+            for column, column_errors in errors['columns'].items():
+                if column_errors['no_out_of_tolerance'] or \
+                        column_errors['max_abs_error']:
+                    print('%-20s %-20s %12.4g %12.4g %8d' % (
+                        engine_name, column, column_errors['max_abs_error'],
+                        column_errors['max_rel_error'],
+                        column_errors['no_out_of_tolerance']))
+                if column_errors['no_out_of_tolerance']:
+                    failed_columns.append('%s (%d)' % (
+                        column, column_errors['no_out_of_tolerance']))
+            if failed_columns:
+                failures.append('%s: values out of tolerance in %s' % (
+                    engine_name, ', '.join(failed_columns)))
+            for key in ('missing_ranges', 'extra_ranges'):
+                if errors[key]:
+                    failures.append('%s: %s %s' % (engine_name,
+                                                   key.replace('_', ' '),
+                                                   ', '.join(errors[key])))
+
+        print('%-20s %10s %10s %10s %10s %10s' % ('engine', 'preprocess', 'analyse',
+                                                  'postproc', 'total', 'peak MB'))
+        for engine_name, engine_results in inputs_results['engines'].items():
+            stage_seconds = engine_results['stage_seconds']
+            peak_rss_mb = engine_results['peak_rss_mb']
+            print('%-20s %10.2f %10.2f %10.2f %10.2f %10s' % (
+                engine_name, stage_seconds['preprocess'], stage_seconds['analyse'],
+                stage_seconds['postprocess'], engine_results['total_seconds'],
+                '%.0f' % peak_rss_mb if peak_rss_mb is not None else '?'))
+
+            if max_seconds and engine_results['total_seconds'] > max_seconds:
+                failures.append('%s took %.1f s, more than the budget of %.1f s.' %
+                                (engine_name, engine_results['total_seconds'],
+                                 max_seconds))
+            if max_memory_mb and peak_rss_mb and peak_rss_mb > max_memory_mb:
+                failures.append('%s needed %.0f MB, more than the budget of %.0f MB.'
+                                % (engine_name, peak_rss_mb, max_memory_mb))
+
+            baseline_results = (baseline or {}).get('inputs', {}) \
+                .get(inputs_dir_path, {}).get('engines', {}).get(engine_name)
+            if baseline_results is None:
+                continue
+            for key, unit in (('total_seconds', 's'), ('peak_rss_mb', 'MB')):
+                baseline_value, value = baseline_results[key], engine_results[key]
+                if baseline_value and value and \
+                        value > baseline_value * (1 + tolerance):
+                    failures.append('%s: %s went from %.1f %s to %.1f %s.' % (
+                        engine_name, key, baseline_value, unit, value, unit))
+
+    for failure in failures:
+        print('FAILED: %s' % failure)
+    return failures
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = arg_parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser(
+        'run', help='Run inputs through every engine and compare the results')
+    run_parser.add_argument('inputs_dir_paths', nargs='+')
+    run_parser.add_argument('--engines',
+                            help='Comma-separated engines to run, from %s. Defaults '
+                                 'to %s' % (', '.join(ENGINES),
+                                            ','.join(DEFAULT_ENGINES)))
+    run_parser.add_argument('--reference', default=REFERENCE_ENGINE,
+                            help='The engine the others are compared with. Defaults '
+                                 'to %s' % REFERENCE_ENGINE)
+    run_parser.add_argument('--output', default='crosscheck_results.json')
+    run_parser.add_argument('--baseline',
+                            help='Results of an earlier check to compare the timings '
+                                 'and memory use with, and to take the reference '
+                                 'results from if the reference engine isn\'t run')
+    run_parser.add_argument('--abs-tolerance', type=float, default=ABS_TOLERANCE)
+    run_parser.add_argument('--rel-tolerance', type=float, default=REL_TOLERANCE)
+    run_parser.add_argument('--regression-tolerance', type=float,
+                            default=REGRESSION_TOLERANCE)
+    run_parser.add_argument('--max-seconds', type=float,
+                            help='Fail if an engine takes longer than this to run '
+                                 'through a set of inputs')
+    run_parser.add_argument('--max-memory-mb', type=float,
+                            help='Fail if an engine needs more memory than this')
+
+    # Used by run to run each engine in its own process.
+    engine_parser = subparsers.add_parser('engine')
+    engine_parser.add_argument('engine_name')
+    engine_parser.add_argument('inputs_dir_path')
+    engine_parser.add_argument('run_id')
+    engine_parser.add_argument('work_dir_path')
+    engine_parser.add_argument('output_path')
+    engine_parser.add_argument('--range-rasters')
+    engine_parser.add_argument('--export-mask-store', action='store_true')
+
+    args = arg_parser.parse_args()
+
+    if args.command == 'run':
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file, object_pairs_hook=OrderedDict)
+        results = run_crosscheck(args.inputs_dir_paths,
+                                 args.engines.split(',') if args.engines else None,
+                                 args.reference, baseline, args.abs_tolerance,
+                                 args.rel_tolerance)
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=1)
+        failures = check_crosscheck_results(results, baseline,
+                                            args.regression_tolerance,
+                                            args.max_seconds, args.max_memory_mb)
+        sys.exit(1 if failures else 0)
+    elif args.command == 'engine':
+        engine_results = run_engine(args.engine_name, args.inputs_dir_path,
+                                    args.run_id, args.work_dir_path, args.range_rasters,
+                                    args.export_mask_store)
+        with open(args.output_path, 'w') as output_file:
+            json.dump(engine_results, output_file)
+    else:
+        arg_parser.print_help()
@@ -4,18 +4,25 @@
 
 import csv
 import os
-import random
-import string
 import warnings
 from configparser import ConfigParser
+from functools import partial
+from math import sqrt
 
 import ee
 import collections
 
 from ee.batch import Export
 
-from utilities import SCI_NAME_RASTER_FILENAME_MAPPING_FP, \
-    map_filename_to_sisid_breeding
+from backends import GFC_NATIVE_SCALE, get_backend
+from cost_model import create_features, load_cost_model, predict_cost, \
+    record_prediction, log_task_costs, refit_cost_model
+from progress import check_cancelled, report_progress
+from runs import get_run
+from task_tracking import EXPORT, FAILED_STATES, INGEST, MEMORY, \
+    get_failed_asset_ids, track_task
+from tracing import span
+from utilities import map_filename_to_sisid_breeding, print_w_timestamp
 
 MODULE_PARENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 CONFIG_FILE_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini')
@@ -24,7 +31,19 @@ CONFIG_FILE_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini')
 MAX_ALT = 10000
 
 # TODO: I wonder whether this should go in the config file, really.
+# The scale at which ranges are analysed if their area isn't known. Otherwise, the
+# scale is chosen from SCALES for each range. See _choose_scale.
 SCALE = 600
+SCALES = [GFC_NATIVE_SCALE, 60, 150, 300, 600, 1200, 2400]
+# The estimated relative error of an estimate made at a coarser scale than the GFC
+# data is this factor over the square root of the number of pixels in the range.
+EDGE_ERROR_FACTOR = 4
+# The minimum maxPixels passed to reduceResolution. It's raised for coarse scales,
+# which average more GFC pixels into each pixel.
+REDUCE_RESOLUTION_MAX_PIXELS = 6000
+# Every time an export task runs out of memory or time, it's resubmitted at a scale
+# this many times coarser.
+MEMORY_FAILURE_SCALE_FACTOR = 2
 MAX_PIXELS = 1e13
 BEST_EFFORT = False
 
@@ -35,27 +54,33 @@ GFC_IMG_ASSET_ID = config_parser['DEFAULT']['GFC image GEE asset ID']
 GFC_FINAL_YR = config_parser.getint('DEFAULT', 'Final year covered by GFC dataset')
 DEM_ASSET_ID = config_parser['DEFAULT']['DEM GEE asset ID']
 BUCKET_NAME = config_parser['DEFAULT']['GCS bucket name for results']
+SCALE_ERROR_BUDGET = config_parser['DEFAULT'].getfloat('Analysis scale error budget',
+                                                       0.01)
+# The CRS range maps are rasterised in. The analysis grid is in the same CRS, so that
+# an equal-area raster grid gives an equal-area analysis grid.
+RASTER_CRS = config_parser['DEFAULT'].get('Raster CRS', 'EPSG:4326')
 
 GFC_IMG = None
 DEM = None
 
 RANGE_MAP_IC_GEE_PATH = ''
-RANDOM_DIR_NAME = ''.join(random.choices(string.ascii_lowercase, k=8))
 
 
 class _Species(object):
 
-    def __init__(self, asset_id, min_alt, max_alt):
+    def __init__(self, asset_id, min_alt, max_alt, scale=SCALE):
         """Initialise _Species object with the necessary information: a GEE asset ID
         and a minimum and maximum altitude.
 
         :param asset_id: GEE asset ID of a range map Image.
         :param min_alt: Minimum altitude of the species being analysed.
         :param max_alt: Maximum altitude of the species being analysed.
+        :param scale: The scale in metres at which to compute the area.
         """
         self._asset_id = asset_id
         self._min_alt = min_alt
         self._max_alt = max_alt
+        self._scale = scale
 
     def __call__(self, forest_change_img):
         """This function is mapped over the ImageCollection of GFC Images. It
@@ -70,12 +95,13 @@ class _Species(object):
 
         forest_change_img_clipped = forest_change_img.And(alt_range).And(species)
 
-        area = forest_change_img_clipped.reduceResolution(reducer=ee.Reducer.mean(),
-                                                          maxPixels=6000). \
-            reproject(crs='EPSG:4326', scale=SCALE). \
+        area = forest_change_img_clipped.reduceResolution(
+            reducer=ee.Reducer.mean(),
+            maxPixels=_get_reduce_resolution_max_pixels(self._scale)). \
+            reproject(crs=RASTER_CRS, scale=self._scale). \
             multiply(ee.Image.pixelArea().divide(1000000)). \
             reduceRegion(reducer=ee.Reducer.sum(),
-                         scale=SCALE,
+                         scale=self._scale,
                          maxPixels=MAX_PIXELS,
                          geometry=forest_change_img_clipped.geometry())
 
@@ -89,6 +115,86 @@ class _Species(object):
         return area_img
 
 
+def _choose_scale(range_area_km2, error_budget=SCALE_ERROR_BUDGET):
+    """Choose the scale at which to analyse a range. At scales coarser than the GFC
+    data, the tree cover in pixels along the edge of the range is averaged with the
+    tree cover just outside it, so the relative error is roughly EDGE_ERROR_FACTOR
+    over the square root of the number of pixels in the range. The coarsest scale in
+    SCALES whose estimated error is within the budget is chosen: small ranges are
+    analysed at the resolution of the GFC data and huge ones much more coarsely.
+
+    :param range_area_km2: The area of the range in square kilometres, or None if
+        unknown.
+    :param error_budget: The greatest acceptable relative error.
+    :return: A scale in metres.
+    """
+    if range_area_km2 is None:
+        return SCALE
+
+    max_scale = sqrt(range_area_km2 * 1e6) * error_budget / EDGE_ERROR_FACTOR
+    return max([SCALES[0]] + [scale for scale in SCALES if scale <= max_scale])
+
+
+def _get_reduce_resolution_max_pixels(scale):
+    """Get the maxPixels to pass to reduceResolution when analysing at a scale. It
+    allows for twice as many GFC pixels per output pixel as there are at the equator.
+
+    :param scale: The scale in metres.
+    :return: An integer.
+    """
+    return max(REDUCE_RESOLUTION_MAX_PIXELS,
+               int(2 * (scale / GFC_NATIVE_SCALE) ** 2))
+
+
+def _create_zonal_results_feat_collection(asset_id, gfc_ic, min_alt, max_alt,
+                                          zone_img, scale=SCALE):
+    """Compute the same areas as _Species.__call__, broken down by zone, in a
+    single pass: the Images derived from the GFC Image are stacked into one Image
+    with a band for each result, which is reduced with a grouped reducer.
+
+    :param asset_id: GEE asset ID of the range map being analysed.
+    :param gfc_ic: ImageCollection containing GFC Images, as returned by
+        _create_gfc_ic.
+    :param min_alt: The minimum altitude of the species being analysed.
+    :param max_alt: The maximum altitude of the species being analysed.
+    :param zone_img: An Image whose first band contains integer zone codes, e.g.
+        country codes. Masked pixels are in zone 0.
+    :param scale: The scale in metres at which to compute the areas.
+    :return: A FeatureCollection containing a Feature for each zone within the
+        range, with a "zone" property and the same results properties as the
+        Feature exported by _run.
+    """
+    species = ee.Image(RANGE_MAP_IC_GEE_PATH + '/' + asset_id)
+    alt_range = DEM.gte(min_alt).And(DEM.lte(max_alt)).selfMask()
+
+    result_names = gfc_ic.aggregate_array('forest')
+    no_results = GFC_FINAL_YR - 2000 + 1
+    forest_change_img = gfc_ic.toBands().rename(result_names)
+    forest_change_img_clipped = forest_change_img.And(alt_range).And(species)
+
+    area_img = forest_change_img_clipped.reduceResolution(
+        reducer=ee.Reducer.mean(), maxPixels=_get_reduce_resolution_max_pixels(scale)). \
+        reproject(crs=RASTER_CRS, scale=scale). \
+        multiply(ee.Image.pixelArea().divide(1000000))
+    zone_band = zone_img.select(0).unmask(0).toInt().rename('zone'). \
+        reproject(crs=RASTER_CRS, scale=scale)
+
+    groups = area_img.addBands(zone_band). \
+        reduceRegion(reducer=ee.Reducer.sum().repeat(no_results).group(
+                         groupField=no_results, groupName='zone'),
+                     scale=scale,
+                     maxPixels=MAX_PIXELS,
+                     geometry=forest_change_img_clipped.geometry()).get('groups')
+
+    def create_zone_feat(group):
+        group = ee.Dictionary(group)
+        zone_results_gee_dict = ee.Dictionary.fromLists(result_names,
+                                                        group.get('sum'))
+        return ee.Feature(None, zone_results_gee_dict.set('zone', group.get('zone')))
+
+    return ee.FeatureCollection(ee.List(groups).map(create_zone_feat))
+
+
 def _initialise_gee_img_vars():
     """Initialise global variables whose values are GEE Images."""
     global GFC_IMG, DEM
@@ -135,6 +241,30 @@ def _populate_altitude_lims_dict(altitude_fp):
     return alt_info
 
 
+def create_altitude_lims_dict_from_df(alt_lims_df):
+    """Create a mapping between scientific names to minimum and maximum altitudes
+    from a pandas DataFrame.
+
+    :param alt_lims_df: A pandas DataFrame with columns titled "sci_name", "min_alt"
+        and "max_alt". Missing altitudes may be NaN or "NA".
+    :return: A dictionary with the same structure as the one returned by
+        _populate_altitude_lims_dict.
+    """
+    Altitude = collections.namedtuple('Altitude', 'min max')
+
+    alt_info = {}
+    for species, min_alt, max_alt in alt_lims_df[['sci_name', 'min_alt',
+                                                  'max_alt']].itertuples(index=False):
+        if min_alt == 'NA' or min_alt != min_alt:
+            min_alt = 0
+        if max_alt == 'NA' or max_alt != max_alt:
+            max_alt = MAX_ALT
+
+        alt_info[species] = Altitude(min=float(min_alt), max=float(max_alt))
+
+    return alt_info
+
+
 def _create_gfc_ic(gfc_img, gfc_final_yr, canopy_cover_thresh):
     """Create an ImageCollection of Images derived from the GFC Image.
 
@@ -165,14 +295,17 @@ def _create_gfc_ic(gfc_img, gfc_final_yr, canopy_cover_thresh):
 
 
 def _populate_sci_name_raster_filename_mapping(sci_name_raster_filename_mapping_fp):
-    """Populate a mapping which maps species' scientific names to raster filenames
-    for the given species.
+    """Populate a mapping which maps species' scientific names to the filenames of
+    the rasters generated for them.
 
     :param sci_name_raster_filename_mapping_fp: A CSV file without column headings
         which associates scientific names with the names of rasters generated for the
-        relevant species.
-    :return: A list of 2-tuples mapping species' scientific names to raster filenames
-        for the given species.
+        relevant species. The third, fourth and fifth columns, if present, contain
+        the number of pixels within each range, the area of its bounding box and the
+        area of the range.
+    :return: A list of 5-tuples mapping species' scientific names to raster
+        filenames, numbers of range pixels, bounding box areas and range areas. The
+        last three are None if the file doesn't contain them.
     """
     #   TODO: I'm not sure this is the best approach. I just need to iterate over the
     #    elements of the range_map_rasters ImageCollection. Instead of taking a path
@@ -184,14 +317,19 @@ def _populate_sci_name_raster_filename_mapping(sci_name_raster_filename_mapping_
     # properties.
     with open(sci_name_raster_filename_mapping_fp, 'r') as snrfmf:
         reader = csv.reader(snrfmf)
-        sci_name_raster_filename_mapping = [(row[0], row[1]) for row in reader]
+        sci_name_raster_filename_mapping = [
+            (row[0], row[1], int(row[2]), float(row[3]),
+             float(row[4]) if len(row) >= 5 else None) if len(row) >= 4
+            else (row[0], row[1], None, None, None)
+            for row in reader]
 
         return sci_name_raster_filename_mapping
 
 
 # TODO: I think it might be better for everything from min_alt to breeding to be made
 #  Image properties.
-def _run(asset_id, gfc_ic, min_alt, max_alt, sci_name, sisid, breeding, aoo_thresh):
+def _run(asset_id, gfc_ic, min_alt, max_alt, sci_name, sisid, breeding, aoo_thresh,
+         zone_img=None, scale=SCALE):
     """Ask GEE to compute the tree cover loss estimates.
 
     :param asset_id: GEE asset ID of the range map being analysed.
@@ -206,35 +344,47 @@ def _run(asset_id, gfc_ic, min_alt, max_alt, sci_name, sisid, breeding, aoo_thre
     :param aoo_thresh: 2km by 2km grid cells containing a proportion of
         tree cover greater than aoo_canopy_cover_thresh are counted as forested cells
         for the purpose of AOO estimation.
-    :return:
+    :param zone_img: An optional Image of integer zone codes. If given, the
+        estimates are broken down by zone: a Feature is exported for each zone
+        within the range.
+    :param scale: The scale in metres at which to carry out the analysis.
+    :return: The ID of the export task.
     """
-    species = _Species(asset_id, min_alt, max_alt)
-    gfc_ic_with_areas = gfc_ic.map(species)
-
-    result_names_gee_list = gfc_ic_with_areas.aggregate_array('forest')
-    result_values_gee_list = gfc_ic_with_areas.aggregate_array('area')
-    results_gee_dict = ee.Dictionary.fromLists(result_names_gee_list,
-                                               result_values_gee_list)
-
-    # aoo_dict = estimate_aoo(asset_id, min_alt, max_alt, aoo_thresh)
-    # results_gee_dict = results_gee_dict.combine(aoo_dict)
+    if zone_img is not None:
+        results_feat_collection = _create_zonal_results_feat_collection(
+            asset_id, gfc_ic, min_alt, max_alt, zone_img, scale). \
+            map(lambda feat: feat.set('sci_name', sci_name, 'sisid', sisid,
+                                      'breeding', breeding, 'scale', scale))
+    else:
+        species = _Species(asset_id, min_alt, max_alt, scale)
+        gfc_ic_with_areas = gfc_ic.map(species)
+
+        result_names_gee_list = gfc_ic_with_areas.aggregate_array('forest')
+        result_values_gee_list = gfc_ic_with_areas.aggregate_array('area')
+        results_gee_dict = ee.Dictionary.fromLists(result_names_gee_list,
+                                                   result_values_gee_list)
+
+        # aoo_dict = estimate_aoo(asset_id, min_alt, max_alt, aoo_thresh)
+        # results_gee_dict = results_gee_dict.combine(aoo_dict)
+
+        results_gee_dict = results_gee_dict.set('sci_name', sci_name)
+        results_gee_dict = results_gee_dict.set('sisid', sisid)
+        results_gee_dict = results_gee_dict.set('breeding', breeding)
+        results_gee_dict = results_gee_dict.set('scale', scale)
+
+        results_feat = ee.Feature(None, results_gee_dict)
+        results_feat_collection = ee.FeatureCollection([results_feat])
 
-    results_gee_dict = results_gee_dict.set('sci_name', sci_name)
-    results_gee_dict = results_gee_dict.set('sisid', sisid)
-    results_gee_dict = results_gee_dict.set('breeding', breeding)
-
-    results_feat = ee.Feature(None, results_gee_dict)
-    results_feat_collection = ee.FeatureCollection([results_feat])
-
-    # FIXME: Again, this is a problem if two users want to use the application
-    #  concurrently.
     export_task = Export.table.toCloudStorage(results_feat_collection,
-                                              description=asset_id,
+                                              description=get_run().
+                                              get_task_description(asset_id),
                                               bucket=BUCKET_NAME,
-                                              fileNamePrefix=RANDOM_DIR_NAME + '/' +
-                                              asset_id)
+                                              fileNamePrefix=get_run().bucket_prefix +
+                                              '/' + asset_id)
     export_task.start()
 
+    return export_task.id
+
 
 # NOTE: This function is unused but has been left in the code in case someone else
 # would like to have a go at getting AOO estimation working in GEE.
@@ -268,7 +418,7 @@ def _estimate_aoo(asset_id, min_alt, max_alt, aoo_thresh):
 
 
 def analyse(alt_lims_table_path, range_map_ic_gee_path, global_canopy_cover_thresh=0.5,
-            aoo_thresh=0.2):
+            aoo_thresh=0.2, zones=None, resume=False):
     """Create and start export tasks to get tree cover loss estimates for each
         species in the the scientific name, raster filename mapping file.
 
@@ -282,23 +432,77 @@ def analyse(alt_lims_table_path, range_map_ic_gee_path, global_canopy_cover_thre
     :param aoo_thresh: 2km by 2km grid cells containing a proportion of
         tree cover greater than aoo_canopy_cover_thresh are counted as forested cells
         for the purpose of AOO estimation.
+    :param zones: Optional GEE asset ID of an Image of integer zone codes, e.g.
+        country codes, or, if GEE is being emulated, a path to a local raster of zone
+        codes. If given, the estimates are broken down by zone.
+    :param resume: Whether to carry on from where an earlier attempt at the current
+        run stopped. If so, ranges for which the run already has an export task which
+        hasn't failed aren't submitted again; the existing tasks are tracked instead.
     """
-    _initialise_gee_img_vars()
+    alt_lims_dict = _populate_altitude_lims_dict(alt_lims_table_path)
 
-    global RANGE_MAP_IC_GEE_PATH
-    RANGE_MAP_IC_GEE_PATH = range_map_ic_gee_path
+    sci_name_raster_filename_mapping = _populate_sci_name_raster_filename_mapping(
+        get_run().sci_name_raster_filename_mapping_fp)
 
-    alt_lims_dict = _populate_altitude_lims_dict(alt_lims_table_path)
+    analyse_ranges(alt_lims_dict, range_map_ic_gee_path,
+                   sci_name_raster_filename_mapping, global_canopy_cover_thresh,
+                   aoo_thresh, zones, resume)
 
-    gfc_ic = _create_gfc_ic(GFC_IMG, GFC_FINAL_YR, global_canopy_cover_thresh)
 
-    sci_name_raster_filename_mapping = _populate_sci_name_raster_filename_mapping(
-        SCI_NAME_RASTER_FILENAME_MAPPING_FP)
+def _get_existing_export_tasks():
+    """Get the current run's export tasks which haven't failed, e.g. those started
+    by an earlier attempt at the run.
 
-    for sci_name, raster_filename in sci_name_raster_filename_mapping:
-        print('Creating export task for %s (%s)...' % (raster_filename,
-                                                       sci_name.lower()), end=' ')
-        asset_id = raster_filename[:-4]
+    :return: A dictionary mapping task descriptions to task IDs. If a range has
+        several tasks, the most recently started one is used.
+    """
+    run = get_run()
+    tasks = sorted(get_backend().list_tasks(),
+                   key=lambda task: task.get('start_time') or 0)
+    return {task['description']: task['id'] for task in tasks
+            if task['state'] not in FAILED_STATES and run.owns_task(task) and
+            task['description'].startswith(run.task_tag)}
+
+
+def analyse_ranges(alt_lims_dict, range_map_ic_gee_path,
+                   sci_name_raster_filename_mapping, global_canopy_cover_thresh=0.5,
+                   aoo_thresh=0.2, zones=None, resume=False):
+    """Create and start export tasks to get tree cover loss estimates for each
+    range map in sci_name_raster_filename_mapping. Unlike analyse, this takes the
+    altitude limits and the mapping in memory. Submission can be cancelled between
+    ranges (see progress.request_cancellation).
+
+    :param alt_lims_dict: A mapping from scientific names to minimum and maximum
+        altitudes, as returned by _populate_altitude_lims_dict.
+    :param range_map_ic_gee_path: GEE path to an ImageCollection containing range map
+        rasters.
+    :param sci_name_raster_filename_mapping: A list of tuples mapping species'
+        scientific names to raster filenames, as returned by
+        _populate_sci_name_raster_filename_mapping. Ranges are analysed in order of
+        decreasing predicted cost, so that the biggest ones don't start last.
+    :param global_canopy_cover_thresh: See analyse.
+    :param aoo_thresh: See analyse.
+    :param zones: See analyse.
+    :param resume: See analyse.
+    """
+    backend = get_backend()
+
+    global RANGE_MAP_IC_GEE_PATH
+    RANGE_MAP_IC_GEE_PATH = range_map_ic_gee_path
+
+    gfc_ic = zone_img = None
+    if not backend.is_local:
+        _initialise_gee_img_vars()
+        gfc_ic = _create_gfc_ic(GFC_IMG, GFC_FINAL_YR, global_canopy_cover_thresh)
+        zone_img = ee.Image(zones) if zones else None
+
+    cost_model_coefficients = load_cost_model()
+    range_jobs = []
+    for mapping_row in sci_name_raster_filename_mapping:
+        sci_name, raster_filename = mapping_row[:2]
+        no_range_pixels, bbox_area_km2 = mapping_row[2:4] if len(mapping_row) >= 4 \
+            else (None, None)
+        range_area_km2 = mapping_row[4] if len(mapping_row) >= 5 else None
         if sci_name in alt_lims_dict:
             min_alt = alt_lims_dict[sci_name].min
             max_alt = alt_lims_dict[sci_name].max
@@ -306,12 +510,110 @@ def analyse(alt_lims_table_path, range_map_ic_gee_path, global_canopy_cover_thre
             min_alt = 0
             max_alt = MAX_ALT
 
+        features = create_features(no_range_pixels, bbox_area_km2, min_alt, max_alt)
+        predicted_s = predict_cost(features, cost_model_coefficients)
+        range_jobs.append((sci_name, raster_filename, min_alt, max_alt, features,
+                           predicted_s, _choose_scale(range_area_km2)))
+
+    # Submit the most expensive ranges first. Ranges whose cost is unknown are
+    # submitted before all the others, in case they're big.
+    range_jobs.sort(key=lambda range_job: float('inf') if range_job[5] is None
+                    else range_job[5], reverse=True)
+
+    failed_ingest_asset_ids = get_failed_asset_ids(INGEST)
+    existing_export_tasks = _get_existing_export_tasks() if resume else {}
+
+    for range_no, (sci_name, raster_filename, min_alt, max_alt, features,
+                   predicted_s, scale) in enumerate(range_jobs):
+        report_progress('analyse', range_no, len(range_jobs), 'ranges')
+        check_cancelled()
+
+        asset_id = raster_filename[:-4]
+        if RANGE_MAP_IC_GEE_PATH + '/' + asset_id in failed_ingest_asset_ids:
+            print('Skipping %s (%s): it wasn\'t ingested.' % (raster_filename,
+                                                              sci_name.lower()))
+            continue
+
+        task_description = get_run().get_task_description(asset_id)
         sisid_breeding_dict = map_filename_to_sisid_breeding(raster_filename)
         sisid = sisid_breeding_dict['sisid']
         breeding = sisid_breeding_dict['breeding']
 
-        _run(asset_id, gfc_ic, min_alt, max_alt, sci_name, sisid, breeding, aoo_thresh)
+        submit = partial(_submit_range_analysis, asset_id, gfc_ic, min_alt, max_alt,
+                         sci_name, sisid, breeding, aoo_thresh, zones, zone_img)
+        if task_description in existing_export_tasks:
+            print('Skipping %s (%s): it has already been submitted.' %
+                  (raster_filename, sci_name.lower()))
+            track_task(EXPORT, RANGE_MAP_IC_GEE_PATH + '/' + asset_id,
+                       existing_export_tasks[task_description],
+                       partial(_resubmit_range_analysis, submit, scale))
+            continue
+
+        print('Creating export task for %s (%s) at a scale of %d m...' %
+              (raster_filename, sci_name.lower(), scale), end=' ')
+        record_prediction(task_description, features, predicted_s)
+
+        with span('analyse.range', sisid=sisid, breeding=breeding,
+                  predicted_s=predicted_s):
+            task_id = submit(scale)
+        track_task(EXPORT, RANGE_MAP_IC_GEE_PATH + '/' + asset_id, task_id,
+                   partial(_resubmit_range_analysis, submit, scale))
         print('Done.')
+    report_progress('analyse', len(range_jobs), len(range_jobs), 'ranges')
+
+
+def _submit_range_analysis(asset_id, gfc_ic, min_alt, max_alt, sci_name, sisid,
+                           breeding, aoo_thresh, zones, zone_img, scale):
+    """Start the export task for a range map with the current backend.
+
+    :param asset_id: See _run.
+    :param gfc_ic: See _run. Unused if the backend is local.
+    :param min_alt: See _run.
+    :param max_alt: See _run.
+    :param sci_name: See _run.
+    :param sisid: See _run.
+    :param breeding: See _run.
+    :param aoo_thresh: See _run.
+    :param zones: See analyse.
+    :param zone_img: An Image created from zones. Unused if the backend is local.
+    :param scale: See _run.
+    :return: The ID of the export task, or None if the backend doesn't have one.
+    """
+    backend = get_backend()
+    if backend.is_local:
+        return backend.run_range_analysis(RANGE_MAP_IC_GEE_PATH + '/' + asset_id,
+                                          min_alt, max_alt, sci_name, sisid,
+                                          breeding, GFC_FINAL_YR, BUCKET_NAME,
+                                          get_run().bucket_prefix + '/' + asset_id,
+                                          get_run().get_task_description(asset_id),
+                                          scale=scale, zone_img_id=zones)
+    return _run(asset_id, gfc_ic, min_alt, max_alt, sci_name, sisid, breeding,
+                aoo_thresh, zone_img, scale)
+
+
+def _resubmit_range_analysis(submit, scale, failure_classes):
+    """Resubmit the export task for a range map after it failed. The more times it
+    has run out of memory or time, the coarser the scale it's resubmitted at.
+
+    :param submit: A function which takes a scale and starts the export task, e.g.
+        a partial application of _submit_range_analysis.
+    :param scale: The scale the task was first submitted at.
+    :param failure_classes: The classes of the task's failures so far, as returned
+        by task_tracking.classify_failure.
+    :return: The ID of the new export task.
+    """
+    scale *= MEMORY_FAILURE_SCALE_FACTOR ** failure_classes.count(MEMORY)
+    print_w_timestamp('Resubmitting the export task for %s at a scale of %d m.' %
+                      (submit.args[0], scale))
+    return submit(scale)
+
+
+def record_task_costs():
+    """Log the predicted and actual durations of the analysis tasks which have
+    finished and refit the cost model which ranges are scheduled with.
+    """
+    if log_task_costs(get_backend().list_tasks()):
+        refit_cost_model()
 
 
 # NOTE: This is just here for testing. This makes it possible to run the analysis
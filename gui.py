@@ -1,11 +1,24 @@
+import queue
+import threading
 import tkinter as tk
+import traceback
+from contextlib import redirect_stdout
 from tkinter import filedialog
 from tkinter.filedialog import askopenfilename
 
+from backends import get_backend
 from main import main
+from progress import ProgressMonitor, RunCancelled, clear_cancellation, \
+    request_cancellation, set_progress_callback
+from runs import Run
 
 FILE_LABELS_WRAPLENGTH = 250
 FILE_LABELS_TEXT_COLOUR = 'gray'
+# How often the window is updated with the output and progress of the run, in
+# milliseconds.
+POLL_INTERVAL_MS = 200
+LOG_WIDTH = 100
+LOG_HEIGHT = 20
 
 gui = tk.Tk()
 
@@ -14,20 +27,139 @@ layer_name = tk.StringVar(gui)
 forest_deps_path = tk.StringVar(gui)
 alt_lims_path = tk.StringVar(gui)
 gls_path = tk.StringVar(gui)
+gl_dists_path = tk.StringVar(gui)
 global_thresh = tk.DoubleVar(gui)
 global_thresh.set(0.5)
 aoo_thresh = tk.DoubleVar(gui)
 aoo_thresh.set(0.2)
+run_id = tk.StringVar(gui)
+status = tk.StringVar(gui)
+status.set('Not started.')
 
+# The run is carried out in a background thread so that the window stays
+# responsive. The thread passes its output and progress to the window through this
+# queue as (kind, text) tuples, as Tk may only be used from the main thread.
+_messages = queue.Queue()
+_worker = None
+_close_when_stopped = False
 
-def call_main_with_args():
-    main(range_map_geodatabase_path=geodatabase_path.get(),
-         layer_name=layer_name.get(),
-         forest_dependency_spreadsheet_path=forest_deps_path.get(),
-         altitude_limits_table_path=alt_lims_path.get(),
-         generation_lengths_table_path=gls_path.get(),
-         global_canopy_cover_thresh=global_thresh.get(),
-         aoo_canopy_cover_thresh=aoo_thresh.get())
+
+class _QueueWriter(object):
+    """A file-like object which passes whatever is written to it to the window."""
+
+    def write(self, text):
+        _messages.put(('log', text))
+
+    def flush(self):
+        pass
+
+
+def _run_main(args, resume):
+    """Carry out a run. This is run in a background thread.
+
+    :param args: A dictionary of keyword arguments to pass to main.
+    :param resume: Whether to resume the run rather than start it.
+    """
+    progress_monitor = ProgressMonitor()
+    set_progress_callback(lambda *progress: _messages.put(
+        ('progress', progress_monitor.update(*progress))))
+    try:
+        with redirect_stdout(_QueueWriter()):
+            main(resume=resume, **args)
+        _messages.put(('finished', 'Finished.'))
+    except RunCancelled:
+        _messages.put(('stopped', 'Cancelled. Press "Resume" to carry on.'))
+    except Exception as e:
+        _messages.put(('log', traceback.format_exc()))
+        _messages.put(('stopped', 'Failed: %s Press "Resume" to carry on.' % e))
+    finally:
+        set_progress_callback(None)
+
+
+def call_main_with_args(resume=False):
+    """Start the run, or resume it, in a background thread.
+
+    :param resume: Whether to resume the last run rather than start a new one.
+    """
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+
+    if not resume:
+        run_id.set(Run().run_id)
+    args = {'range_map_geodatabase_path': geodatabase_path.get(),
+            'layer_name': layer_name.get(),
+            'forest_dependency_spreadsheet_path': forest_deps_path.get(),
+            'altitude_limits_table_path': alt_lims_path.get(),
+            'generation_lengths_table_path': gls_path.get(),
+            'generation_length_distributions_table_path':
+                gl_dists_path.get() or None,
+            'global_canopy_cover_thresh': global_thresh.get(),
+            'aoo_canopy_cover_thresh': aoo_thresh.get(),
+            'run_id': run_id.get()}
+
+    # Logging in can ask for input, which can't be given once the output is shown in
+    # the window, so it's done here, in the main thread, before the run starts.
+    status.set('Logging in. Follow any instructions in the Anaconda Prompt '
+               'window...')
+    gui.update_idletasks()
+    try:
+        get_backend().authenticate()
+    except Exception as e:
+        status.set('Couldn\'t log in to Google Cloud or Earth Engine: %s' % e)
+        return
+
+    clear_cancellation()
+    status.set('Resuming...' if resume else 'Starting...')
+    submit_btn.config(state=tk.DISABLED)
+    resume_btn.config(state=tk.DISABLED)
+    cancel_btn.config(state=tk.NORMAL)
+    _worker = threading.Thread(target=_run_main, args=(args, resume), daemon=True)
+    _worker.start()
+
+
+def cancel_run():
+    """Ask the run to stop at the next range boundary, leaving it resumable."""
+    request_cancellation()
+    cancel_btn.config(state=tk.DISABLED)
+    status.set('Cancelling once the current range or chunk is finished...')
+
+
+def close_window():
+    """Close the window, cancelling the run first if there is one."""
+    global _close_when_stopped
+    if _worker is not None and _worker.is_alive():
+        _close_when_stopped = True
+        cancel_run()
+    else:
+        gui.destroy()
+
+
+def _poll_messages():
+    """Show the output and progress of the run in the window."""
+    while True:
+        try:
+            kind, text = _messages.get_nowait()
+        except queue.Empty:
+            break
+
+        if kind == 'log':
+            log_txt.config(state=tk.NORMAL)
+            log_txt.insert(tk.END, text)
+            log_txt.see(tk.END)
+            log_txt.config(state=tk.DISABLED)
+        elif kind == 'progress':
+            status.set(text)
+        else:
+            status.set(text)
+            submit_btn.config(state=tk.NORMAL)
+            cancel_btn.config(state=tk.DISABLED)
+            resume_btn.config(state=tk.NORMAL if kind == 'stopped' else tk.DISABLED)
+
+    if _close_when_stopped and not _worker.is_alive():
+        gui.destroy()
+        return
+    gui.after(POLL_INTERVAL_MS, _poll_messages)
 
 
 geodatabase_btn = tk.Button(master=gui,
@@ -68,6 +200,15 @@ gls_labl = tk.Label(master=gui,
                     wraplength=FILE_LABELS_WRAPLENGTH,
                     fg=FILE_LABELS_TEXT_COLOUR)
 
+gl_dists_btn = tk.Button(master=gui,
+                         text='Select generation length distributions table '
+                              '(optional)',
+                         command=lambda: gl_dists_path.set(askopenfilename()))
+gl_dists_labl = tk.Label(master=gui,
+                         textvariable=gl_dists_path,
+                         wraplength=FILE_LABELS_WRAPLENGTH,
+                         fg=FILE_LABELS_TEXT_COLOUR)
+
 global_thresh_labl = tk.Label(master=gui,
                               text='Enter global canopy cover threshold')
 global_thresh_entr = tk.Entry(master=gui,
@@ -83,6 +224,33 @@ submit_btn = tk.Button(master=gui,
                        command=call_main_with_args,
                        fg='green')
 
+cancel_btn = tk.Button(master=gui,
+                       text='Cancel',
+                       command=cancel_run,
+                       fg='red',
+                       state=tk.DISABLED)
+
+resume_btn = tk.Button(master=gui,
+                       text='Resume',
+                       command=lambda: call_main_with_args(resume=True),
+                       state=tk.DISABLED)
+
+run_id_labl = tk.Label(master=gui,
+                       textvariable=run_id,
+                       fg=FILE_LABELS_TEXT_COLOUR)
+
+status_labl = tk.Label(master=gui,
+                       textvariable=status,
+                       wraplength=FILE_LABELS_WRAPLENGTH)
+
+log_txt = tk.Text(master=gui,
+                  width=LOG_WIDTH,
+                  height=LOG_HEIGHT,
+                  state=tk.DISABLED)
+log_scrollbar = tk.Scrollbar(master=gui,
+                             command=log_txt.yview)
+log_txt.config(yscrollcommand=log_scrollbar.set)
+
 
 # Add widgets to the GUI.
 row_no = 1
@@ -106,6 +274,10 @@ gls_btn.grid(row=row_no, column=1, sticky='ew')
 row_no += 1
 gls_labl.grid(row=row_no, column=1)
 row_no += 1
+gl_dists_btn.grid(row=row_no, column=1, sticky='ew')
+row_no += 1
+gl_dists_labl.grid(row=row_no, column=1)
+row_no += 1
 global_thresh_labl.grid(row=row_no, column=1)
 row_no += 1
 global_thresh_entr.grid(row=row_no, column=1, sticky='ew')
@@ -115,8 +287,21 @@ row_no += 1
 aoo_thresh_entr.grid(row=row_no, column=1, sticky='ew')
 row_no += 1
 submit_btn.grid(row=row_no, column=1, sticky='ew')
+row_no += 1
+cancel_btn.grid(row=row_no, column=1, sticky='ew')
+row_no += 1
+resume_btn.grid(row=row_no, column=1, sticky='ew')
+row_no += 1
+run_id_labl.grid(row=row_no, column=1)
+row_no += 1
+status_labl.grid(row=row_no, column=1)
+# The log is shown to the right of everything else.
+log_txt.grid(row=1, column=2, rowspan=row_no, sticky='ns')
+log_scrollbar.grid(row=1, column=3, rowspan=row_no, sticky='ns')
 
 gui.title('GFC Habitat Loss Estimator')
 gui.resizable(False, False)
+gui.protocol('WM_DELETE_WINDOW', close_window)
 
+gui.after(POLL_INTERVAL_MS, _poll_messages)
 gui.mainloop()
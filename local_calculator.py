@@ -0,0 +1,338 @@
+# Local equivalent of the GEE range analysis in gfc_calculator, used by the local
+# emulator backend.
+
+import os
+from configparser import ConfigParser
+from math import ceil, floor, radians
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window, from_bounds
+
+from tile_cache import get_source_key, get_tile_cache
+
+MODULE_PARENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+CONFIG_FILE_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini')
+
+config_parser = ConfigParser()
+config_parser.read(CONFIG_FILE_PATH)
+
+LOCAL_TREECOVER2000_PATH = config_parser['DEFAULT'].get(
+    'Local GFC treecover2000 path', '')
+LOCAL_LOSSYEAR_PATH = config_parser['DEFAULT'].get('Local GFC lossyear path', '')
+LOCAL_DEM_PATH = config_parser['DEFAULT'].get('Local DEM path', '')
+
+# Radius of the authalic sphere in metres.
+EARTH_RADIUS = 6371007.2
+# Range maps are processed in square blocks of this size in degrees so that memory
+# use doesn't depend on the size of the range. The blocks are aligned to a global
+# grid, so that blocks of the GFC data and DEM can be cached and reused for other
+# ranges. See tile_cache.
+BLOCK_SIZE_DEG = 1
+# When no local GFC data are configured, these made-up values are used instead. They
+# make it possible to exercise the pipeline end to end offline, e.g. for
+# benchmarking, but the results are meaningless.
+SYNTHETIC_TREE_COVER_FRACTION = 0.5
+SYNTHETIC_ANNUAL_LOSS_FRACTION = 0.01
+
+
+def _pixel_areas_km2(transform, height, crs=None):
+    """Compute the area of the pixels in each row of a grid in EPSG:4326 or in an
+    equal-area CRS.
+
+    :param transform: The affine transform of the grid.
+    :param height: The number of rows in the grid.
+    :param crs: The CRS of the grid. If it's a projected CRS, it must be equal-area
+        and in metres. If None, EPSG:4326 is assumed.
+    :return: A NumPy array containing the area in square kilometres of a pixel in
+        each row.
+    """
+    if crs is not None and not crs.is_geographic:
+        return np.full(height, abs(transform.a * transform.e) / 1e6)
+
+    row_edges = transform.f + transform.e * np.arange(height + 1)
+    sin_lats = np.sin(np.radians(row_edges))
+    areas_m2 = EARTH_RADIUS ** 2 * radians(abs(transform.a)) * \
+        np.abs(sin_lats[:-1] - sin_lats[1:])
+    return areas_m2 / 1e6
+
+
+def _reproject_onto(source, dst_shape, dst_transform, dst_crs, src_transform=None,
+                    src_crs=None, fill=0):
+    """Resample a raster onto a grid with nearest-neighbour resampling.
+
+    :param source: A rasterio Band or a NumPy array.
+    :param dst_shape: The shape of the destination grid.
+    :param dst_transform: The affine transform of the destination grid.
+    :param dst_crs: The CRS of the destination grid.
+    :param src_transform: The affine transform of source, if it's an array.
+    :param src_crs: The CRS of source, if it's an array.
+    :param fill: The value of destination pixels outside the source.
+    :return: A NumPy array with shape dst_shape.
+    """
+    destination = np.full(dst_shape, fill, dtype=np.float32)
+    reproject(source, destination, src_transform=src_transform, src_crs=src_crs,
+              dst_transform=dst_transform, dst_crs=dst_crs, dst_nodata=fill,
+              resampling=Resampling.nearest)
+    return destination
+
+
+def _read_range_mask(range_raster_path):
+    """Read a range map raster.
+
+    :param range_raster_path: Path to a range map GeoTIFF.
+    :return: A tuple (mask, transform, crs, bounds) in which mask is a NumPy array
+        that is nonzero inside the range.
+    """
+    with rasterio.open(range_raster_path) as range_raster:
+        mask = range_raster.read(1, masked=False)
+        # Range map rasters are generated with the origin at the bottom left, so the
+        # "bottom" and "top" reported by rasterio may be the wrong way round.
+        left, bottom, right, top = range_raster.bounds
+        bounds = (min(left, right), min(bottom, top), max(left, right),
+                  max(bottom, top))
+        return mask, range_raster.transform, range_raster.crs, bounds
+
+
+def _read_zones(zone_src, dst_shape, dst_transform, dst_crs):
+    """Read the zone codes covering a grid. Pixels outside the zone raster or
+    without a zone are in zone 0.
+
+    :param zone_src: An open rasterio dataset of integer zone codes, e.g. country
+        codes.
+    :param dst_shape: The shape of the grid.
+    :param dst_transform: The affine transform of the grid.
+    :param dst_crs: The CRS of the grid.
+    :return: A NumPy array of zone codes with shape dst_shape.
+    """
+    zones = _reproject_onto(rasterio.band(zone_src, 1), dst_shape, dst_transform,
+                            dst_crs, fill=0)
+    return np.nan_to_num(zones).astype(np.int64)
+
+
+def _read_block(key, block_window, window, read_window):
+    """Read the part of a block of a raster within a window, through the tile cache
+    if it's turned on.
+
+    :param key: A tuple identifying the raster and the grid it's read onto. The
+        block's offsets are added to it.
+    :param block_window: The Window of the whole block on the GFC grid.
+    :param window: A Window within block_window.
+    :param read_window: A function which takes a Window on the GFC grid and returns
+        a NumPy array of the raster's values within it.
+    :return: A NumPy array of the values within window.
+    """
+    tile_cache = get_tile_cache()
+    if tile_cache is None:
+        return read_window(window)
+
+    tile = tile_cache.get(key + (int(block_window.col_off), int(block_window.row_off),
+                                 int(block_window.width)),
+                          lambda: read_window(block_window))
+    row_off = int(window.row_off - block_window.row_off)
+    col_off = int(window.col_off - block_window.col_off)
+    return tile[row_off:row_off + int(window.height),
+                col_off:col_off + int(window.width)]
+
+
+def _create_results_dict(remaining, loss, no_years):
+    """Create a dictionary of results in the format returned by
+    compute_range_results.
+
+    :param remaining: The area of tree cover in 2000 in square kilometres.
+    :param loss: A NumPy array whose element i is the area lost in year 2000 + i.
+    :param no_years: The number of years of loss.
+    :return: A dictionary.
+    """
+    results_dict = {'2001_remaining': float(remaining)}
+    for year in range(1, no_years + 1):
+        results_dict['%d_loss' % (2000 + year)] = float(loss[year])
+    return results_dict
+
+
+def _compute_synthetic_results(range_raster_path, gfc_final_yr, zone_path=''):
+    """Generate made-up results for a range map from its area alone.
+
+    :param range_raster_path: Path to a range map GeoTIFF.
+    :param gfc_final_yr: The final year covered by the GFC dataset.
+    :param zone_path: See compute_zonal_range_results.
+    :return: A dictionary in the same format as the one returned by
+        compute_zonal_range_results.
+    """
+    mask, transform, crs, _ = _read_range_mask(range_raster_path)
+    areas = np.broadcast_to(_pixel_areas_km2(transform, mask.shape[0], crs)[:, None],
+                            mask.shape)[mask > 0]
+    if zone_path:
+        with rasterio.open(zone_path) as zone_src:
+            zones = _read_zones(zone_src, mask.shape, transform, crs)[mask > 0]
+    else:
+        zones = np.zeros(len(areas), dtype=np.int64)
+
+    no_years = gfc_final_yr - 2000
+    zone_results_dicts = {}
+    for zone in np.unique(zones):
+        remaining = areas[zones == zone].sum() * SYNTHETIC_TREE_COVER_FRACTION
+        loss = np.full(no_years + 1, remaining * SYNTHETIC_ANNUAL_LOSS_FRACTION)
+        zone_results_dicts[int(zone)] = _create_results_dict(remaining, loss,
+                                                             no_years)
+    return zone_results_dicts
+
+
+def compute_range_results(range_raster_path, min_alt, max_alt, gfc_final_yr,
+                          treecover2000_path=LOCAL_TREECOVER2000_PATH,
+                          lossyear_path=LOCAL_LOSSYEAR_PATH, dem_path=LOCAL_DEM_PATH):
+    """Compute the same estimates as _Species.__call__ in gfc_calculator from local
+    copies of the GFC data and DEM: the area of tree cover within the
+    altitude-clipped range in 2000 and the area lost in each year. As in GEE, a
+    pixel counts as tree cover if its "treecover2000" value is greater than zero.
+
+    If no local GFC data are configured, made-up results are returned instead. See
+    _compute_synthetic_results.
+
+    :param range_raster_path: Path to a range map GeoTIFF.
+    :param min_alt: The minimum altitude of the species.
+    :param max_alt: The maximum altitude of the species.
+    :param gfc_final_yr: The final year covered by the GFC dataset.
+    :param treecover2000_path: See compute_zonal_range_results.
+    :param lossyear_path: See compute_zonal_range_results.
+    :param dem_path: See compute_zonal_range_results.
+    :return: A dictionary mapping "2001_remaining" and "20XY_loss" for each year to
+        areas in square kilometres.
+    """
+    zone_results_dicts = compute_zonal_range_results(range_raster_path, min_alt,
+                                                     max_alt, gfc_final_yr,
+                                                     treecover2000_path,
+                                                     lossyear_path, dem_path)
+    no_years = gfc_final_yr - 2000
+    return zone_results_dicts.get(0, _create_results_dict(0, np.zeros(no_years + 1),
+                                                          no_years))
+
+
+def compute_zonal_range_results(range_raster_path, min_alt, max_alt, gfc_final_yr,
+                                treecover2000_path=LOCAL_TREECOVER2000_PATH,
+                                lossyear_path=LOCAL_LOSSYEAR_PATH,
+                                dem_path=LOCAL_DEM_PATH, zone_path=''):
+    """Compute the estimates returned by compute_range_results separately for each
+    zone (e.g. country) within a range map, in a single pass over the GFC data.
+
+    :param range_raster_path: Path to a range map GeoTIFF.
+    :param min_alt: The minimum altitude of the species.
+    :param max_alt: The maximum altitude of the species.
+    :param gfc_final_yr: The final year covered by the GFC dataset.
+    :param treecover2000_path: Path to a raster (e.g. a VRT of Hansen tiles)
+        containing the "treecover2000" band of the GFC dataset.
+    :param lossyear_path: Path to a raster containing the "lossyear" band of the GFC
+        dataset.
+    :param dem_path: Path to a digital elevation model. If empty, altitude limits
+        are ignored.
+    :param zone_path: Path to a raster of integer zone codes. Pixels outside it or
+        without a zone are in zone 0. If empty, every pixel is in zone 0.
+    :return: A dictionary mapping each zone code which occurs within the range to a
+        dictionary in the same format as the one returned by compute_range_results.
+    """
+    if not (treecover2000_path and lossyear_path):
+        return _compute_synthetic_results(range_raster_path, gfc_final_yr, zone_path)
+
+    mask, mask_transform, mask_crs, mask_bounds = _read_range_mask(range_raster_path)
+
+    no_years = gfc_final_yr - 2000
+    # Maps each zone code to the area of tree cover and an array of annual losses.
+    zone_totals = {}
+
+    with rasterio.open(treecover2000_path) as treecover2000_src, \
+            rasterio.open(lossyear_path) as lossyear_src:
+        dem_src = rasterio.open(dem_path) if dem_path else None
+        zone_src = rasterio.open(zone_path) if zone_path else None
+        try:
+            if mask_crs != treecover2000_src.crs:
+                mask_bounds = transform_bounds(mask_crs, treecover2000_src.crs,
+                                               *mask_bounds)
+            full_window = from_bounds(*mask_bounds,
+                                      transform=treecover2000_src.transform)
+            # Cover every GFC pixel the range overlaps. Rounding the length rather
+            # than the far edge can leave out the last row or column.
+            col_off, row_off = floor(full_window.col_off), floor(full_window.row_off)
+            full_window = Window(
+                col_off, row_off,
+                ceil(full_window.col_off + full_window.width) - col_off,
+                ceil(full_window.row_off + full_window.height) - row_off)
+            block_size = int(round(BLOCK_SIZE_DEG /
+                                   abs(treecover2000_src.transform.a)))
+            gfc_grid_key = (treecover2000_src.crs.to_string(),
+                            tuple(treecover2000_src.transform)[:6])
+            treecover2000_key = ('treecover2000',) + \
+                get_source_key(treecover2000_path)
+            lossyear_key = ('lossyear',) + get_source_key(lossyear_path)
+            if dem_src is not None:
+                dem_key = ('dem',) + get_source_key(dem_path) + gfc_grid_key
+
+            for row_off in range(int(full_window.row_off) // block_size * block_size,
+                                 int(full_window.row_off + full_window.height),
+                                 block_size):
+                for col_off in range(int(full_window.col_off) // block_size *
+                                     block_size,
+                                     int(full_window.col_off + full_window.width),
+                                     block_size):
+                    block_window = Window(col_off, row_off, block_size, block_size)
+                    window = block_window.intersection(full_window)
+                    block_shape = (int(window.height), int(window.width))
+                    block_transform = treecover2000_src.window_transform(window)
+
+                    in_range = _reproject_onto(mask, block_shape, block_transform,
+                                               treecover2000_src.crs,
+                                               mask_transform, mask_crs) > 0
+                    if not in_range.any():
+                        continue
+
+                    treecover2000 = _read_block(
+                        treecover2000_key, block_window, window,
+                        lambda read_window: treecover2000_src.read(
+                            1, window=read_window, boundless=True, fill_value=0))
+                    valid = in_range & (treecover2000 > 0)
+
+                    if dem_src is not None:
+                        alt = _read_block(
+                            dem_key, block_window, window,
+                            lambda read_window: _reproject_onto(
+                                rasterio.band(dem_src, 1),
+                                (int(read_window.height), int(read_window.width)),
+                                treecover2000_src.window_transform(read_window),
+                                treecover2000_src.crs, fill=np.nan))
+                        valid &= (alt >= min_alt) & (alt <= max_alt)
+
+                    areas = np.broadcast_to(
+                        _pixel_areas_km2(block_transform, block_shape[0])[:, None],
+                        block_shape)[valid]
+                    if zone_src is not None:
+                        zones = _read_zones(zone_src, block_shape, block_transform,
+                                            treecover2000_src.crs)[valid]
+                    else:
+                        zones = np.zeros(len(areas), dtype=np.int64)
+
+                    lossyear = _read_block(
+                        lossyear_key, block_window, window,
+                        lambda read_window: lossyear_src.read(
+                            1, window=read_window, boundless=True,
+                            fill_value=0))[valid]
+                    # Ignore loss after the final year of the configured dataset.
+                    in_period = lossyear <= no_years
+
+                    for zone in np.unique(zones):
+                        in_zone = zones == zone
+                        zone_total = zone_totals.setdefault(
+                            int(zone), [0.0, np.zeros(no_years + 1)])
+                        zone_total[0] += float(areas[in_zone].sum())
+                        in_zone &= in_period
+                        zone_total[1] += np.bincount(lossyear[in_zone],
+                                                     weights=areas[in_zone],
+                                                     minlength=no_years + 1)
+        finally:
+            if dem_src is not None:
+                dem_src.close()
+            if zone_src is not None:
+                zone_src.close()
+
+    return {zone: _create_results_dict(remaining, loss, no_years)
+            for zone, (remaining, loss) in zone_totals.items()}
@@ -1,12 +1,184 @@
+import json
 import os
 
-import ee
-
-from preprocessor import preprocess
-from gfc_calculator import analyse
-from postprocessor import postprocess
+from backends import LocalBackend, DryRunBackend, get_backend, set_backend
+from runs import Run, get_run, parse_shard, set_run
+from progress import RunCancelled, check_cancelled
+from task_tracking import EXPORT, clear_tracked_tasks, wait_for_tracked_tasks, \
+    write_failed_ranges_report
+from tracing import enable_tracing, disable_tracing, print_summary, span
 from utilities import wait_until_all_tasks_complete, print_w_timestamp
 
+# The stages import the modules they need, which take a while to import (GEE,
+# GeoPandas, GDAL, scikit-learn...), only when they're run, so that the
+# command-line interface starts quickly and stages can be run on their own.
+
+DRY_RUN_REPORT_FILE_PATH = 'dry_run_report.json'
+
+
+def validate_run_args(run_id=None, shard=None, resume=False, aoi=None,
+                      range_rasters_path=None, range_raster_manifest_path=None):
+    """Check that the arguments of a run, or of a stage of one, can be used together.
+    See main for the parameters.
+
+    :raises ValueError: If they can't.
+    """
+    if shard and not run_id:
+        raise ValueError('A run ID must be given when a run is sharded, so that every '
+                         'shard is part of the same run.')
+    if resume and not run_id:
+        raise ValueError('The ID of the run to resume must be given.')
+    if range_rasters_path and not range_raster_manifest_path:
+        from mask_store import is_mask_store
+        if not is_mask_store(range_rasters_path):
+            raise ValueError('A manifest must be given with range map rasters.')
+    if range_rasters_path and aoi:
+        raise ValueError('An area of interest can\'t be used with range map rasters.')
+
+
+def start_run(run_id=None, shard=None, emulator_dir_path=None, dry_run=False,
+              trace_file_path=None):
+    """Set the current run and backend and, if Google Earth Engine is used, log in
+    to it and Google Cloud if there aren't credentials already.
+
+    :param run_id: See main.
+    :param shard: See main.
+    :param emulator_dir_path: See main.
+    :param dry_run: See main.
+    :param trace_file_path: See main. Tracing must be disabled with end_run.
+    :return: The Run.
+    """
+    run = Run(run_id, parse_shard(shard) if shard else None)
+    set_run(run)
+    clear_tracked_tasks()
+    print_w_timestamp('Run ID: %s' % run.label)
+
+    if trace_file_path:
+        enable_tracing(trace_file_path)
+
+    if dry_run:
+        set_backend(DryRunBackend())
+    elif emulator_dir_path:
+        set_backend(LocalBackend(emulator_dir_path))
+    else:
+        get_backend().authenticate()
+
+    return run
+
+
+def end_run(trace_file_path=None):
+    """Finish tracing the current run, if it was traced.
+
+    :param trace_file_path: The trace file path passed to start_run.
+    """
+    if trace_file_path:
+        print_w_timestamp('Stages which took the longest:')
+        print_summary()
+        disable_tracing()
+
+
+def run_preprocess_stage(range_map_geodatabase_path=None, layer_name=None,
+                         forest_dependency_spreadsheet_path=None, aoi=None,
+                         clip_to_aoi=False, range_rasters_path=None,
+                         range_raster_manifest_path=None, resume=False,
+                         altitude_limits_table_path=None):
+    """Pre-process the current run's range maps and upload them to GEE. See main for
+    the parameters.
+
+    :return: The GEE path to the ImageCollection the range maps were uploaded to.
+    """
+    with span('preprocess'):
+        if range_rasters_path:
+            from raster_input import preprocess_rasters
+            return preprocess_rasters(range_rasters_path, range_raster_manifest_path,
+                                      resume)
+
+        from preprocessor import preprocess
+        return preprocess(range_map_geodatabase_path, layer_name,
+                          forest_dependency_spreadsheet_path, aoi, clip_to_aoi,
+                          resume, altitude_limits_table_path)
+
+
+def run_analyse_stage(altitude_limits_table_path, global_canopy_cover_thresh,
+                      aoo_canopy_cover_thresh, zone_raster=None,
+                      range_map_ic_gee_path=None, resume=False):
+    """Wait for the current run's range maps to be ingested, start the export tasks
+    which analyse them and wait for those to finish. See main for the parameters.
+
+    :param range_map_ic_gee_path: The GEE path to the ImageCollection the range maps
+        were uploaded to. Defaults to the one saved in the run's working directory
+        when it was pre-processed.
+    """
+    from gfc_calculator import analyse, record_task_costs
+
+    run = get_run()
+    if range_map_ic_gee_path is None:
+        if not os.path.exists(run.range_map_ic_fp):
+            raise ValueError('Run %s hasn\'t been pre-processed.' % run.label)
+        with open(run.range_map_ic_fp) as range_map_ic_file:
+            range_map_ic_gee_path = range_map_ic_file.read().strip()
+
+    with span('wait.preprocess'):
+        print_w_timestamp('Waiting for all GEE tasks to complete...')
+        wait_until_all_tasks_complete()
+        print_w_timestamp('Done.')
+
+    check_cancelled()
+    with span('analyse'):
+        if global_canopy_cover_thresh:
+            if aoo_canopy_cover_thresh:
+                analyse(altitude_limits_table_path,
+                        range_map_ic_gee_path,
+                        global_canopy_cover_thresh,
+                        aoo_canopy_cover_thresh,
+                        zones=zone_raster,
+                        resume=resume)
+            else:
+                analyse(altitude_limits_table_path,
+                        range_map_ic_gee_path,
+                        global_canopy_cover_thresh,
+                        zones=zone_raster,
+                        resume=resume)
+        else:
+            if aoo_canopy_cover_thresh:
+                analyse(altitude_limits_table_path,
+                        range_map_ic_gee_path,
+                        aoo_canopy_cover_thresh,
+                        zones=zone_raster,
+                        resume=resume)
+            else:
+                analyse(altitude_limits_table_path,
+                        range_map_ic_gee_path,
+                        zones=zone_raster,
+                        resume=resume)
+
+    with span('wait.analyse'):
+        print_w_timestamp('Waiting for all GEE tasks to complete...')
+        wait_for_tracked_tasks(EXPORT)
+        print_w_timestamp('Done.')
+
+    no_failed_ranges = write_failed_ranges_report(run.failed_ranges_report_fp)
+    if no_failed_ranges:
+        print_w_timestamp('%d range maps couldn\'t be analysed. See %s.' %
+                          (no_failed_ranges, run.failed_ranges_report_fp))
+
+    if not isinstance(get_backend(), DryRunBackend):
+        record_task_costs()
+
+
+def run_postprocess_stage(generation_lengths_table_path,
+                          generation_length_distributions_table_path=None,
+                          results_store_path=None):
+    """Download the current run's results from the results bucket and post-process
+    them. See main for the parameters.
+    """
+    from postprocessor import postprocess
+
+    with span('postprocess'):
+        postprocess(generation_lengths_table_path,
+                    generation_length_distributions_table_path,
+                    results_store_path)
+
 
 def main(range_map_geodatabase_path,
          layer_name,
@@ -14,7 +186,20 @@ def main(range_map_geodatabase_path,
          global_canopy_cover_thresh,
          aoo_canopy_cover_thresh,
          altitude_limits_table_path,
-         generation_lengths_table_path):
+         generation_lengths_table_path,
+         generation_length_distributions_table_path=None,
+         results_store_path=None,
+         emulator_dir_path=None,
+         dry_run=False,
+         trace_file_path=None,
+         aoi=None,
+         clip_to_aoi=False,
+         zone_raster=None,
+         run_id=None,
+         shard=None,
+         range_rasters_path=None,
+         range_raster_manifest_path=None,
+         resume=False):
     """This function is the core of the application. It performs the pre-processing,
     analysis and post-processing.
 
@@ -34,43 +219,80 @@ def main(range_map_geodatabase_path,
         and maximum altitudes. See README for required format.
     :param generation_lengths_table_path: Path to a CSV file containing species'
         generation lengths. See README for required format.
+    :param generation_length_distributions_table_path: Optional path to a CSV file
+        containing species' generation length distributions. If given, the
+        uncertainty in the three-generation-length estimates is also estimated. See
+        README for required format.
+    :param results_store_path: Optional path to a directory. If given, the results
+        are also written to a Parquet dataset in this directory. See README.
+    :param emulator_dir_path: Optional path to a directory. If given, Google Earth
+        Engine and Google Cloud Storage are emulated locally in this directory
+        instead of being used. See README.
+    :param dry_run: If True, nothing is uploaded to or computed in Google Earth
+        Engine. Instead, a report of what would have been is written to
+        DRY_RUN_REPORT_FILE_PATH.
+    :param trace_file_path: Optional path to a file. If given, the time and resources
+        used by every stage are recorded in this file and a summary of the stages
+        which took the longest is printed at the end. See README.
+    :param aoi: Optional area of interest: a path to a vector file or a bounding box
+        of the form "min_lon,min_lat,max_lon,max_lat". If given, only species with a
+        range map which intersects it are analysed. See README.
+    :param clip_to_aoi: If True, the range maps are clipped to the area of interest,
+        so that the results describe only the part of each range within it.
+    :param zone_raster: Optional GEE asset ID of an Image of integer zone codes, e.g.
+        country codes, or, if emulator_dir_path is given, a path to a local raster.
+        If given, the results are also broken down by zone. See README.
+    :param run_id: Optional run ID, which everything the run creates is named after.
+        If None, one is generated. Every shard of a sharded run must be given the
+        same run ID.
+    :param shard: Optional string of the form "i/N". If given, only the species in
+        shard i of N are analysed, and the results are written to the shard's
+        working directory, to be merged with postprocessor.merge_shards. See README.
+    :param range_rasters_path: Optional path to a directory of range map rasters,
+        to a VRT in which each band is a range map or to a mask store, such as one
+        exported by a previous run (see preprocessor.EXPORT_MASK_STORE). If given,
+        these are analysed instead of the range maps in the geodatabase, which is
+        ignored along with the layer name and the forest dependency spreadsheet. See
+        README.
+    :param range_raster_manifest_path: Path to a CSV file saying which species and
+        season each range map raster is for. Required if range_rasters_path is given,
+        unless it's a mask store.
+    :param resume: Whether to carry on from where an earlier attempt at the run
+        stopped, e.g. because it was cancelled (see progress.request_cancellation) or
+        crashed. The range maps which were pre-processed are skipped, and the export
+        tasks which were submitted and haven't failed are waited for rather than
+        submitted again. Requires run_id.
     :return:
     """
-    # Google Cloud Platform authentication.
-    os.system('gcloud auth login')
-    # Google Earth Engine authentication.
-    ee.Authenticate()
-
-    ee.Initialize()
-
-    range_map_ic_gee_path = preprocess(range_map_geodatabase_path, layer_name,
-                                       forest_dependency_spreadsheet_path)
-
-    print_w_timestamp('Waiting for all GEE tasks to complete...')
-    wait_until_all_tasks_complete()
-    print_w_timestamp('Done.')
-
-    if global_canopy_cover_thresh:
-        if aoo_canopy_cover_thresh:
-            analyse(altitude_limits_table_path,
-                    range_map_ic_gee_path,
-                    global_canopy_cover_thresh,
-                    aoo_canopy_cover_thresh)
-        else:
-            analyse(altitude_limits_table_path,
-                    range_map_ic_gee_path,
-                    global_canopy_cover_thresh)
-    else:
-        if aoo_canopy_cover_thresh:
-            analyse(altitude_limits_table_path,
-                    range_map_ic_gee_path,
-                    aoo_canopy_cover_thresh)
-        else:
-            analyse(altitude_limits_table_path,
-                    range_map_ic_gee_path)
+    validate_run_args(run_id, shard, resume, aoi, range_rasters_path,
+                      range_raster_manifest_path)
+
+    try:
+        start_run(run_id, shard, emulator_dir_path, dry_run, trace_file_path)
+
+        range_map_ic_gee_path = run_preprocess_stage(
+            range_map_geodatabase_path, layer_name, forest_dependency_spreadsheet_path,
+            aoi, clip_to_aoi, range_rasters_path, range_raster_manifest_path, resume,
+            altitude_limits_table_path)
+
+        check_cancelled()
+        run_analyse_stage(altitude_limits_table_path, global_canopy_cover_thresh,
+                          aoo_canopy_cover_thresh, zone_raster, range_map_ic_gee_path,
+                          resume)
 
-    print_w_timestamp('Waiting for all GEE tasks to complete...')
-    wait_until_all_tasks_complete()
-    print_w_timestamp('Done.')
+        if dry_run:
+            dry_run_backend = get_backend()
+            dry_run_backend.write_report(DRY_RUN_REPORT_FILE_PATH)
+            print_w_timestamp('Dry run report:\n%s' %
+                              json.dumps(dry_run_backend.report(), indent=1))
+            return
 
-    postprocess(generation_lengths_table_path)
+        check_cancelled()
+        run_postprocess_stage(generation_lengths_table_path,
+                              generation_length_distributions_table_path,
+                              results_store_path)
+    except RunCancelled:
+        print_w_timestamp('Cancelled. To carry on, resume run %s.' % get_run().run_id)
+        raise
+    finally:
+        end_run(trace_file_path)
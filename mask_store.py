@@ -0,0 +1,251 @@
+# A single-file store of range map masks, which replaces a directory of thousands of
+# small GeoTIFFs named after the ranges' SISIDs and seasons.
+#
+# The file starts with a fixed-size header: MAGIC followed by the offset and length
+# of the index, as little-endian unsigned 64-bit integers. The masks follow, one
+# after another, each bit-packed row by row with np.packbits and aligned to
+# ALIGNMENT bytes. Masks are read by memory-mapping the file, so reading a packed
+# mask doesn't copy it.
+#
+# The index is JSON, in one segment for each time a writer added masks to the store:
+# for each range added, its SISID, season, scientific name, grid size, CRS, affine
+# transform, bounds, number of range pixels and the offset of its mask, and the
+# offset and length of the previous segment. The header points to the last segment.
+# When a store is reopened, the masks added are appended after its last segment, and
+# a new segment listing only those masks and then the header are only written once
+# they have been. So the store stays readable, with the masks it had before, if the
+# writer is never closed, e.g. because the process crashes, and reopening it once
+# per chunk of range maps doesn't leave a copy of the whole index behind each time.
+
+import json
+import os
+import struct
+
+import numpy as np
+from affine import Affine
+
+MAGIC = b'GFCMASK1'
+HEADER_FORMAT = '<8sQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ALIGNMENT = 8
+MASK_STORE_EXTENSION = '.gfcmask'
+
+
+def is_mask_store(path):
+    """Check whether a file is a mask store.
+
+    :param path: Path to a file.
+    :return: True if the file starts with MAGIC.
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as store_file:
+        return store_file.read(len(MAGIC)) == MAGIC
+
+
+def _read_header(store_file):
+    """Read the header of a mask store.
+
+    :param store_file: A mask store opened in binary mode.
+    :return: A tuple (index_offset, index_length) describing the last segment of
+        the index. index_length is 0 if the store has no index yet.
+    """
+    store_file.seek(0)
+    magic, index_offset, index_length = struct.unpack(
+        HEADER_FORMAT, store_file.read(HEADER_SIZE))
+    if magic != MAGIC:
+        raise ValueError('%s isn\'t a mask store.' % store_file.name)
+    return index_offset, index_length
+
+
+def _read_index(store_file):
+    """Read every segment of the index of a mask store.
+
+    :param store_file: A mask store opened in binary mode.
+    :return: A list of the index entries of the ranges, in the order they were
+        added.
+    """
+    segments = []
+    previous_segment = _read_header(store_file)
+    while previous_segment and previous_segment[1]:
+        store_file.seek(previous_segment[0])
+        segment = json.loads(store_file.read(previous_segment[1]).decode())
+        if isinstance(segment, list):
+            # Stores written before the index was split into segments.
+            segment = {'previous': None, 'ranges': segment}
+        segments.append(segment['ranges'])
+        previous_segment = segment['previous']
+    return [range_dict for segment_ranges in reversed(segments)
+            for range_dict in segment_ranges]
+
+
+class MaskStoreWriter(object):
+    """Appends range map masks to a mask store, creating it if it doesn't exist.
+    The masks' segment of the index is only written when the writer is closed.
+    Until then, a store which existed keeps its old index."""
+
+    def __init__(self, path):
+        """Initialise a MaskStoreWriter.
+
+        :param path: Path to the mask store.
+        """
+        self._path = path
+        # The index entries of the masks added by this writer.
+        self._ranges = []
+        if os.path.exists(path):
+            self._file = open(path, 'r+b')
+            index_offset, index_length = _read_header(self._file)
+            self._previous_segment = [index_offset, index_length] if index_length \
+                else None
+            # The masks added next are appended after the old index, which stays
+            # valid until the header is rewritten.
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(path, 'w+b')
+            self._file.write(struct.pack(HEADER_FORMAT, MAGIC, 0, 0))
+            self._previous_segment = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def add(self, sisid, breeding, sci_name, packed_mask, width, transform,
+            no_range_pixels, crs='EPSG:4326'):
+        """Append a range map mask.
+
+        :param sisid: The SISID of the species.
+        :param breeding: 1 for a breeding range and 0 for a non-breeding range.
+        :param sci_name: The scientific name of the species.
+        :param packed_mask: The mask, bit-packed row by row with np.packbits. A
+            NumPy uint8 array with one row per row of the mask.
+        :param width: The width of the mask in pixels.
+        :param transform: The affine transform of the mask.
+        :param no_range_pixels: The number of pixels within the range.
+        :param crs: The CRS of the mask, e.g. "EPSG:4326".
+        """
+        height = packed_mask.shape[0]
+        padding = -self._file.tell() % ALIGNMENT
+        self._file.write(b'\0' * padding)
+        offset = self._file.tell()
+        self._file.write(np.ascontiguousarray(packed_mask, dtype=np.uint8).tobytes())
+
+        transform = Affine(*tuple(transform)[:6])
+        xs = (transform.c, transform.c + transform.a * width)
+        ys = (transform.f, transform.f + transform.e * height)
+        self._ranges.append({'sisid': int(sisid),
+                             'breeding': int(breeding),
+                             'sci_name': sci_name,
+                             'width': int(width),
+                             'height': int(height),
+                             'crs': crs,
+                             'transform': list(transform)[:6],
+                             'bounds': [min(xs), min(ys), max(xs), max(ys)],
+                             'no_range_pixels': int(no_range_pixels),
+                             'offset': offset})
+
+    def close(self):
+        """Write the masks' segment of the index and the header and close the
+        file."""
+        if self._file.closed:
+            return
+        if not self._ranges and self._previous_segment:
+            self._file.close()
+            return
+        index = json.dumps({'previous': self._previous_segment,
+                            'ranges': self._ranges}).encode()
+        index_offset = self._file.tell()
+        self._file.write(index)
+        # The masks and index must be on disk before the header points to them.
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.seek(0)
+        self._file.write(struct.pack(HEADER_FORMAT, MAGIC, index_offset, len(index)))
+        self._file.close()
+
+
+class MaskStore(object):
+    """Reads range map masks from a mask store by memory-mapping it."""
+
+    def __init__(self, path):
+        """Initialise a MaskStore.
+
+        :param path: Path to the mask store.
+        """
+        self.path = path
+        with open(path, 'rb') as store_file:
+            ranges = _read_index(store_file)
+        self._ranges = {(range_dict['sisid'], range_dict['breeding']): range_dict
+                        for range_dict in ranges}
+        self._data = np.memmap(path, dtype=np.uint8, mode='r') if ranges else None
+
+    def keys(self):
+        """Get the keys of the ranges in the store.
+
+        :return: A list of tuples (sisid, breeding), in the order they were added.
+        """
+        return list(self._ranges)
+
+    def get_info(self, sisid, breeding):
+        """Get the index entry of a range.
+
+        :param sisid: The SISID of the species.
+        :param breeding: 1 for a breeding range and 0 for a non-breeding range.
+        :return: A dictionary with the keys "sisid", "breeding", "sci_name", "width",
+            "height", "crs", "transform", "bounds", "no_range_pixels" and
+            "offset".
+        """
+        return self._ranges[(int(sisid), int(breeding))]
+
+    def get_transform(self, sisid, breeding):
+        """Get the affine transform of a range's mask.
+
+        :param sisid: The SISID of the species.
+        :param breeding: 1 for a breeding range and 0 for a non-breeding range.
+        :return: An Affine.
+        """
+        return Affine(*self.get_info(sisid, breeding)['transform'])
+
+    def read_packed(self, sisid, breeding):
+        """Read a range's mask without unpacking or copying it.
+
+        :param sisid: The SISID of the species.
+        :param breeding: 1 for a breeding range and 0 for a non-breeding range.
+        :return: A read-only NumPy uint8 array backed by the file, with one row per
+            row of the mask, as returned by np.packbits(mask, axis=1).
+        """
+        info = self.get_info(sisid, breeding)
+        row_no_bytes = (info['width'] + 7) // 8
+        packed = self._data[info['offset']:
+                            info['offset'] + info['height'] * row_no_bytes]
+        return packed.reshape(info['height'], row_no_bytes)
+
+    def read_mask(self, sisid, breeding):
+        """Read and unpack a range's mask.
+
+        :param sisid: The SISID of the species.
+        :param breeding: 1 for a breeding range and 0 for a non-breeding range.
+        :return: A NumPy uint8 array which is 1 inside the range and 0 outside it.
+        """
+        info = self.get_info(sisid, breeding)
+        return np.unpackbits(self.read_packed(sisid, breeding), axis=1,
+                             count=info['width'])
+
+    def export_geotiff(self, sisid, breeding, file_path):
+        """Write a range's mask to an uncompressed 8-bit GeoTIFF in the format
+        written by _generate_raster in the preprocessor: 255 inside the range and 0
+        outside it.
+
+        :param sisid: The SISID of the species.
+        :param breeding: 1 for a breeding range and 0 for a non-breeding range.
+        :param file_path: Path to write the GeoTIFF to.
+        """
+        import rasterio
+
+        mask = self.read_mask(sisid, breeding)
+        with rasterio.open(file_path, 'w', driver='GTiff', width=mask.shape[1],
+                           height=mask.shape[0], count=1, dtype=rasterio.uint8,
+                           crs=self.get_info(sisid, breeding)['crs'],
+                           transform=self.get_transform(sisid, breeding)) as out:
+            out.write_band(1, mask * np.uint8(255))
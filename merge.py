@@ -0,0 +1,9 @@
+# Kept so that "python merge.py <run ID> ..." still works. It's the same as
+# "python cli.py merge --run-id <run ID> ...".
+import sys
+
+if len(sys.argv) > 1 and not sys.argv[1].startswith('-'):
+    sys.argv[1:2] = ['--run-id', sys.argv[1]]
+sys.argv.insert(1, 'merge')
+
+import cli
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+
+import ee
+
+import preprocessor
+from preprocessor import preprocess_range_maps
+from gfc_calculator import analyse_ranges, create_altitude_lims_dict_from_df, \
+    record_task_costs
+from postprocessor import collect_results
+from backends import get_backend
+from task_tracking import EXPORT, INGEST, clear_tracked_tasks, get_failed_asset_ids, \
+    wait_for_tracked_tasks, write_failed_ranges_report
+from utilities import print_w_timestamp
+
+
+def run_pipeline(range_maps_gdf,
+                 forest_dep_df,
+                 alt_lims_df,
+                 gl_df,
+                 global_canopy_cover_thresh=0.5,
+                 aoo_canopy_cover_thresh=0.2,
+                 work_dir_path=None,
+                 aoi=None,
+                 clip_to_aoi=False,
+                 zones=None):
+    """Run the pre-processing, analysis and post-processing on in-memory inputs and
+    return the results. Unlike main.main, this doesn't authenticate interactively:
+    Earth Engine and Google Cloud credentials must already be available.
+
+    Nothing is written to disk unless work_dir_path is given, except the rasters,
+    which have to be staged in a temporary directory to be uploaded to GEE. If the
+    current run (see runs.set_run) is a shard, only the species in the shard are
+    analysed.
+
+    :param range_maps_gdf: A GeoDataFrame containing range maps to be analysed, with
+        the same columns as the range map geodatabase. See README.
+    :param forest_dep_df: A pandas DataFrame specifying species' forest dependency,
+        with a column titled "SIS ID" or "SISID" and a column titled "Forest
+        dependency".
+    :param alt_lims_df: A pandas DataFrame specifying species' altitude limits, with
+        columns titled "sci_name", "min_alt" and "max_alt".
+    :param gl_df: A pandas DataFrame specifying species' generation lengths, with
+        columns titled "sci_name" and "gl".
+    :param global_canopy_cover_thresh: See main.main.
+    :param aoo_canopy_cover_thresh: See main.main.
+    :param work_dir_path: Optional path to a directory. If given, the rasters, a
+        mask store of the range maps if preprocessor.EXPORT_MASK_STORE is true, the
+        scientific name, raster filename mapping, a simplification report if range
+        maps are simplified, a report of the geometries which were repaired, the
+        results returned by GEE and the combined results are written to it.
+    :param aoi: An optional area of interest: a shapely geometry in EPSG:4326, a
+        path to a vector file or a bounding box of the form
+        "min_lon,min_lat,max_lon,max_lat". If given, only species with a range map
+        which intersects it are analysed.
+    :param clip_to_aoi: Whether to clip the range maps to the area of interest.
+    :param zones: Optional GEE asset ID of an Image of integer zone codes, e.g.
+        country codes, or, if GEE is being emulated, a path to a local raster. If
+        given, the results are also broken down by zone.
+    :return: A pandas DataFrame with the same columns as the results CSV file. If
+        zones is given, a tuple (results_df, zonal_results_df) is returned instead,
+        in which zonal_results_df has the same columns as the zonal results CSV
+        file.
+    """
+    if not get_backend().is_local:
+        ee.Initialize()
+
+    clear_tracked_tasks()
+
+    mask_export_path = simplification_report_path = geometry_report_path = \
+        mapping_fp = None
+    if work_dir_path:
+        os.makedirs(work_dir_path, exist_ok=True)
+        raster_dir_path = os.path.join(work_dir_path, 'rasters')
+        mapping_fp = os.path.join(work_dir_path, 'sci_name_raster_filename_mapping.csv')
+        if os.path.exists(mapping_fp):
+            os.remove(mapping_fp)
+        if preprocessor.EXPORT_MASK_STORE:
+            mask_export_path = os.path.join(work_dir_path, 'range_masks.gfcmask')
+            if os.path.exists(mask_export_path):
+                os.remove(mask_export_path)
+        simplification_report_path = os.path.join(work_dir_path,
+                                                  'simplification_report.csv')
+        if os.path.exists(simplification_report_path):
+            os.remove(simplification_report_path)
+        geometry_report_path = os.path.join(work_dir_path, 'geometry_report.csv')
+        if os.path.exists(geometry_report_path):
+            os.remove(geometry_report_path)
+    else:
+        raster_dir_path = tempfile.mkdtemp()
+
+    alt_lims_dict = create_altitude_lims_dict_from_df(alt_lims_df)
+
+    try:
+        range_map_ic_gee_path, sci_name_raster_filename_mapping = \
+            preprocess_range_maps(range_maps_gdf, forest_dep_df, raster_dir_path,
+                                  keep_rasters=bool(work_dir_path), aoi=aoi,
+                                  clip_to_aoi=clip_to_aoi,
+                                  mask_export_path=mask_export_path,
+                                  simplification_report_path=
+                                  simplification_report_path,
+                                  geometry_report_path=geometry_report_path,
+                                  mapping_fp=mapping_fp,
+                                  alt_lims_dict=alt_lims_dict)
+    finally:
+        if not work_dir_path:
+            shutil.rmtree(raster_dir_path, ignore_errors=True)
+
+    analyse_ranges(alt_lims_dict, range_map_ic_gee_path,
+                   sci_name_raster_filename_mapping, global_canopy_cover_thresh,
+                   aoo_canopy_cover_thresh, zones)
+
+    print_w_timestamp('Waiting for all GEE tasks to complete...')
+    wait_for_tracked_tasks(EXPORT)
+    print_w_timestamp('Done.')
+    record_task_costs()
+
+    no_failed_ranges = len(get_failed_asset_ids(INGEST) | get_failed_asset_ids(EXPORT))
+    if no_failed_ranges:
+        print_w_timestamp('%d range maps couldn\'t be analysed.' % no_failed_ranges)
+        if work_dir_path:
+            write_failed_ranges_report(os.path.join(work_dir_path,
+                                                    'failed_ranges.csv'))
+
+    output_file_paths = [os.path.join(work_dir_path, filename) if work_dir_path
+                         else None
+                         for filename in ('gee_results.csv', 'combined_results.csv',
+                                          'zonal_results.csv')]
+    results_df, zonal_results_df = collect_results(
+        dict(zip(gl_df['sci_name'], gl_df['gl'])), *output_file_paths)
+    if not zones:
+        return results_df
+    return results_df, zonal_results_df
@@ -1,12 +1,39 @@
 import csv
+import io
 import os
 from configparser import ConfigParser
+from collections import OrderedDict
 
 import numpy as np
 from sklearn.linear_model import LinearRegression
 
+from backends import get_backend
+from runs import Run, get_run, parse_shard_name, set_run
+from tracing import span
+from utilities import print_w_timestamp
+
 MODULE_PARENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 RESULTS_FILE_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'combined_results.csv')
+UNCERTAINTY_RESULTS_FILE_PATH = os.path.join(MODULE_PARENT_DIR_PATH,
+                                             '3gl_uncertainty_results.csv')
+ZONAL_RESULTS_FILE_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'zonal_results.csv')
+RESULTS_STORE_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'results-store')
+WIDE_RESULTS_DATASET_NAME = 'wide'
+LONG_RESULTS_DATASET_NAME = 'long'
+ZONAL_RESULTS_DATASET_NAME = 'zonal'
+ZONAL_RESULTS_FIELDS = ['sisid', 'sci_name', 'breeding', 'zone', 'year', 'loss',
+                        'remaining']
+RESULTS_STORE_PARTITION_COLS = ['run_id', 'gfc_version']
+RESULTS_STORE_COMPRESSION = 'zstd'
+
+NO_GL_SAMPLES = 1000
+GL_PERCENTILES = (2.5, 25, 50, 75, 97.5)
+# Generation lengths sampled from a normal distribution are clipped to this minimum
+# (in years) so that no sample is zero or negative.
+MIN_GL = 0.1
+# The maximum number of (range, sample) pairs held in memory at once during the
+# uncertainty analysis. Ranges are processed in blocks small enough to respect this.
+MAX_ELEMENTS_PER_BLOCK = 10000000
 
 
 def _populate_gl_dict(gl_fp):
@@ -76,62 +103,551 @@ def _estimate_3gl_tc_area_loss(sci_name, remaining, gl_dict, gfc_final_yr):
     return start, finish, loss, percentage_loss
 
 
-def _postprocess_results_set_write_to_file(results_dict, gl_table_path, fields,
-                                           gfc_final_yr):
+def _populate_gl_distributions_dict(gl_dists_fp):
+    """Read the generation length distributions table and return a mapping from
+    species to generation length distributions.
+
+    :param gl_dists_fp: Path to a CSV file containing species' generation length
+        distributions. See README for required format.
+    :return: A dictionary mapping species to 2-tuples (distribution, parameters) in
+        which distribution is one of "uniform", "triangular" and "normal" and
+        parameters is a tuple of floats.
+    """
+    no_params = {'uniform': 2, 'triangular': 3, 'normal': 2}
+
+    gl_dists_dict = {}
+    with open(gl_dists_fp, newline='') as gl_dists_file:
+        for row in csv.reader(gl_dists_file):
+            sci_name = row[0]
+            distribution = row[1].strip().lower()
+            if distribution not in no_params:
+                raise ValueError('Unknown generation length distribution "%s" for '
+                                 'species %s.' % (row[1], sci_name))
+            params = tuple(float(param) for param in
+                           row[2:2 + no_params[distribution]])
+            gl_dists_dict[sci_name] = (distribution, params)
+
+    return gl_dists_dict
+
+
+def _sample_gls(distributions, params, no_samples, rng):
+    """Draw generation length samples for a block of ranges. Sampling is vectorised
+    over every range which shares a distribution.
+
+    :param distributions: A NumPy array of distribution names, one per range. The
+        name "point" denotes a point estimate.
+    :param params: A NumPy array with one row per range and three columns. Unused
+        parameters are NaN.
+    :param no_samples: The number of samples to draw for each range.
+    :param rng: A NumPy random Generator.
+    :return: A NumPy array of generation lengths with one row per range and
+        no_samples columns.
+    """
+    gls = np.empty((len(distributions), no_samples))
+
+    mask = distributions == 'point'
+    gls[mask] = params[mask, 0:1]
+
+    mask = distributions == 'uniform'
+    gls[mask] = rng.uniform(params[mask, 0:1], params[mask, 1:2],
+                            size=(mask.sum(), no_samples))
+
+    mask = distributions == 'triangular'
+    gls[mask] = rng.triangular(params[mask, 0:1], params[mask, 1:2],
+                               params[mask, 2:3], size=(mask.sum(), no_samples))
+
+    mask = distributions == 'normal'
+    gls[mask] = np.maximum(rng.normal(params[mask, 0:1], params[mask, 1:2],
+                                      size=(mask.sum(), no_samples)), MIN_GL)
+
+    return gls
+
+
+def _estimate_3gl_tc_area_loss_vectorised(remaining, gls, gfc_final_yr):
+    """A vectorised equivalent of _estimate_3gl_tc_area_loss which evaluates many
+    generation lengths for many range maps at once.
+
+    :param remaining: A NumPy array with one row per range map and one column per
+        year from 2001 to gfc_final_yr + 1. Each entry is the estimated area of
+        remaining tree cover within the range map in the given year.
+    :param gls: A NumPy array of generation lengths with one row per range map and
+        one column per sample.
+    :param gfc_final_yr: The final year covered by the GFC Image being used.
+    :return: A tuple (loss, percentage_loss) of NumPy arrays with the same shape as
+        gls.
+    """
+    years = np.arange(2001, gfc_final_yr + 2, dtype=float)
+    final_remaining = remaining[:, -1:]
+
+    # Case 2: fit a least squares line to each range's remaining tree cover. The
+    # fit doesn't depend on the generation length, so it's computed once per range.
+    centred_years = years - years.mean()
+    slopes = (remaining @ centred_years) / (centred_years @ centred_years)
+    intercepts = remaining.mean(axis=1) - slopes * years.mean()
+
+    finish = 2001 + 3 * gls
+    case_2_loss = np.minimum(np.maximum(intercepts[:, None] + slopes[:, None] * finish,
+                                        0),
+                             final_remaining)
+    case_2_start_tc_area = np.broadcast_to(remaining[:, :1], gls.shape)
+
+    # Case 1: interpolate the remaining tree cover at the start of the period.
+    start = np.minimum(gfc_final_yr + 1 - 3 * gls, gfc_final_yr + 1 - 10)
+    # Clip the start so that indexing is safe for samples which fall under case 2.
+    start = np.clip(start, 2001, gfc_final_yr + 1)
+    lower_idx = (np.floor(start) - 2001).astype(int)
+    upper_idx = (np.ceil(start) - 2001).astype(int)
+    offset = start - np.floor(start)
+
+    lower_pt = np.take_along_axis(remaining, lower_idx, axis=1)
+    upper_pt = np.take_along_axis(remaining, upper_idx, axis=1)
+
+    case_1_start_tc_area = lower_pt + (upper_pt - lower_pt) * offset
+    case_1_loss = case_1_start_tc_area - final_remaining
+
+    is_case_2 = 3 * gls > gfc_final_yr - 2000
+    loss = np.where(is_case_2, case_2_loss, case_1_loss)
+    start_tc_area = np.where(is_case_2, case_2_start_tc_area, case_1_start_tc_area)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage_loss = (loss / start_tc_area) * 100
+
+    return loss, percentage_loss
+
+
+def _postprocess_results_set(results_dict, gl_dict, gfc_final_yr):
     """Derive estimates of remaining tree cover from the loss estimates returned by
-    GEE, use them to compute three-generation-length estimates and write a row
-    containing all the results to the output file.
+    GEE and use them to compute three-generation-length estimates.
 
-    :param results_dict: A dictionary containing the results returned by GEE.
-    :param gl_table_path: Path to a CSV file containing species' generation
-        lengths. See README for required format.
-    :param fields: A list of strings which are used as column headings in the output
-        CSV file.
+    :param results_dict: A dictionary containing the results returned by GEE. The
+        derived results are added to it.
+    :param gl_dict: A dictionary in which each entry maps the scientific name of a
+        species to its average generation length.
     :param gfc_final_yr: The final year covered by the GFC Image being used.
-    :return:
+    :return: results_dict.
     """
-    with open(RESULTS_FILE_PATH, 'a') as combined_results_file:
-        dw = csv.DictWriter(combined_results_file, fieldnames=fields)
+    #   Add estimates of remaining tree cover to loss_dict.
+    remaining_value = float(results_dict['2001_remaining'])
 
-        gl_dict = _populate_gl_dict(gl_table_path)
+    remaining_dict = {2001: remaining_value}
+    results_dict['2000_remaining'] = remaining_value
 
-        #   Add estimates of remaining tree cover to loss_dict.
-        remaining_value = float(results_dict['2001_remaining'])
+    for year in range(2002, gfc_final_yr + 2):
+        loss_key = str(year - 1) + '_loss'
+        remaining_value -= float(results_dict[loss_key])
+        remaining_dict[year] = remaining_value
 
-        remaining_dict = {2001: remaining_value}
-        results_dict['2000_remaining'] = remaining_value
+        remaining_key = str(year - 1) + '_remaining'
+        results_dict[remaining_key] = remaining_value
 
-        for year in range(2002, gfc_final_yr + 2):
-            loss_key = str(year - 1) + '_loss'
-            remaining_value -= float(results_dict[loss_key])
-            remaining_dict[year] = remaining_value
+    sci_name = results_dict['sci_name']
 
-            remaining_key = str(year - 1) + '_remaining'
-            results_dict[remaining_key] = remaining_value
+    start, finish, loss, percent_loss = _estimate_3gl_tc_area_loss(
+        sci_name, remaining_dict, gl_dict, gfc_final_yr)
 
-        sci_name = results_dict['sci_name']
+    # The regression branch of _estimate_3gl_tc_area_loss returns 1x1 arrays.
+    results_dict['3gl_start'] = float(start)
+    results_dict['3gl_finish'] = float(finish)
+    results_dict['3gl_loss'] = float(np.squeeze(loss))
+    results_dict['3gl_percent_loss'] = float(np.squeeze(percent_loss))
+
+    return results_dict
+
+
+def _get_results_fields(gfc_final_yr):
+    """Get the column headings of the results CSV file.
+
+    :param gfc_final_yr: The final year covered by the GFC Image being used.
+    :return: A list of strings.
+    """
+    fields = ['sisid', 'sci_name', 'breeding'] + \
+             ['20%s_loss' % str(n).zfill(2) for n in range(1, gfc_final_yr - 2000 +
+                                                           1)] + \
+             ['20%s_remaining' % str(n).zfill(2) for n in range(0, gfc_final_yr -
+                                                                2000 + 1)] + \
+             ['3gl_start', '3gl_finish', '3gl_loss', '3gl_percent_loss', 'scale']
+
+    return fields
+
+
+def _read_results_from_bucket(bucket_name, prefix):
+    """Read the results files exported by GEE straight from the results bucket into
+    memory, without writing them to disk.
+
+    :param bucket_name: The name of the GCS bucket the results were exported to.
+    :param prefix: The prefix shared by the results files, e.g. a directory name.
+    :return: A list of dictionaries, each containing the results returned by GEE for
+        one range map.
+    """
+    bucket_contents = get_backend().read_from_bucket('gs://%s/%s' % (bucket_name,
+                                                                     prefix))
+
+    # The files are concatenated, so every file's header row appears in the output.
+    reader = csv.reader(io.StringIO(bucket_contents))
+    header = None
+    results_dicts = []
+    for row in reader:
+        if not row:
+            continue
+        if 'system:index' in row:
+            header = row
+            continue
+        results_dicts.append(dict(zip(header, row)))
+
+    return results_dicts
+
+
+def _postprocess_results_dicts(results_dicts, gl_dict, gfc_final_yr):
+    """Post-process the results returned by GEE for a set of range maps.
+
+    :param results_dicts: A list of dictionaries, each containing the results
+        returned by GEE for one range map.
+    :param gl_dict: A dictionary in which each entry maps the scientific name of a
+        species to its average generation length.
+    :param gfc_final_yr: The final year covered by the GFC Image being used.
+    :return: A list of dictionaries, each containing all the results for one range
+        map.
+    """
+    postprocessed_results_dicts = []
+    for results_dict in results_dicts:
+        results_dict.pop('system:index', None)
+        results_dict.pop('.geo', None)
 
-        start, finish, loss, percent_loss = _estimate_3gl_tc_area_loss(
-            sci_name, remaining_dict, gl_dict, gfc_final_yr)
+        postprocessed_results_dicts.append(_postprocess_results_set(results_dict,
+                                                                    gl_dict,
+                                                                    gfc_final_yr))
 
-        results_dict['3gl_start'] = start
-        results_dict['3gl_finish'] = finish
-        results_dict['3gl_loss'] = loss
-        results_dict['3gl_percent_loss'] = percent_loss
+    return postprocessed_results_dicts
 
-        # Write results
-        dw.writerow(results_dict)
 
+def _split_zonal_results_dicts(results_dicts):
+    """Separate the results which were broken down by zone from the others, and
+    add up the zonal results for each range map to give results for the whole range.
 
-def postprocess(gl_table_path):
+    :param results_dicts: A list of dictionaries, each containing results returned by
+        GEE. Those broken down by zone contain one zone of one range map and have a
+        "zone" key.
+    :return: A tuple (results_dicts, zonal_results_dicts). results_dicts contains one
+        dictionary for each range map, in the format returned by GEE when the results
+        aren't broken down by zone. zonal_results_dicts contains the results which
+        were broken down by zone.
+    """
+    whole_range_results_dicts = []
+    zonal_results_dicts = []
+    combined_results_dicts = OrderedDict()
+    for results_dict in results_dicts:
+        if 'zone' not in results_dict:
+            whole_range_results_dicts.append(results_dict)
+            continue
+        zonal_results_dicts.append(results_dict)
+
+        key = (results_dict['sisid'], results_dict['breeding'])
+        combined_results_dict = combined_results_dicts.get(key)
+        if combined_results_dict is None:
+            combined_results_dicts[key] = {
+                field: value for field, value in results_dict.items()
+                if field not in ('zone', 'system:index', '.geo')}
+            continue
+        for field, value in results_dict.items():
+            if field.endswith('_loss') or field.endswith('_remaining'):
+                combined_results_dict[field] = float(combined_results_dict[field]) + \
+                                               float(value)
+
+    return whole_range_results_dicts + list(combined_results_dicts.values()), \
+        zonal_results_dicts
+
+
+def _create_zonal_results_rows(zonal_results_dicts, gfc_final_yr):
+    """Convert results broken down by zone to long format, with one row per zone
+    per year.
+
+    :param zonal_results_dicts: A list of dictionaries returned by
+        _split_zonal_results_dicts.
+    :param gfc_final_yr: The final year covered by the GFC Image being used.
+    :return: A list of dictionaries whose keys are ZONAL_RESULTS_FIELDS. The loss in
+        2000 is None.
+    """
+    zonal_results_rows = []
+    for zonal_results_dict in zonal_results_dicts:
+        id_dict = {'sisid': zonal_results_dict['sisid'],
+                   'sci_name': zonal_results_dict['sci_name'],
+                   'breeding': zonal_results_dict['breeding'],
+                   'zone': int(float(zonal_results_dict['zone']))}
+
+        remaining = float(zonal_results_dict['2001_remaining'])
+        zonal_results_rows.append(dict(id_dict, year=2000, loss=None,
+                                       remaining=remaining))
+        for year in range(2001, gfc_final_yr + 1):
+            loss = float(zonal_results_dict['%d_loss' % year])
+            remaining -= loss
+            zonal_results_rows.append(dict(id_dict, year=year, loss=loss,
+                                           remaining=remaining))
+
+    return zonal_results_rows
+
+
+def _create_zonal_results_df(zonal_results_rows, run_id, gfc_version):
+    """Create a typed DataFrame from results broken down by zone.
+
+    :param zonal_results_rows: A list of dictionaries returned by
+        _create_zonal_results_rows.
+    :param run_id: An identifier for the run which produced the results.
+    :param gfc_version: An identifier for the version of the GFC dataset used.
+    :return: A DataFrame with the columns ZONAL_RESULTS_FIELDS.
+    """
+    import pandas as pd
+
+    zonal_df = pd.DataFrame.from_records(zonal_results_rows,
+                                         columns=ZONAL_RESULTS_FIELDS)
+    zonal_df['sisid'] = pd.to_numeric(zonal_df['sisid']).astype('int64')
+    zonal_df['sci_name'] = zonal_df['sci_name'].astype('string')
+    zonal_df['breeding'] = pd.to_numeric(zonal_df['breeding']).astype('int8')
+    zonal_df['zone'] = zonal_df['zone'].astype('int64')
+    zonal_df['year'] = zonal_df['year'].astype('int16')
+    zonal_df[['loss', 'remaining']] = zonal_df[['loss', 'remaining']].astype('float64')
+
+    zonal_df['run_id'] = run_id
+    zonal_df['gfc_version'] = gfc_version
+
+    return zonal_df
+
+
+def _write_results_csv(results_dicts, fields, results_file_path=RESULTS_FILE_PATH):
+    """Write post-processed results to a CSV file.
+
+    :param results_dicts: A list of dictionaries, each containing the results for
+        one range map.
+    :param fields: A list of strings which are used as column headings in the output
+        CSV file.
+    :param results_file_path: Path to write the results to.
+    """
+    with open(results_file_path, 'w', newline='') as combined_results_file:
+        dw = csv.DictWriter(combined_results_file, fieldnames=fields)
+        dw.writeheader()
+        dw.writerows(results_dicts)
+
+
+def _create_results_dfs(results_dicts, fields, gfc_final_yr, run_id, gfc_version):
+    """Create typed wide- and long-format DataFrames from post-processed results.
+
+    :param results_dicts: A list of dictionaries, each containing the results for
+        one range map.
+    :param fields: A list of strings naming the columns of the wide-format results.
+    :param gfc_final_yr: The final year covered by the GFC Image being used.
+    :param run_id: An identifier for the run which produced the results.
+    :param gfc_version: An identifier for the version of the GFC dataset used.
+    :return: A tuple (wide_df, long_df). wide_df has the same columns as the results
+        CSV file. long_df has one row per range map per year and the columns "sisid",
+        "sci_name", "breeding", "year", "loss" and "remaining".
+    """
+    import pandas as pd
+
+    wide_df = pd.DataFrame.from_records(results_dicts, columns=fields)
+    float_cols = fields[3:]
+    wide_df[float_cols] = wide_df[float_cols].apply(pd.to_numeric).astype('float64')
+    wide_df['sisid'] = pd.to_numeric(wide_df['sisid']).astype('int64')
+    wide_df['breeding'] = pd.to_numeric(wide_df['breeding']).astype('int8')
+    wide_df['sci_name'] = wide_df['sci_name'].astype('string')
+
+    years = range(2000, gfc_final_yr + 1)
+    id_cols = ['sisid', 'sci_name', 'breeding']
+    long_dfs = []
+    for year in years:
+        year_df = wide_df[id_cols].copy()
+        year_df['year'] = pd.Series(year, index=year_df.index, dtype='int16')
+        loss_col = '%d_loss' % year
+        year_df['loss'] = wide_df[loss_col] if loss_col in wide_df else float('nan')
+        year_df['remaining'] = wide_df['%d_remaining' % year]
+        long_dfs.append(year_df)
+    long_df = pd.concat(long_dfs, ignore_index=True)
+
+    for df in (wide_df, long_df):
+        df['run_id'] = run_id
+        df['gfc_version'] = gfc_version
+
+    return wide_df, long_df
+
+
+def _get_results_store_partitioning():
+    """Get the partitioning of the results store's datasets. The partition columns
+    are declared as strings, as otherwise pyarrow infers the type of e.g.
+    gfc_version=2019, or of a run ID made up of digits, as an integer when the
+    store is read, and filtering on them fails.
+
+    :return: A pyarrow.dataset.Partitioning.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([(col, pa.string())
+                                      for col in RESULTS_STORE_PARTITION_COLS]),
+                           flavor='hive')
+
+
+def _write_results_store(wide_df, long_df, results_store_path=RESULTS_STORE_PATH,
+                         zonal_df=None):
+    """Write the results to a compressed Parquet dataset partitioned by run and GFC
+    version. The wide-format results go in one dataset and the long-format results
+    in another. Any results already in the store for the same run and GFC version,
+    e.g. from postprocessing the run again, are replaced.
+
+    :param wide_df: A DataFrame returned by _create_results_dfs.
+    :param long_df: A DataFrame returned by _create_results_dfs.
+    :param results_store_path: Path to the directory containing the datasets.
+    :param zonal_df: An optional DataFrame returned by _create_zonal_results_df,
+        which is written to a third dataset.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError:
+        raise ImportError('pyarrow is required to write the results store. Install '
+                          'it with "conda install pyarrow".')
+
+    datasets = [(WIDE_RESULTS_DATASET_NAME, wide_df),
+                (LONG_RESULTS_DATASET_NAME, long_df)]
+    if zonal_df is not None:
+        datasets.append((ZONAL_RESULTS_DATASET_NAME, zonal_df))
+
+    for dataset_name, df in datasets:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        file_format = ds.ParquetFileFormat()
+        ds.write_dataset(table, os.path.join(results_store_path, dataset_name),
+                         format=file_format,
+                         file_options=file_format.make_write_options(
+                             compression=RESULTS_STORE_COMPRESSION),
+                         partitioning=_get_results_store_partitioning(),
+                         basename_template='part-{i}.parquet',
+                         existing_data_behavior='delete_matching')
+
+
+def load_results(results_store_path=RESULTS_STORE_PATH, long_format=False,
+                 run_id=None, gfc_version=None, zonal=False):
+    """Load results from the results store into a pandas DataFrame. Only the
+    partitions matching run_id and gfc_version are read.
+
+    :param results_store_path: Path to a results store written by postprocess.
+    :param long_format: Whether to load the long-format results, with one row per
+        range map per year, rather than the wide-format results.
+    :param run_id: If given, only results from this run are loaded.
+    :param gfc_version: If given, only results computed with this version of the
+        GFC dataset are loaded.
+    :param zonal: Whether to load the results broken down by zone, with one row per
+        zone per range map per year. If True, long_format is ignored.
+    :return: A pandas DataFrame.
+    """
+    import pyarrow.parquet as pq
+
+    if zonal:
+        dataset_name = ZONAL_RESULTS_DATASET_NAME
+    elif long_format:
+        dataset_name = LONG_RESULTS_DATASET_NAME
+    else:
+        dataset_name = WIDE_RESULTS_DATASET_NAME
+
+    filters = []
+    if run_id is not None:
+        filters.append(('run_id', '=', str(run_id)))
+    if gfc_version is not None:
+        filters.append(('gfc_version', '=', str(gfc_version)))
+
+    table = pq.read_table(os.path.join(results_store_path, dataset_name),
+                          filters=filters or None,
+                          partitioning=_get_results_store_partitioning())
+    return table.to_pandas()
+
+
+def export_results_store_to_csv(results_file_path,
+                                results_store_path=RESULTS_STORE_PATH, run_id=None,
+                                gfc_version=None):
+    """Export wide-format results from the results store to a CSV file with the
+    same layout as the one written by postprocess.
+
+    :param results_file_path: Path to write the CSV file to.
+    :param results_store_path: Path to a results store written by postprocess.
+    :param run_id: If given, only results from this run are exported.
+    :param gfc_version: If given, only results computed with this version of the
+        GFC dataset are exported.
+    """
+    results_df = load_results(results_store_path, run_id=run_id,
+                              gfc_version=gfc_version)
+    results_df = results_df.drop(columns=RESULTS_STORE_PARTITION_COLS)
+    results_df.to_csv(results_file_path, index=False)
+
+
+def collect_results(gl_dict, raw_results_file_path=None, results_file_path=None,
+                    zonal_results_file_path=None):
+    """Read the current run's results straight from the results bucket and
+    post-process them in memory, without downloading them to disk.
+
+    :param gl_dict: A dictionary in which each entry maps the scientific name of a
+        species to its average generation length.
+    :param raw_results_file_path: Optional path to write the results returned by GEE
+        to.
+    :param results_file_path: Optional path to write the post-processed results to,
+        in the format of the results CSV file.
+    :param zonal_results_file_path: Optional path to write the results broken down
+        by zone to, if there are any, in the format of the zonal results CSV file.
+    :return: A tuple (results_df, zonal_results_df). results_df has the same columns
+        as the results CSV file and zonal_results_df the same columns as the zonal
+        results CSV file. zonal_results_df is empty unless the ranges were broken
+        down by zone.
+    """
+    config_parser = ConfigParser()
+    config_parser.read(os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini'))
+    bucket_name = config_parser['DEFAULT']['GCS bucket name for results']
+    gfc_final_yr = config_parser.getint('DEFAULT', 'Final year covered by GFC dataset')
+
+    raw_results_dicts = _read_results_from_bucket(bucket_name,
+                                                  get_run().bucket_prefix)
+    if raw_results_file_path and raw_results_dicts:
+        _write_results_csv(raw_results_dicts, list(raw_results_dicts[0]),
+                           raw_results_file_path)
+
+    raw_results_dicts, zonal_results_dicts = _split_zonal_results_dicts(
+        raw_results_dicts)
+    results_dicts = _postprocess_results_dicts(raw_results_dicts, gl_dict,
+                                               gfc_final_yr)
+    zonal_results_rows = _create_zonal_results_rows(zonal_results_dicts,
+                                                    gfc_final_yr)
+
+    fields = _get_results_fields(gfc_final_yr)
+    if results_file_path:
+        _write_results_csv(results_dicts, fields, results_file_path)
+    if zonal_results_file_path and zonal_results_rows:
+        _write_results_csv(zonal_results_rows, ZONAL_RESULTS_FIELDS,
+                           zonal_results_file_path)
+
+    results_df, _ = _create_results_dfs(results_dicts, fields, gfc_final_yr, None,
+                                        str(gfc_final_yr))
+    zonal_results_df = _create_zonal_results_df(zonal_results_rows, None,
+                                                str(gfc_final_yr))
+
+    return results_df.drop(columns=RESULTS_STORE_PARTITION_COLS), \
+        zonal_results_df.drop(columns=RESULTS_STORE_PARTITION_COLS)
+
+
+def postprocess(gl_table_path, gl_dists_table_path=None, results_store_path=None,
+                run_id=None, write_csv=True):
     """Post-process the results for every range map which was analysed: process the
     results files in the storage bucket, derive additional results and write
     everything to an output file.
 
     :param gl_table_path: Path to a CSV file containing species' generation
         lengths. See README for required format.
+    :param gl_dists_table_path: Optional path to a CSV file containing species'
+        generation length distributions. If given, the sensitivity of the
+        three-generation-length estimates to generation length is also estimated.
+        See README for required format.
+    :param results_store_path: Optional path to a directory. If given, the results
+        are also written to a Parquet dataset in this directory. See README.
+    :param run_id: An identifier used to partition the results store. Defaults to
+        the label of the current run.
+    :param write_csv: Whether to write the results CSV file.
     :return:
     """
+    run = get_run()
+
     # NOTE: Here it's being assumed that all the results are already
     #  in the bucket. I doubt there's much to be gained by doing things one by one when
     #  each set of results becomes available, and it would be a lot more complex.
@@ -141,12 +657,14 @@ def postprocess(gl_table_path):
     config_parser = ConfigParser()
     config_parser.read(config_file_path)
     BUCKET_NAME = config_parser['DEFAULT']['GCS bucket name for results']
-    LOCAL_RESULTS_DIR_PATH = 'gee-results'
-
-    # Copy contents of bucket to LOCAL_RESULTS_DIR_PATH.
-    if not os.path.exists(LOCAL_RESULTS_DIR_PATH):
-        os.mkdir(LOCAL_RESULTS_DIR_PATH)
-    os.system('gsutil -m cp gs://%s/** %s' % (BUCKET_NAME, LOCAL_RESULTS_DIR_PATH))
+    LOCAL_RESULTS_DIR_PATH = run.results_dir_path
+
+    # Copy the run's part of the bucket to LOCAL_RESULTS_DIR_PATH.
+    os.makedirs(LOCAL_RESULTS_DIR_PATH, exist_ok=True)
+    with span('postprocess.download'):
+        get_backend().copy_from_bucket('gs://%s/%s' % (BUCKET_NAME,
+                                                       run.bucket_prefix),
+                                       LOCAL_RESULTS_DIR_PATH)
     # Empty bucket.
     # os.system('gsutil rm gs://%s' % BUCKET_NAME)
 
@@ -156,26 +674,265 @@ def postprocess(gl_table_path):
     config_parser.read(config_file_path)
     gfc_final_yr = config_parser.getint('DEFAULT', 'Final year covered by GFC dataset')
 
-    fields = ['sisid', 'sci_name', 'breeding'] + \
-             ['20%s_loss' % str(n).zfill(2) for n in range(1, gfc_final_yr - 2000 +
-                                                           1)] + \
-             ['20%s_remaining' % str(n).zfill(2) for n in range(0, gfc_final_yr -
-                                                                2000 + 1)] + \
-             ['3gl_start', '3gl_finish', '3gl_loss', '3gl_percent_loss']
+    fields = _get_results_fields(gfc_final_yr)
+
+    gl_dict = _populate_gl_dict(gl_table_path)
+    raw_results_dicts = []
+
+    with span('postprocess.derive') as derive_span:
+        for results_filename in results_filenames:
+            results_file_path = os.path.join(LOCAL_RESULTS_DIR_PATH, results_filename)
+            with open(results_file_path, newline='') as results_file:
+                raw_results_dicts += list(csv.DictReader(results_file))
+
+            os.remove(results_file_path)
+
+        raw_results_dicts, zonal_results_dicts = _split_zonal_results_dicts(
+            raw_results_dicts)
+        results_dicts = _postprocess_results_dicts(raw_results_dicts, gl_dict,
+                                                   gfc_final_yr)
+        zonal_results_rows = _create_zonal_results_rows(zonal_results_dicts,
+                                                        gfc_final_yr)
+        derive_span.add(ranges=len(results_dicts))
+
+    results_file_path = run.get_output_file_path(RESULTS_FILE_PATH)
+    if write_csv:
+        with span('postprocess.write_csv'):
+            _write_results_csv(results_dicts, fields, results_file_path)
+            if zonal_results_rows:
+                _write_results_csv(zonal_results_rows, ZONAL_RESULTS_FIELDS,
+                                   run.get_output_file_path(ZONAL_RESULTS_FILE_PATH))
+
+    if results_store_path:
+        if run_id is None:
+            run_id = run.label
+        print_w_timestamp('Writing results store...', end=' ')
+        with span('postprocess.write_store'):
+            wide_df, long_df = _create_results_dfs(results_dicts, fields,
+                                                   gfc_final_yr, run_id,
+                                                   str(gfc_final_yr))
+            zonal_df = _create_zonal_results_df(zonal_results_rows, run_id,
+                                                str(gfc_final_yr)) \
+                if zonal_results_rows else None
+            _write_results_store(wide_df, long_df, results_store_path, zonal_df)
+        print('Done.')
+
+    if gl_dists_table_path:
+        print_w_timestamp('Estimating generation length uncertainty...', end=' ')
+        with span('postprocess.gl_uncertainty'):
+            # The results are passed in directly, as the results file may not have
+            # been written, or may be left over from an earlier run.
+            _estimate_3gl_uncertainty(
+                results_dicts, gl_table_path, gl_dists_table_path,
+                uncertainty_results_file_path=run.get_output_file_path(
+                    UNCERTAINTY_RESULTS_FILE_PATH))
+        print('Done.')
+
+
+def _describe_shard_nos(shard_nos):
+    """Describe a list of shard numbers in a message.
+
+    :param shard_nos: A non-empty list of shard numbers.
+    :return: A string, e.g. "shard 2" or "shards 2, 4".
+    """
+    return '%s %s' % ('shard' if len(shard_nos) == 1 else 'shards',
+                      ', '.join(str(shard_no) for shard_no in shard_nos))
 
-    with open('combined_results.csv', 'w') as combined_results_file:
-        dw = csv.DictWriter(combined_results_file, fieldnames=fields)
-        dw.writeheader()
 
-    for results_filename in results_filenames:
-        results_file_path = os.path.join(LOCAL_RESULTS_DIR_PATH, results_filename)
-        with open(results_file_path, newline='') as results_file:
-            results_reader = csv.DictReader(results_file)
-            for results_dict in results_reader:
-                del results_dict['system:index']
-                del results_dict['.geo']
+def _check_shards(run_id, allow_partial=False):
+    """Check that every shard of a sharded run has exported its results to the
+    results bucket and that none of them still has tasks pending or running. The
+    number of range maps each shard couldn't analyse is reported for the shards
+    whose working directories are on this machine.
+
+    :param run_id: The run ID which every shard was given.
+    :param allow_partial: If True, missing or unfinished shards are reported rather
+        than raising an error.
+    """
+    from status import get_run_status
+
+    config_parser = ConfigParser()
+    config_parser.read(os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini'))
+    bucket_name = config_parser['DEFAULT']['GCS bucket name for results']
+
+    backend = get_backend()
+    shards = set(filter(None, (parse_shard_name(name) for name in
+                               backend.list_bucket_dirs('gs://%s/%s' %
+                                                        (bucket_name, run_id)))))
+    if not shards:
+        raise ValueError('No shards of the run %s were found in the results bucket.'
+                         % run_id)
+    shard_counts = sorted(set(no_shards for _, no_shards in shards))
+    if len(shard_counts) > 1:
+        raise ValueError('The shards of the run %s disagree on the number of shards: '
+                         '%s.' % (run_id, ', '.join(str(no_shards)
+                                                    for no_shards in shard_counts)))
+    no_shards = shard_counts[0]
+
+    tasks = [task for task in backend.list_tasks()
+             if task['state'] == 'RUNNING' or task['state'] == 'PENDING']
+    missing_shard_nos = []
+    unfinished_shard_nos = []
+    for shard_no in range(1, no_shards + 1):
+        shard_run = Run(run_id, (shard_no, no_shards))
+        if (shard_no, no_shards) not in shards:
+            missing_shard_nos.append(shard_no)
+        elif any(shard_run.owns_task(task) for task in tasks):
+            unfinished_shard_nos.append(shard_no)
+        if os.path.isdir(shard_run.work_dir_path):
+            no_failed_ranges = get_run_status(shard_run)['failed_ranges']
+            if no_failed_ranges:
+                print_w_timestamp('%d range maps couldn\'t be analysed in %s. See %s.'
+                                  % (no_failed_ranges, shard_run.shard_name,
+                                     shard_run.failed_ranges_report_fp))
+
+    problems = []
+    if missing_shard_nos:
+        problems.append('no results were found for %s' %
+                        _describe_shard_nos(missing_shard_nos))
+    if unfinished_shard_nos:
+        problems.append('%s still %s tasks pending or running' %
+                        (_describe_shard_nos(unfinished_shard_nos),
+                         'has' if len(unfinished_shard_nos) == 1 else 'have'))
+    if problems:
+        message = 'The run %s has %d shards, but %s.' % (run_id, no_shards,
+                                                          ' and '.join(problems))
+        if not allow_partial:
+            raise ValueError(message + ' Pass allow_partial to merge the shards '
+                                       'which have finished anyway.')
+        print_w_timestamp('Warning: %s Merging the remaining shards anyway.' %
+                          message)
+
+
+def merge_shards(run_id, gl_table_path, gl_dists_table_path=None,
+                 results_store_path=None, allow_partial=False):
+    """Combine the results of every shard of a sharded run into one results file
+    (and results store), as if the run hadn't been sharded. The shards' results are
+    read from the results bucket, so this can be done on any machine once every
+    shard has finished.
+
+    :param run_id: The run ID which every shard was given.
+    :param gl_table_path: See postprocess.
+    :param gl_dists_table_path: See postprocess.
+    :param results_store_path: See postprocess. The results are partitioned by
+        run_id.
+    :param allow_partial: If True, the shards which have finished are merged even if
+        others are missing from the results bucket or still have tasks pending or
+        running. Otherwise, a ValueError naming those shards is raised.
+    """
+    _check_shards(run_id, allow_partial)
+    set_run(Run(run_id))
+    postprocess(gl_table_path, gl_dists_table_path, results_store_path)
+
+
+def estimate_3gl_uncertainty(gl_table_path, gl_dists_table_path,
+                             no_samples=NO_GL_SAMPLES, percentiles=GL_PERCENTILES,
+                             results_file_path=RESULTS_FILE_PATH,
+                             uncertainty_results_file_path=UNCERTAINTY_RESULTS_FILE_PATH,
+                             seed=None):
+    """Estimate how the three-generation-length loss estimates vary when species'
+    generation lengths are uncertain. Generation lengths are sampled from each
+    species' distribution and the three-generation-length loss is evaluated for
+    every sample. This works entirely from the results file written by postprocess,
+    so nothing is recomputed in GEE.
+
+    :param gl_table_path: Path to a CSV file containing species' generation
+        lengths. See README for required format. These point estimates are used for
+        species which don't appear in the generation length distributions table.
+    :param gl_dists_table_path: Path to a CSV file containing species' generation
+        length distributions. See README for required format.
+    :param no_samples: The number of generation lengths to sample for each range map.
+    :param percentiles: The percentiles of the three-generation-length loss and
+        percentage loss to report.
+    :param results_file_path: Path to a results file written by postprocess.
+    :param uncertainty_results_file_path: Path to write the percentiles to.
+    :param seed: Seed for the random number generator. Pass a value to make the
+        results reproducible.
+    """
+    with open(results_file_path, newline='') as results_file:
+        results_dicts = list(csv.DictReader(results_file))
+
+    _estimate_3gl_uncertainty(results_dicts, gl_table_path, gl_dists_table_path,
+                              no_samples, percentiles, uncertainty_results_file_path,
+                              seed)
+
+
+def _estimate_3gl_uncertainty(results_dicts, gl_table_path, gl_dists_table_path,
+                              no_samples=NO_GL_SAMPLES, percentiles=GL_PERCENTILES,
+                              uncertainty_results_file_path=
+                              UNCERTAINTY_RESULTS_FILE_PATH,
+                              seed=None):
+    """Estimate how the three-generation-length loss estimates vary when species'
+    generation lengths are uncertain. See estimate_3gl_uncertainty.
+
+    :param results_dicts: A list of dictionaries, each containing the post-processed
+        results for one range map, as written to the results file.
+    :param gl_table_path: See estimate_3gl_uncertainty.
+    :param gl_dists_table_path: See estimate_3gl_uncertainty.
+    :param no_samples: See estimate_3gl_uncertainty.
+    :param percentiles: See estimate_3gl_uncertainty.
+    :param uncertainty_results_file_path: See estimate_3gl_uncertainty.
+    :param seed: See estimate_3gl_uncertainty.
+    """
+    gl_dict = _populate_gl_dict(gl_table_path)
+    gl_dists_dict = _populate_gl_distributions_dict(gl_dists_table_path)
 
-                _postprocess_results_set_write_to_file(results_dict, gl_table_path,
-                                                       fields, gfc_final_yr)
+    config_parser = ConfigParser()
+    config_parser.read(os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini'))
+    gfc_final_yr = config_parser.getint('DEFAULT', 'Final year covered by GFC dataset')
+
+    # Column n of the remaining array holds the remaining tree cover in year 2001 + n,
+    # which is stored under the heading for year 2000 + n in the results file.
+    remaining_keys = ['20%s_remaining' % str(n).zfill(2) for n in
+                      range(0, gfc_final_yr - 2000 + 1)]
 
-        os.remove(results_file_path)
+    ids = []
+    distributions = []
+    params = []
+    remaining = []
+    for results_dict in results_dicts:
+        sci_name = results_dict['sci_name']
+        if sci_name in gl_dists_dict:
+            distribution, dist_params = gl_dists_dict[sci_name]
+        elif sci_name in gl_dict:
+            distribution, dist_params = 'point', (float(gl_dict[sci_name]),)
+        else:
+            print_w_timestamp('No generation length for %s. Skipping.' % sci_name)
+            continue
+
+        ids.append((results_dict['sisid'], sci_name, results_dict['breeding']))
+        distributions.append(distribution)
+        params.append(dist_params + (np.nan,) * (3 - len(dist_params)))
+        remaining.append([float(results_dict[key]) for key in remaining_keys])
+
+    distributions = np.array(distributions)
+    params = np.array(params, dtype=float).reshape(-1, 3)
+    remaining = np.array(remaining, dtype=float).reshape(-1, len(remaining_keys))
+
+    rng = np.random.default_rng(seed)
+    block_size = max(1, MAX_ELEMENTS_PER_BLOCK // no_samples)
+
+    fields = ['sisid', 'sci_name', 'breeding', 'gl_distribution'] + \
+             ['3gl_loss_p%s' % p for p in percentiles] + \
+             ['3gl_percent_loss_p%s' % p for p in percentiles]
+
+    with open(uncertainty_results_file_path, 'w', newline='') as uncertainty_file:
+        writer = csv.writer(uncertainty_file)
+        writer.writerow(fields)
+
+        for block_start in range(0, len(ids), block_size):
+            block = slice(block_start, block_start + block_size)
+
+            gls = _sample_gls(distributions[block], params[block], no_samples, rng)
+            loss, percentage_loss = _estimate_3gl_tc_area_loss_vectorised(
+                remaining[block], gls, gfc_final_yr)
+
+            loss_percentiles = np.percentile(loss, percentiles, axis=1).T
+            percentage_loss_percentiles = np.percentile(percentage_loss,
+                                                        percentiles, axis=1).T
+
+            for i, (sisid, sci_name, breeding) in enumerate(ids[block]):
+                writer.writerow([sisid, sci_name, breeding,
+                                 distributions[block][i]] +
+                                list(loss_percentiles[i]) +
+                                list(percentage_loss_percentiles[i]))
@@ -1,30 +1,78 @@
 import csv
+import hashlib
 import random
 import shutil
 import string
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from configparser import ConfigParser
 from fractions import Fraction
+from functools import partial
 from math import ceil
 
 import ee
 
-from utilities import map_sisid_breeding_to_filename, \
-    SCI_NAME_RASTER_FILENAME_MAPPING_FP, print_w_timestamp, \
-    wait_until_all_tasks_complete
+from backends import get_backend
+from cost_model import compute_bbox_area_km2, estimate_range_area_km2
+from mask_store import MaskStoreWriter
+from progress import check_cancelled, report_progress
+from runs import get_run
+from task_tracking import INGEST, track_task, wait_for_tracked_tasks
+from tracing import span, add_counters, is_enabled, get_peak_rss_mb, detach_tracing
+from utilities import map_filename_to_sisid_breeding, \
+    map_sisid_breeding_to_filename, print_w_timestamp
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
 from rasterio.features import rasterize
+from rasterio.warp import reproject
 from affine import Affine
+from shapely import wkb
+from shapely.geometry import box
+from shapely.ops import unary_union
+from shapely.validation import explain_validity, make_valid
 from osgeo.gdal import Translate
 import fiona
 
-CHUNK_SIZE = 50
 MODULE_PARENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
-RASTER_DIR_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'rasters')
+# The number of vertices and the bounds of every row of a geodatabase layer are
+# cached here, so that the layer only has to be scanned once.
+LAYER_INDEX_DIR_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'layer-indexes')
+
+# Repaired range map geometries are cached here, named after a hash of the original
+# geometry, so that later runs don't have to repair them again. VALIDATED_FILENAME
+# lists the hash of every geometry which has been validated and, if it was invalid,
+# why.
+GEOMETRY_CACHE_DIR_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'geometry-cache')
+VALIDATED_FILENAME = 'validated.tsv'
+_VALIDATED_GEOMETRIES = None
+
+# Range maps are pre-processed in chunks of whole species. The number of vertices in
+# a chunk is limited so that pre-processing it fits in the memory budget set in the
+# configuration file and takes about TARGET_CHUNK_SECONDS. The limit starts at
+# INITIAL_CHUNK_VERTEX_BUDGET and is adjusted after every chunk.
+INITIAL_CHUNK_VERTEX_BUDGET = 250000
+MIN_CHUNK_VERTEX_BUDGET = 10000
+TARGET_CHUNK_SECONDS = 300
+# The vertex budget can at most double from one chunk to the next.
+MAX_CHUNK_VERTEX_BUDGET_GROWTH = 2
+# A deliberately pessimistic estimate of the memory needed per vertex, used until
+# the memory used by a chunk has been observed, or throughout if the memory used
+# can't be measured (on Windows without psutil).
+INITIAL_MB_PER_VERTEX = 0.005
+_WARNED_ABOUT_MEMORY_USE = False
+# Weight given to the previous estimate of the time taken per vertex.
+SMOOTHING = 0.5
+
+# The number of worker processes range maps are rasterised in.
+NO_RASTERISATION_WORKERS = os.cpu_count() or 1
+_RASTERISATION_POOL = None
 
 CONFIG_FILE_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini')
 CONFIG_PARSER = ConfigParser()
@@ -32,28 +80,52 @@ CONFIG_PARSER.read(CONFIG_FILE_PATH)
 
 PIXEL_WIDTH_STR = CONFIG_PARSER['DEFAULT']['Pixel width']
 PIXEL_HEIGHT_STR = CONFIG_PARSER['DEFAULT']['Pixel height']
+# The CRS range maps are rasterised in. The pixel width and height are in its units,
+# e.g. degrees for EPSG:4326 or metres for an equal-area CRS such as EPSG:6933. A
+# projected CRS must be equal-area.
+RASTER_CRS = CONFIG_PARSER['DEFAULT'].get('Raster CRS', 'EPSG:4326')
+RASTER_CRS_IS_GEOGRAPHIC = CRS.from_user_input(RASTER_CRS).is_geographic
 GCS_BUCKET_NAME = CONFIG_PARSER['DEFAULT']['GCS bucket name for rasters']
 GCS_BUCKET_PATH = 'gs://' + GCS_BUCKET_NAME
-
-
-def _get_gee_home_folder_path():
-    """If the current user already has a GEE home folder, get a path to it. If not,
-    create one and return a path to it.
-
-    :return: A GEE path to the user's home folder.
-    """
-    earth_engine_ls_output = os.popen('earthengine ls').read()
-    if "users" in earth_engine_ls_output:
-        # User already has a home folder. Get a path to it.
-        gee_home_folder_path = earth_engine_ls_output.split('assets/')[1][:-1]
-    else:
-        # User does not already have a home folder. Create one.
-        # Generate a random suffix. (Home folder names must be unique.)
-        random_suffix = ''.join(random.choices(string.digits, k=10))
-        gee_home_folder_path = 'users/forest_loss_tool_user_' + random_suffix
-        ee.data.createAssetHome(gee_home_folder_path)
-
-    return gee_home_folder_path
+PREPROCESSING_MEMORY_BUDGET_MB = CONFIG_PARSER['DEFAULT'].getfloat(
+    'Pre-processing memory budget (MB)', 4000)
+# Range maps can be simplified before they're dissolved, dropping vertices which are
+# much closer together than a pixel is wide. The tolerance is this many pixels. 0
+# turns simplification off.
+SIMPLIFICATION_TOLERANCE_PIXELS = CONFIG_PARSER['DEFAULT'].getfloat(
+    'Simplification tolerance (pixels)', 0)
+# The fraction of species whose ranges are also rasterised without simplification, to
+# count the pixels simplification changed. They're chosen by a hash of their SISIDs.
+SIMPLIFICATION_CHECK_FRACTION = CONFIG_PARSER['DEFAULT'].getfloat(
+    'Simplification check fraction', 0.1)
+SIMPLIFICATION_REPORT_FIELDS = ['sisid', 'breeding', 'no_vertices',
+                                'no_simplified_vertices', 'no_range_pixels',
+                                'no_changed_pixels']
+# Whether to validate every range map geometry, and repair the invalid ones, before
+# any range maps are dissolved.
+VALIDATE_GEOMETRIES = CONFIG_PARSER['DEFAULT'].getboolean('Validate geometries', True)
+GEOMETRY_REPORT_FIELDS = ['sisid', 'seasonal', 'feature_hash', 'problem',
+                          'no_vertices', 'no_repaired_vertices']
+# Whether to remove the parts of each range which are outside the species' altitude
+# limits, according to a local copy of the DEM, before the range is uploaded. GEE
+# still applies the altitude limits, so only pixels which can't be within them are
+# removed: a pixel is kept if any part of it might be within them, give or take
+# ALTITUDE_PRECLIPPING_MARGIN_M, as are its neighbours.
+ALTITUDE_PRECLIPPING = CONFIG_PARSER['DEFAULT'].getboolean(
+    'Pre-clip ranges to altitude limits', False)
+# Whether to also export every range mask to a mask store in the run's working
+# directory, e.g. to analyse the range maps again with --range-rasters. See
+# mask_store.
+EXPORT_MASK_STORE = CONFIG_PARSER['DEFAULT'].getboolean('Export mask store', False)
+ALTITUDE_PRECLIPPING_MARGIN_M = CONFIG_PARSER['DEFAULT'].getfloat(
+    'Altitude pre-clipping margin (m)', 0)
+LOCAL_DEM_PATH = CONFIG_PARSER['DEFAULT'].get('Local DEM path', '')
+# Geometries are split into about this many batches per worker process to be
+# validated or simplified, so that the workers finish at about the same time.
+NO_BATCHES_PER_WORKER = 4
+
+# Columns of the range map GeoDataFrame which are compared against string codes.
+CODE_COLS = ['PRESENCE', 'ORIGIN', 'SEASONAL']
 
 
 def _create_forest_dep_df(forest_dep_spreadsheet_path):
@@ -68,10 +140,22 @@ def _create_forest_dep_df(forest_dep_spreadsheet_path):
     # Construct a DataFrame from the forest dependency spreadsheet.
     forest_dep_df = pd.read_excel(forest_dep_spreadsheet_path)
 
-    # Change the "SISID" column to "SIS ID".
-    forest_dep_df_col_names = list(forest_dep_df.columns.values)
-    forest_dep_df_col_names[forest_dep_df_col_names.index('SIS ID')] = 'SISID'
-    forest_dep_df.columns = forest_dep_df_col_names
+    return _normalise_forest_dep_df(forest_dep_df)
+
+
+def _normalise_forest_dep_df(forest_dep_df):
+    """Rename the "SIS ID" column of a forest dependency DataFrame to "SISID", if
+    necessary.
+
+    :param forest_dep_df: A pandas DataFrame specifying species' forest dependency,
+        with a column titled "SIS ID" or "SISID" and a column titled "Forest
+        dependency".
+    :return: A pandas DataFrame specifying species' forest dependency, with a column
+        titled "SISID" and a column titled "Forest dependency".
+    """
+    # Change the "SIS ID" column to "SISID".
+    if 'SIS ID' in forest_dep_df.columns:
+        forest_dep_df = forest_dep_df.rename(columns={'SIS ID': 'SISID'})
 
     return forest_dep_df
 
@@ -137,6 +221,295 @@ def _dissolve(botw_gdf_w_forest_deps):
     return dissolved
 
 
+def _to_raster_crs(gdf):
+    """Reproject range maps to RASTER_CRS if it's a projected CRS. Range maps without
+    a CRS are assumed to be in EPSG:4326, as are all range maps if RASTER_CRS is
+    geographic.
+
+    :param gdf: A GeoDataFrame of range maps.
+    :return: A GeoDataFrame of range maps in RASTER_CRS.
+    """
+    if RASTER_CRS_IS_GEOGRAPHIC:
+        return gdf
+    if gdf.crs is None:
+        gdf = gdf.set_crs('EPSG:4326')
+    if gdf.crs != RASTER_CRS:
+        gdf = gdf.to_crs(RASTER_CRS)
+    return gdf
+
+
+def _map_over_geometries(function, geometries, no_vertices):
+    """Apply a function to batches of geometries in the rasterisation worker pool, or
+    in this process if there's only one worker.
+
+    :param function: A function which takes a list of geometries and returns a list
+        with a result for each.
+    :param geometries: A list of shapely geometries.
+    :param no_vertices: A list of the number of vertices in each geometry.
+    :return: A list of the results for every geometry, in the same order.
+    """
+    if NO_RASTERISATION_WORKERS == 1 or len(geometries) < 2:
+        return function(geometries)
+
+    # Batches of consecutive geometries with about the same number of vertices.
+    batch_no_vertices = sum(no_vertices) / (NO_RASTERISATION_WORKERS *
+                                            NO_BATCHES_PER_WORKER)
+    batches = [[]]
+    no_vertices_in_batch = 0
+    for geometry, no_geometry_vertices in zip(geometries, no_vertices):
+        if batches[-1] and no_vertices_in_batch >= batch_no_vertices:
+            batches.append([])
+            no_vertices_in_batch = 0
+        batches[-1].append(geometry)
+        no_vertices_in_batch += no_geometry_vertices
+    return [result for batch_results in _get_rasterisation_pool().map(function,
+                                                                      batches)
+            for result in batch_results]
+
+
+def _hash_geometry(geometry):
+    """Hash a geometry, to look it up in the geometry cache.
+
+    :param geometry: A shapely geometry.
+    :return: The SHA-1 hash of its WKB as a hexadecimal string.
+    """
+    return hashlib.sha1(geometry.wkb).hexdigest()
+
+
+def _repair_geometries(geometries):
+    """Validate geometries and repair the invalid ones. This may be run in a worker
+    process.
+
+    :param geometries: A list of shapely geometries.
+    :return: A list with, for each geometry, None if it's valid or a tuple (problem,
+        repaired_geometry) if it isn't, in which problem is shapely's explanation of
+        why it's invalid. Only the polygonal parts of a repaired geometry are kept.
+    """
+    results = []
+    for geometry in geometries:
+        if geometry is None or geometry.is_valid:
+            results.append(None)
+            continue
+        repaired_geometry = make_valid(geometry)
+        if repaired_geometry.geom_type == 'GeometryCollection':
+            # Collapsed parts of polygons become lines or points.
+            repaired_geometry = unary_union(
+                [part for part in repaired_geometry.geoms
+                 if part.geom_type in ('Polygon', 'MultiPolygon')])
+        results.append((explain_validity(geometry), repaired_geometry))
+    return results
+
+
+def _get_validated_geometries():
+    """Get the hashes of the geometries which have been validated, reading them from
+    the geometry cache the first time.
+
+    :return: A dictionary mapping the hash of each validated geometry to why it was
+        invalid, or to an empty string if it was valid.
+    """
+    global _VALIDATED_GEOMETRIES
+    if _VALIDATED_GEOMETRIES is None:
+        _VALIDATED_GEOMETRIES = {}
+        validated_fp = os.path.join(GEOMETRY_CACHE_DIR_PATH, VALIDATED_FILENAME)
+        if os.path.exists(validated_fp):
+            with open(validated_fp) as validated_file:
+                for line in validated_file:
+                    fields = line.rstrip('\n').split('\t')
+                    # A line may have been cut short if a run was killed.
+                    if len(fields) == 2:
+                        _VALIDATED_GEOMETRIES[fields[0]] = fields[1]
+    return _VALIDATED_GEOMETRIES
+
+
+def _get_repaired_geometry_fp(feature_hash):
+    return os.path.join(GEOMETRY_CACHE_DIR_PATH, feature_hash + '.wkb')
+
+
+def _cache_validated_geometries(feature_hashes, results):
+    """Add validated geometries to the geometry cache.
+
+    :param feature_hashes: A list of the hashes of the geometries.
+    :param results: A list of the results of validating them, as returned by
+        _repair_geometries.
+    """
+    os.makedirs(GEOMETRY_CACHE_DIR_PATH, exist_ok=True)
+    lines = []
+    for feature_hash, result in zip(feature_hashes, results):
+        problem = ''
+        if result is not None:
+            # Tabs and line breaks would corrupt the list of validated geometries.
+            problem = ' '.join(result[0].split())
+            repaired_geometry_fp = _get_repaired_geometry_fp(feature_hash)
+            # Write to a temporary file first, in case several runs are repairing
+            # the same geometry at once.
+            temp_file_path = '%s.%d' % (repaired_geometry_fp, os.getpid())
+            with open(temp_file_path, 'wb') as repaired_geometry_file:
+                repaired_geometry_file.write(result[1].wkb)
+            os.replace(temp_file_path, repaired_geometry_fp)
+        _get_validated_geometries()[feature_hash] = problem
+        lines.append('%s\t%s\n' % (feature_hash, problem))
+
+    # The repaired geometries are written before they're listed, so a listed
+    # geometry can always be read.
+    with open(os.path.join(GEOMETRY_CACHE_DIR_PATH, VALIDATED_FILENAME),
+              'a') as validated_file:
+        validated_file.write(''.join(lines))
+
+
+def _validate_gdf(gdf, report_fp=None):
+    """Validate every range map in a GeoDataFrame and replace the invalid ones with
+    repaired ones. Geometries which aren't in the geometry cache are validated in
+    parallel and added to it.
+
+    :param gdf: A GeoDataFrame of range maps.
+    :param report_fp: Optional path to a CSV file. If given, a row is appended to it
+        for each range map which was repaired.
+    :return: A tuple (validated_gdf, no_repaired_geometries).
+    """
+    geometries = list(gdf.geometry)
+    feature_hashes = [None if geometry is None else _hash_geometry(geometry)
+                      for geometry in geometries]
+    validated_geometries = _get_validated_geometries()
+
+    unvalidated_row_nos = []
+    for row_no, feature_hash in enumerate(feature_hashes):
+        if feature_hash is not None and feature_hash not in validated_geometries:
+            unvalidated_row_nos.append(row_no)
+    if unvalidated_row_nos:
+        unvalidated_geometries = [geometries[row_no] for row_no in unvalidated_row_nos]
+        results = _map_over_geometries(
+            _repair_geometries, unvalidated_geometries,
+            [_count_vertices(geometry) for geometry in unvalidated_geometries])
+        _cache_validated_geometries([feature_hashes[row_no] for row_no
+                                     in unvalidated_row_nos], results)
+
+    repaired_geometries = list(geometries)
+    report_rows = []
+    for row_no, (row, feature_hash) in enumerate(zip(gdf.itertuples(),
+                                                     feature_hashes)):
+        problem = validated_geometries.get(feature_hash)
+        if not problem:
+            continue
+        with open(_get_repaired_geometry_fp(feature_hash), 'rb') as \
+                repaired_geometry_file:
+            repaired_geometries[row_no] = wkb.loads(repaired_geometry_file.read())
+        report_rows.append({'sisid': row.SISID,
+                            'seasonal': row.SEASONAL,
+                            'feature_hash': feature_hash,
+                            'problem': problem,
+                            'no_vertices': _count_vertices(geometries[row_no]),
+                            'no_repaired_vertices':
+                                _count_vertices(repaired_geometries[row_no])})
+
+    if report_fp and report_rows:
+        write_header = not os.path.exists(report_fp)
+        with open(report_fp, 'a', newline='') as report_file:
+            report_writer = csv.DictWriter(report_file,
+                                           fieldnames=GEOMETRY_REPORT_FIELDS)
+            if write_header:
+                report_writer.writeheader()
+            report_writer.writerows(report_rows)
+
+    if report_rows:
+        gdf = gdf.set_geometry(gpd.GeoSeries(repaired_geometries, index=gdf.index,
+                                             crs=gdf.crs))
+    return gdf, len(report_rows)
+
+
+def _simplify_geometries(geometries, tolerance):
+    """Simplify geometries without changing their topology, e.g. making a polygon's
+    boundary cross itself. This may be run in a worker process.
+
+    :param geometries: A list of shapely geometries.
+    :param tolerance: The greatest distance a simplified boundary may be from the
+        original one, in the units of the geometries' CRS.
+    :return: A list of the simplified geometries.
+    """
+    return [geometry.simplify(tolerance, preserve_topology=True)
+            for geometry in geometries]
+
+
+def _simplify_gdf(gdf):
+    """Simplify every range map in a GeoDataFrame, in parallel, with a tolerance of
+    SIMPLIFICATION_TOLERANCE_PIXELS pixels.
+
+    :param gdf: A GeoDataFrame of range maps in RASTER_CRS.
+    :return: A tuple (simplified_gdf, no_vertices, no_simplified_vertices), in which
+        the last two are lists of the number of vertices in each row before and after
+        simplification.
+    """
+    tolerance = SIMPLIFICATION_TOLERANCE_PIXELS * min(float(Fraction(PIXEL_WIDTH_STR)),
+                                                      float(Fraction(PIXEL_HEIGHT_STR)))
+    geometries = list(gdf.geometry)
+    no_vertices = [_count_vertices(geometry) for geometry in geometries]
+    simplified_geometries = _map_over_geometries(
+        partial(_simplify_geometries, tolerance=tolerance), geometries, no_vertices)
+
+    simplified_gdf = gdf.set_geometry(gpd.GeoSeries(simplified_geometries,
+                                                    index=gdf.index, crs=gdf.crs))
+    return simplified_gdf, no_vertices, [_count_vertices(geometry) for geometry
+                                         in simplified_geometries]
+
+
+def _is_checked_for_simplification(sisid):
+    """Check whether a species is one of the SIMPLIFICATION_CHECK_FRACTION whose
+    ranges are also rasterised without simplification. This only depends on the
+    SISID, so the same species are checked in every run.
+
+    :param sisid: The SISID of the species.
+    :return: True if the species' ranges are checked.
+    """
+    digest = hashlib.sha1(str(int(sisid)).encode()).hexdigest()
+    return int(digest, 16) % 10000 < SIMPLIFICATION_CHECK_FRACTION * 10000
+
+
+def _sum_by_range(gdf, values):
+    """Add up a value over the rows which _dissolve dissolves into each range map.
+
+    :param gdf: A filtered GeoDataFrame of range maps.
+    :param values: A list with a value for each row of gdf.
+    :return: A dictionary mapping tuples (sisid, breeding) of strings to sums.
+    """
+    sums = {}
+    for sisid, seasonal, value in zip(gdf['SISID'], gdf['SEASONAL'], values):
+        for breeding, seasons in (('1', ('1', '2')), ('0', ('1', '3'))):
+            if seasonal in seasons:
+                key = (str(sisid), breeding)
+                sums[key] = sums.get(key, 0) + value
+    return sums
+
+
+def _count_changed_pixels(geometry, unsimplified_geometry):
+    """Count the pixels which simplifying a range map changed, on the grid the
+    unsimplified range map would have been rasterised onto.
+
+    :param geometry: The simplified range map.
+    :param unsimplified_geometry: The range map before simplification.
+    :return: The number of pixels which are only within one of the two.
+    """
+    width, height, transform = _compute_raster_grid(unsimplified_geometry)
+    masks = [rasterize(shapes=((range_geometry, 1),), out_shape=(height, width),
+                       fill=0, transform=transform, dtype=np.uint8)
+             for range_geometry in (geometry, unsimplified_geometry)]
+    return int(np.count_nonzero(masks[0] != masks[1]))
+
+
+def _append_to_simplification_report(report_rows, report_fp):
+    """Append rows to a simplification report, creating it if it doesn't exist.
+
+    :param report_rows: A list of dictionaries whose keys are
+        SIMPLIFICATION_REPORT_FIELDS.
+    :param report_fp: Path to the report.
+    """
+    write_header = not os.path.exists(report_fp)
+    with open(report_fp, 'a', newline='') as report_file:
+        report_writer = csv.DictWriter(report_file,
+                                       fieldnames=SIMPLIFICATION_REPORT_FIELDS)
+        if write_header:
+            report_writer.writeheader()
+        report_writer.writerows(report_rows)
+
+
 def _clear_dir(dir_path):
     """If there is a directory at dir_path, empty it. If not, create it.
 
@@ -145,68 +518,660 @@ def _clear_dir(dir_path):
     if os.path.isdir(dir_path):
         shutil.rmtree(dir_path)
 
-    os.mkdir(dir_path)
+    os.makedirs(dir_path)
 
 
-def _rasterise_gdf(dissolved):
-    """Rasterise the GeoDataFrame dissolved.
+def _append_to_sci_name_raster_filename_mapping(sci_name_raster_filename_mapping,
+                                                mapping_fp=None):
+    """Append rows to the scientific name, raster filename mapping file.
 
-    :param dissolved: A GeoDataFrame in which there is one row for each desired range
-        map.
+    :param sci_name_raster_filename_mapping: A list of tuples as returned by
+        _rasterise_gdf.
+    :param mapping_fp: Path to the mapping file. Defaults to the current run's.
     """
-    with open(SCI_NAME_RASTER_FILENAME_MAPPING_FP, 'a', newline='') as snrfmf:
+    if mapping_fp is None:
+        mapping_fp = get_run().sci_name_raster_filename_mapping_fp
+    with open(mapping_fp, 'a', newline='') as snrfmf:
         snrfmf_writer = csv.writer(snrfmf)
+        snrfmf_writer.writerows(sci_name_raster_filename_mapping)
 
-        for row in dissolved.itertuples():
-            sisid_str = str(row.SISID)
-            breeding_str = str(row.BREEDING)
-            uncompressed_filename = map_sisid_breeding_to_filename(sisid_str,
-                                                                   breeding_str,
-                                                                   True)
-            uncompressed_file_path = os.path.join(RASTER_DIR_PATH,
-                                                  uncompressed_filename)
 
-            least_longitude = row.geometry.bounds[0]
-            least_latitude = row.geometry.bounds[1]
+def _read_preprocessed_ranges(mapping_fp=None):
+    """Find the range maps which have already been pre-processed, according to the
+    scientific name, raster filename mapping file.
 
-            longitude_range = row.geometry.bounds[2] - row.geometry.bounds[0]
-            latitude_range = row.geometry.bounds[3] - row.geometry.bounds[1]
+    :param mapping_fp: Path to the mapping file. Defaults to the current run's.
+    :return: A set of tuples (sisid, breeding) of strings. It's empty if the mapping
+        file doesn't exist.
+    """
+    if mapping_fp is None:
+        mapping_fp = get_run().sci_name_raster_filename_mapping_fp
+    if not os.path.exists(mapping_fp):
+        return set()
 
-            pixel_width_float = float(Fraction(PIXEL_WIDTH_STR))
-            pixel_height_float = float(Fraction(PIXEL_HEIGHT_STR))
+    preprocessed_ranges = set()
+    with open(mapping_fp, newline='') as snrfmf:
+        for row in csv.reader(snrfmf):
+            sisid_breeding_dict = map_filename_to_sisid_breeding(row[1])
+            preprocessed_ranges.add((sisid_breeding_dict['sisid'],
+                                     sisid_breeding_dict['breeding']))
+    return preprocessed_ranges
 
-            width = ceil(longitude_range / pixel_width_float)
-            height = ceil(latitude_range / pixel_height_float)
 
-            geotransform = (least_longitude, pixel_width_float, 0.0, least_latitude,
-                            0.0, pixel_height_float)
-            transform = Affine.from_gdal(*geotransform)
+def _count_vertices(geometry):
+    """Count the vertices of a geometry, including those of every part and hole.
 
-            print_w_timestamp('Generating %s...' % uncompressed_filename, end=' ')
-            _generate_raster(uncompressed_file_path, width, height, transform,
-                             row.geometry)
-            print('Done.')
+    :param geometry: A shapely geometry.
+    :return: The number of vertices.
+    """
+    if hasattr(geometry, 'geoms'):
+        return sum(_count_vertices(part) for part in geometry.geoms)
+    if geometry.geom_type == 'Polygon':
+        return len(geometry.exterior.coords) + \
+            sum(len(interior.coords) for interior in geometry.interiors)
+    return len(geometry.coords)
 
-            compressed_filename = map_sisid_breeding_to_filename(sisid_str,
-                                                                 breeding_str,
-                                                                 False)
-            compressed_file_path = os.path.join(RASTER_DIR_PATH, compressed_filename)
 
-            print_w_timestamp('Compressing...', end=' ')
-            _compress_raster(uncompressed_file_path, compressed_file_path)
-            print('Done.')
+def _iter_geojson_coordinate_sequences(geometry):
+    """Iterate over the rings, lines and points of a GeoJSON-like geometry, as read
+    by fiona.
+
+    :param geometry: A GeoJSON-like geometry mapping.
+    :return: A generator of sequences of coordinates.
+    """
+    if geometry is None:
+        return
+
+    geometry_type = geometry['type']
+    if geometry_type == 'GeometryCollection':
+        for part in geometry['geometries']:
+            for coordinate_sequence in _iter_geojson_coordinate_sequences(part):
+                yield coordinate_sequence
+    elif geometry_type == 'Point':
+        yield [geometry['coordinates']]
+    elif geometry_type in ('LineString', 'MultiPoint'):
+        yield geometry['coordinates']
+    elif geometry_type in ('Polygon', 'MultiLineString'):
+        for ring in geometry['coordinates']:
+            yield ring
+    elif geometry_type == 'MultiPolygon':
+        for polygon in geometry['coordinates']:
+            for ring in polygon:
+                yield ring
+
+
+def _summarise_geojson_geometry(geometry):
+    """Count the vertices of a GeoJSON-like geometry and find its bounds.
+
+    :param geometry: A GeoJSON-like geometry mapping.
+    :return: A tuple (no_vertices, min_x, min_y, max_x, max_y). The bounds are NaN
+        if the geometry is empty.
+    """
+    coordinate_arrs = [np.asarray(coordinate_sequence, dtype=float)
+                       .reshape(len(coordinate_sequence), -1)[:, :2]
+                       for coordinate_sequence
+                       in _iter_geojson_coordinate_sequences(geometry)
+                       if len(coordinate_sequence)]
+    if not coordinate_arrs:
+        return 0, np.nan, np.nan, np.nan, np.nan
+
+    coordinates = np.concatenate(coordinate_arrs)
+    min_x, min_y = coordinates.min(axis=0)
+    max_x, max_y = coordinates.max(axis=0)
+    return len(coordinates), min_x, min_y, max_x, max_y
+
+
+def _get_layer_index_file_path(geodatabase_path, layer_name):
+    """Get the path of the cached index of a geodatabase layer. The path depends on
+    when the geodatabase was last modified, so a stale index is never used.
+
+    :param geodatabase_path: Path to a geodatabase.
+    :param layer_name: Name of a layer in the geodatabase.
+    :return: Path to a CSV file.
+    """
+    if os.path.isdir(geodatabase_path):
+        # ESRI file geodatabases are directories.
+        file_paths = [os.path.join(geodatabase_path, filename)
+                      for filename in os.listdir(geodatabase_path)]
+    else:
+        file_paths = [geodatabase_path]
+    modified_time = max(os.path.getmtime(file_path) for file_path in file_paths)
+    size = sum(os.path.getsize(file_path) for file_path in file_paths)
+
+    key = '%s|%s|%f|%d' % (os.path.abspath(geodatabase_path), layer_name,
+                           modified_time, size)
+    return os.path.join(LAYER_INDEX_DIR_PATH,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest() + '.csv')
+
+
+def _get_layer_index(geodatabase_path, layer_name):
+    """Get the SISID, number of vertices and bounds of every row of a geodatabase
+    layer, building and caching the index if necessary.
+
+    :param geodatabase_path: Path to a geodatabase.
+    :param layer_name: Name of a layer in the geodatabase.
+    :return: A pandas DataFrame with a row for each row of the layer, in the same
+        order, and columns titled "SISID", "no_vertices", "min_x", "min_y", "max_x"
+        and "max_y".
+    """
+    layer_index_file_path = _get_layer_index_file_path(geodatabase_path, layer_name)
+    if os.path.exists(layer_index_file_path):
+        return pd.read_csv(layer_index_file_path)
+
+    print_w_timestamp('Indexing "%s" layer...' % layer_name, end=' ')
+    with span('index'):
+        rows = []
+        with fiona.open(geodatabase_path, layer=layer_name) as layer_collection:
+            for feature in layer_collection:
+                rows.append((feature['properties']['SISID'],) +
+                            _summarise_geojson_geometry(feature['geometry']))
+        layer_index_df = pd.DataFrame(rows, columns=['SISID', 'no_vertices', 'min_x',
+                                                     'min_y', 'max_x', 'max_y'])
+    print('Done.')
+
+    os.makedirs(LAYER_INDEX_DIR_PATH, exist_ok=True)
+    # Write to a temporary file first, in case several runs are indexing the same
+    # layer at once.
+    temp_file_path = '%s.%d' % (layer_index_file_path, os.getpid())
+    layer_index_df.to_csv(temp_file_path, index=False)
+    os.replace(temp_file_path, layer_index_file_path)
+
+    return layer_index_df
+
+
+def _load_aoi(aoi):
+    """Load an area of interest.
+
+    :param aoi: Either a path to a vector file (e.g. a shapefile or GeoPackage) whose
+        features together make up the area of interest, or a bounding box of the form
+        "min_lon,min_lat,max_lon,max_lat".
+    :return: A shapely geometry in EPSG:4326.
+    """
+    if os.path.exists(aoi):
+        aoi_gdf = gpd.read_file(aoi)
+        if aoi_gdf.crs is not None:
+            aoi_gdf = aoi_gdf.to_crs('EPSG:4326')
+        return aoi_gdf.unary_union
+
+    try:
+        bounds = [float(bound_str) for bound_str in aoi.split(',')]
+    except ValueError:
+        bounds = []
+    if len(bounds) != 4:
+        raise ValueError('The area of interest "%s" is neither a file nor a bounding '
+                         'box of the form "min_lon,min_lat,max_lon,max_lat".' % aoi)
+    return box(*bounds)
+
+
+def _select_rows_in_aoi(layer_index_df, aoi_geometry):
+    """Select the rows of every species which has a range map whose bounding box
+    intersects an area of interest.
+
+    :param layer_index_df: A pandas DataFrame returned by _get_layer_index.
+    :param aoi_geometry: A shapely geometry in EPSG:4326.
+    :return: The selected rows of layer_index_df.
+    """
+    # The bounds are cached in the layer index, so building the R-tree is quick.
+    bboxes = gpd.GeoSeries([box(*bounds) for bounds in
+                            layer_index_df[['min_x', 'min_y', 'max_x', 'max_y']]
+                           .fillna(0).values],
+                           index=layer_index_df.index)
+    bboxes[layer_index_df['no_vertices'] == 0] = None
+    candidate_row_nos = bboxes.sindex.query(aoi_geometry, predicate='intersects')
+
+    candidate_sisids = layer_index_df['SISID'].iloc[candidate_row_nos].unique()
+    return layer_index_df[layer_index_df['SISID'].isin(candidate_sisids)]
+
+
+def _select_species_in_aoi(botw_gdf, aoi_geometry, clip_to_aoi=False):
+    """Select the rows of every species which has a range map which intersects an
+    area of interest.
+
+    :param botw_gdf: A GeoDataFrame of range maps in the format of the range map
+        geodatabase.
+    :param aoi_geometry: A shapely geometry in EPSG:4326.
+    :param clip_to_aoi: Whether to clip the range maps to the area of interest.
+    :return: A GeoDataFrame containing the selected rows.
+    """
+    intersects = botw_gdf.intersects(aoi_geometry)
+    botw_gdf = botw_gdf[botw_gdf['SISID'].isin(botw_gdf.loc[intersects, 'SISID'])]
+
+    if clip_to_aoi:
+        botw_gdf = botw_gdf.copy()
+        botw_gdf['geometry'] = botw_gdf.intersection(aoi_geometry)
+        botw_gdf = botw_gdf[~botw_gdf.is_empty]
+
+    return botw_gdf
+
+
+def _read_rows(geodatabase_path, layer_name, row_nos):
+    """Read rows from a geodatabase layer.
+
+    :param geodatabase_path: Path to a geodatabase.
+    :param layer_name: Name of a layer in the geodatabase.
+    :param row_nos: A sorted sequence of the indices of the rows to read.
+    :return: A GeoDataFrame.
+    """
+    row_nos = np.asarray(row_nos)
+    # Read each run of consecutive rows at once.
+    run_starts = np.concatenate(([0], np.flatnonzero(np.diff(row_nos) != 1) + 1))
+    run_ends = np.append(run_starts[1:], len(row_nos))
+
+    gdfs = [gpd.read_file(geodatabase_path, layer=layer_name,
+                          rows=slice(int(row_nos[run_start]),
+                                     int(row_nos[run_end - 1]) + 1))
+            for run_start, run_end in zip(run_starts, run_ends)]
+    if len(gdfs) == 1:
+        return gdfs[0]
+    return gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), crs=gdfs[0].crs)
+
+
+class _ChunkPlanner(object):
+    """Chooses how many rows to pre-process at a time. Every chunk contains whole
+    species and, unless a single species is bigger, no more vertices than the current
+    vertex budget. After each chunk, the budget is adjusted from the time the chunk
+    took and the memory it used.
+    """
+
+    def __init__(self, sisids, vertex_counts, memory_budget_mb=None):
+        """
+        :param sisids: The SISID of every row. Rows of the same species must be
+            adjacent.
+        :param vertex_counts: The number of vertices in every row.
+        :param memory_budget_mb: The amount of memory the tool may use. Defaults to
+            PREPROCESSING_MEMORY_BUDGET_MB.
+        """
+        sisids = np.asarray(sisids)
+        self._cum_vertex_counts = np.concatenate(([0], np.cumsum(vertex_counts)))
+        # The index of the row after the last row of each species.
+        self._species_ends = np.append(np.flatnonzero(sisids[1:] != sisids[:-1]) + 1,
+                                       len(sisids))
+        self._memory_budget_mb = memory_budget_mb or PREPROCESSING_MEMORY_BUDGET_MB
+        self._baseline_rss_mb = get_peak_rss_mb()
+        global _WARNED_ABOUT_MEMORY_USE
+        if self._baseline_rss_mb is None and not _WARNED_ABOUT_MEMORY_USE:
+            print_w_timestamp('Warning: the memory used can\'t be measured, so chunk '
+                              'sizes are chosen from an estimate of the memory each '
+                              'vertex needs instead. Install psutil to measure it.')
+            _WARNED_ABOUT_MEMORY_USE = True
+        self._mb_per_vertex = INITIAL_MB_PER_VERTEX
+        self._s_per_vertex = None
+        self.vertex_budget = min(INITIAL_CHUNK_VERTEX_BUDGET,
+                                 self._get_memory_vertex_budget())
+
+        self.chunk_no_vertices = 0
+        self._chunk_start_time = None
+        self._chunk_start_peak_rss_mb = None
+
+    def _get_memory_vertex_budget(self):
+        if self._baseline_rss_mb is None:
+            # The memory used can't be measured, so fall back to a fixed estimate of
+            # the memory needed per vertex.
+            return self._memory_budget_mb / INITIAL_MB_PER_VERTEX
+        return max(0, self._memory_budget_mb - self._baseline_rss_mb) / \
+            self._mb_per_vertex
+
+    def start_chunk(self, start_row_no):
+        """Choose the rows in the next chunk and start measuring it.
+
+        :param start_row_no: The index of the first row in the chunk.
+        :return: The number of rows in the chunk.
+        """
+        max_cum_vertex_count = self._cum_vertex_counts[start_row_no] + \
+            self.vertex_budget
+        no_species_within_budget = np.searchsorted(
+            self._cum_vertex_counts[self._species_ends], max_cum_vertex_count,
+            side='right')
+        # Take at least the first species, even if it's over budget on its own.
+        first_species_end = self._species_ends[
+            np.searchsorted(self._species_ends, start_row_no, side='right')]
+        end_row_no = first_species_end
+        if no_species_within_budget:
+            end_row_no = max(end_row_no,
+                             self._species_ends[no_species_within_budget - 1])
+
+        self.chunk_no_vertices = int(self._cum_vertex_counts[end_row_no] -
+                                     self._cum_vertex_counts[start_row_no])
+        self._chunk_start_time = time.perf_counter()
+        self._chunk_start_peak_rss_mb = get_peak_rss_mb()
+
+        return int(end_row_no - start_row_no)
+
+    def finish_chunk(self):
+        """Adjust the vertex budget using the time taken and memory used by the
+        chunk which has just been processed.
+        """
+        no_vertices = max(1, self.chunk_no_vertices)
+
+        s_per_vertex = (time.perf_counter() - self._chunk_start_time) / no_vertices
+        if self._s_per_vertex is None:
+            self._s_per_vertex = s_per_vertex
+        else:
+            self._s_per_vertex = SMOOTHING * self._s_per_vertex + \
+                                 (1 - SMOOTHING) * s_per_vertex
+
+        peak_rss_mb = get_peak_rss_mb()
+        if peak_rss_mb is not None and self._baseline_rss_mb is not None:
+            mb_per_vertex = max(0, peak_rss_mb - self._baseline_rss_mb) / no_vertices
+            if peak_rss_mb > self._chunk_start_peak_rss_mb:
+                # The chunk set a new peak, so we know how much memory it needed.
+                self._mb_per_vertex = mb_per_vertex
+            else:
+                # The chunk needed no more than the previous peak.
+                self._mb_per_vertex = min(self._mb_per_vertex, mb_per_vertex)
+            self._mb_per_vertex = max(self._mb_per_vertex, 1e-9)
+
+        time_vertex_budget = TARGET_CHUNK_SECONDS / max(self._s_per_vertex, 1e-12)
+        self.vertex_budget = max(MIN_CHUNK_VERTEX_BUDGET,
+                                 min(self.vertex_budget *
+                                     MAX_CHUNK_VERTEX_BUDGET_GROWTH,
+                                     time_vertex_budget,
+                                     self._get_memory_vertex_budget()))
+
+
+def _compute_raster_grid(geometry):
+    """Compute the dimensions and geotransform of a raster which covers the bounding
+    box of geometry.
+
+    :param geometry: The geometry to be rasterised, in RASTER_CRS.
+    :return: A tuple (width, height, transform).
+    """
+    least_longitude = geometry.bounds[0]
+    least_latitude = geometry.bounds[1]
+
+    longitude_range = geometry.bounds[2] - geometry.bounds[0]
+    latitude_range = geometry.bounds[3] - geometry.bounds[1]
+
+    pixel_width_float = float(Fraction(PIXEL_WIDTH_STR))
+    pixel_height_float = float(Fraction(PIXEL_HEIGHT_STR))
 
-            #   Delete uncompressed raster.
-            os.remove(uncompressed_file_path)
+    width = ceil(longitude_range / pixel_width_float)
+    height = ceil(latitude_range / pixel_height_float)
 
-            # Delete ".tif.aux.xml" file.
-            xml_file_path = compressed_file_path + '.aux.xml'
-            os.remove(xml_file_path)
+    geotransform = (least_longitude, pixel_width_float, 0.0, least_latitude,
+                    0.0, pixel_height_float)
+    transform = Affine.from_gdal(*geotransform)
 
-            # At this point, I assert that a GeoTIFF has been generated and compressed
-            # successfully. Therefore, a mapping is added.
-            sci_name = str(row.SCINAME)
-            snrfmf_writer.writerow((sci_name, compressed_filename))
+    return width, height, transform
+
+
+def _init_rasterisation_worker():
+    """Initialise a rasterisation worker process."""
+    detach_tracing()
+
+
+def _get_rasterisation_pool():
+    """Get the pool of worker processes which range maps are rasterised in, creating
+    it if necessary.
+
+    :return: A ProcessPoolExecutor.
+    """
+    global _RASTERISATION_POOL
+    if _RASTERISATION_POOL is None:
+        _RASTERISATION_POOL = ProcessPoolExecutor(
+            NO_RASTERISATION_WORKERS, initializer=_init_rasterisation_worker)
+    return _RASTERISATION_POOL
+
+
+def _shut_down_rasterisation_pool():
+    """Shut down the pool of rasterisation worker processes, if there is one."""
+    global _RASTERISATION_POOL
+    if _RASTERISATION_POOL is not None:
+        _RASTERISATION_POOL.shutdown()
+        _RASTERISATION_POOL = None
+
+
+def _clip_to_altitude_band(mask, transform, min_alt, max_alt):
+    """Remove the pixels of a range mask which can't be within a species' altitude
+    limits, according to the local DEM, and crop the mask to the pixels which are
+    left.
+
+    :param mask: A NumPy uint8 array which is nonzero within the range.
+    :param transform: The affine transform of the mask, in RASTER_CRS.
+    :param min_alt: The minimum altitude of the species.
+    :param max_alt: The maximum altitude of the species.
+    :return: A tuple (clipped_mask, clipped_transform). If no pixels are left, the
+        clipped mask is a single pixel outside the range.
+    """
+    # The lowest and highest points of the DEM within each pixel. Pixels the DEM
+    # doesn't cover are NaN, and are kept.
+    lowest, highest = [np.full(mask.shape, np.nan, dtype=np.float32)
+                       for _ in range(2)]
+    with rasterio.open(LOCAL_DEM_PATH) as dem_src:
+        for destination, resampling in ((lowest, Resampling.min),
+                                        (highest, Resampling.max)):
+            reproject(rasterio.band(dem_src, 1), destination, dst_transform=transform,
+                      dst_crs=RASTER_CRS, dst_nodata=np.nan, resampling=resampling)
+    out_of_band = (highest < min_alt - ALTITUDE_PRECLIPPING_MARGIN_M) | \
+        (lowest > max_alt + ALTITUDE_PRECLIPPING_MARGIN_M)
+
+    # Keep the neighbours of every pixel which is kept too, in case GEE samples the
+    # DEM slightly differently.
+    in_band = ~out_of_band
+    kept = in_band.copy()
+    kept[1:] |= in_band[:-1]
+    kept[:-1] |= in_band[1:]
+    kept[:, 1:] |= in_band[:, :-1]
+    kept[:, :-1] |= in_band[:, 1:]
+    clipped_mask = np.where(kept, mask, 0).astype(np.uint8)
+
+    rows_in_range = np.flatnonzero(clipped_mask.any(axis=1))
+    cols_in_range = np.flatnonzero(clipped_mask.any(axis=0))
+    if len(rows_in_range) == 0:
+        return clipped_mask[:1, :1], transform
+    row_off, col_off = rows_in_range[0], cols_in_range[0]
+    return clipped_mask[row_off:rows_in_range[-1] + 1,
+                        col_off:cols_in_range[-1] + 1], \
+        transform * Affine.translation(int(col_off), int(row_off))
+
+
+def _get_raster_bounds(transform, width, height):
+    """Get the bounds of a raster grid.
+
+    :param transform: The affine transform of the grid.
+    :param width: The width of the grid in pixels.
+    :param height: The height of the grid in pixels.
+    :return: A tuple (min_x, min_y, max_x, max_y).
+    """
+    xs = (transform.c, transform.c + transform.a * width)
+    ys = (transform.f, transform.f + transform.e * height)
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _rasterise_range(raster_dir_path, sisid_str, breeding_str, geometry,
+                     unsimplified_geometry=None, altitude_limits=None,
+                     pack_mask=False):
+    """Rasterise and compress a range map. This may be run in a worker process.
+
+    :param raster_dir_path: Path to the directory to write the raster to.
+    :param sisid_str: The SISID of the species.
+    :param breeding_str: "1" for a breeding range and "0" for a non-breeding range.
+    :param geometry: The geometry of the range map.
+    :param unsimplified_geometry: Optional geometry of the range map before it was
+        simplified. If given, the pixels simplification changed are counted.
+    :param altitude_limits: Optional tuple (min_alt, max_alt). If given, the raster
+        is clipped to the altitude limits with _clip_to_altitude_band before it's
+        compressed.
+    :param pack_mask: Whether to return the range mask, to export it to a mask
+        store.
+    :return: A tuple (compressed_filename, no_range_pixels, no_pixels,
+        no_bytes_written, packed_mask, transform, no_changed_pixels,
+        no_unclipped_range_pixels, bounds), in which no_pixels is the number of pixels
+        in the raster, packed_mask is the range mask bit-packed row by row, or None if
+        pack_mask is False, transform is its affine transform, no_changed_pixels is
+        the number of pixels simplification changed, or None if
+        unsimplified_geometry isn't given, no_unclipped_range_pixels is the number of
+        pixels within the range before it was clipped to the altitude limits and
+        bounds are the bounds of the raster.
+    """
+    uncompressed_filename = map_sisid_breeding_to_filename(sisid_str,
+                                                           breeding_str,
+                                                           True)
+    uncompressed_file_path = os.path.join(raster_dir_path,
+                                          uncompressed_filename)
+
+    with span('rasterise', sisid=sisid_str, breeding=breeding_str) as \
+            rasterise_span:
+        width, height, transform = _compute_raster_grid(geometry)
+
+        print_w_timestamp('Generating %s...' % uncompressed_filename)
+        if altitude_limits is None:
+            mask = _generate_raster(uncompressed_file_path, width, height, transform,
+                                    geometry)
+            no_unclipped_range_pixels = int(np.count_nonzero(mask))
+        else:
+            mask = _burn_geometry(width, height, transform, geometry)
+            no_unclipped_range_pixels = int(np.count_nonzero(mask))
+            with span('altitude.clip', sisid=sisid_str, breeding=breeding_str):
+                mask, transform = _clip_to_altitude_band(mask, transform,
+                                                         *altitude_limits)
+            height, width = mask.shape
+            _write_raster(uncompressed_file_path, mask, transform)
+        no_range_pixels = int(np.count_nonzero(mask))
+        packed_mask = np.packbits(mask > 0, axis=1) if pack_mask else None
+
+        if is_enabled():
+            rasterise_span.add(vertices=_count_vertices(geometry),
+                               pixels=width * height)
+
+    no_changed_pixels = None
+    if unsimplified_geometry is not None:
+        with span('simplify.check', sisid=sisid_str, breeding=breeding_str):
+            no_changed_pixels = _count_changed_pixels(geometry, unsimplified_geometry)
+
+    compressed_filename = map_sisid_breeding_to_filename(sisid_str,
+                                                         breeding_str,
+                                                         False)
+    compressed_file_path = os.path.join(raster_dir_path, compressed_filename)
+
+    with span('compress', sisid=sisid_str, breeding=breeding_str) as \
+            compress_span:
+        print_w_timestamp('Compressing %s...' % uncompressed_filename)
+        _compress_raster(uncompressed_file_path, compressed_file_path)
+
+        no_bytes_written = os.path.getsize(compressed_file_path)
+        compress_span.add(bytes_written=no_bytes_written)
+
+    #   Delete uncompressed raster.
+    os.remove(uncompressed_file_path)
+
+    # Delete ".tif.aux.xml" file.
+    xml_file_path = compressed_file_path + '.aux.xml'
+    if os.path.exists(xml_file_path):
+        os.remove(xml_file_path)
+
+    return compressed_filename, no_range_pixels, width * height, no_bytes_written, \
+        packed_mask, transform, no_changed_pixels, no_unclipped_range_pixels, \
+        _get_raster_bounds(transform, width, height)
+
+
+def _rasterise_gdf(dissolved, raster_dir_path, mask_export_path=None,
+                   unsimplified_geometries=None, no_changed_pixels=None,
+                   alt_lims_dict=None):
+    """Rasterise the GeoDataFrame dissolved. The range maps are rasterised in
+    parallel, biggest first, so that a big range map which is started last doesn't
+    leave every other worker idle.
+
+    :param dissolved: A GeoDataFrame in which there is one row for each desired range
+        map.
+    :param raster_dir_path: Path to the directory to write the rasters to.
+    :param mask_export_path: Optional path to a mask store. If given, the range
+        masks are also exported to it. See mask_store.
+    :param unsimplified_geometries: Optional dictionary mapping tuples (sisid,
+        breeding) of strings to the geometries of range maps before they were
+        simplified, in RASTER_CRS. The pixels simplification changed are counted for
+        these range maps.
+    :param no_changed_pixels: Optional dictionary. The number of pixels
+        simplification changed in each range map in unsimplified_geometries is added
+        to it, by (sisid, breeding).
+    :param alt_lims_dict: Optional mapping from scientific names to minimum and
+        maximum altitudes, as returned by gfc_calculator._populate_altitude_lims_dict.
+        If given, the rasters of the species in it are clipped to their altitude
+        limits. See _clip_to_altitude_band.
+    :return: A list of 5-tuples, one for each generated raster, containing the
+        scientific name of the species, the filename of the raster, the number of
+        pixels within the range, the area of the range map's bounding box in square
+        kilometres and the estimated area of the range in square kilometres. If the
+        raster was clipped to the altitude limits, the number of pixels and the
+        bounding box are those of the clipped raster, but the area of the range is
+        that of the unclipped range, so that clipping doesn't change the scale it's
+        analysed at.
+    """
+    dissolved = _to_raster_crs(dissolved)
+    unsimplified_geometries = unsimplified_geometries or {}
+    alt_lims_dict = alt_lims_dict or {}
+
+    rows = list(dissolved.itertuples())
+    # Rasterisation takes time roughly proportional to the size of the raster.
+    no_pixels_list = []
+    for row in rows:
+        width, height, _ = _compute_raster_grid(row.geometry)
+        no_pixels_list.append(width * height)
+    row_nos = sorted(range(len(rows)), key=lambda row_no: no_pixels_list[row_no],
+                     reverse=True)
+
+    rasterise_args_list = [(raster_dir_path, str(row.SISID), str(row.BREEDING),
+                            row.geometry,
+                            unsimplified_geometries.get((str(row.SISID),
+                                                         str(row.BREEDING))),
+                            tuple(alt_lims_dict[str(row.SCINAME)])
+                            if str(row.SCINAME) in alt_lims_dict else None,
+                            bool(mask_export_path))
+                           for row in rows]
+    if NO_RASTERISATION_WORKERS > 1 and len(rows) > 1:
+        with span('rasterise.parallel') as parallel_span:
+            pool = _get_rasterisation_pool()
+            futures = {row_no: pool.submit(_rasterise_range,
+                                           *rasterise_args_list[row_no])
+                       for row_no in row_nos}
+            results = {row_no: future.result() for row_no, future in futures.items()}
+            # The worker processes don't trace, so count their work here instead.
+            parallel_span.add(ranges=len(rows),
+                              pixels=sum(no_pixels_list),
+                              bytes_written=sum(result[3]
+                                                for result in results.values()))
+    else:
+        results = {row_no: _rasterise_range(*rasterise_args_list[row_no])
+                   for row_no in row_nos}
+
+    if mask_export_path:
+        with MaskStoreWriter(mask_export_path) as mask_store_writer:
+            for row_no, row in enumerate(rows):
+                _, no_range_pixels, no_pixels, _, packed_mask, transform = \
+                    results[row_no][:6]
+                width = no_pixels // packed_mask.shape[0]
+                mask_store_writer.add(row.SISID, row.BREEDING, str(row.SCINAME),
+                                      packed_mask, width, transform,
+                                      no_range_pixels, RASTER_CRS)
+
+    if no_changed_pixels is not None:
+        for row_no, row in enumerate(rows):
+            if results[row_no][6] is not None:
+                no_changed_pixels[(str(row.SISID), str(row.BREEDING))] = \
+                    results[row_no][6]
+
+    sci_name_raster_filename_mapping = []
+    for row_no, row in enumerate(rows):
+        compressed_filename, no_range_pixels, no_pixels = results[row_no][:3]
+        no_unclipped_range_pixels = results[row_no][7]
+
+        # At this point, I assert that a GeoTIFF has been generated and compressed
+        # successfully. Therefore, a mapping is added.
+        sci_name = str(row.SCINAME)
+        bbox_area_km2 = compute_bbox_area_km2(row.geometry.bounds,
+                                              not RASTER_CRS_IS_GEOGRAPHIC)
+        range_area_km2 = estimate_range_area_km2(bbox_area_km2,
+                                                 no_unclipped_range_pixels,
+                                                 no_pixels_list[row_no])
+        if sci_name in alt_lims_dict:
+            # The raster may have been cropped.
+            bbox_area_km2 = compute_bbox_area_km2(results[row_no][8],
+                                                  not RASTER_CRS_IS_GEOGRAPHIC)
+        sci_name_raster_filename_mapping.append(
+            (sci_name, compressed_filename, no_range_pixels, bbox_area_km2,
+             range_area_km2))
+
+    return sci_name_raster_filename_mapping
 
 
 def _generate_raster(uncompressed_file_path, width, height, transform, geometry):
@@ -219,26 +1184,49 @@ def _generate_raster(uncompressed_file_path, width, height, transform, geometry)
     :param height: Height of the generated raster.
     :param transform: Geotransform of the generated raster.
     :param geometry: Geometry to rasterise.
+    :return: A NumPy uint8 array which is 255 within the geometry and 0 outside it.
+    """
+    burned = _burn_geometry(width, height, transform, geometry)
+    _write_raster(uncompressed_file_path, burned, transform)
+    return burned
+
+
+def _burn_geometry(width, height, transform, geometry):
+    """Rasterise a geometry in memory.
+
+    :param width: Width of the raster.
+    :param height: Height of the raster.
+    :param transform: Geotransform of the raster.
+    :param geometry: Geometry to rasterise.
+    :return: A NumPy uint8 array which is 255 within the geometry and 0 outside it.
+    """
+    # I don't know if I should be setting the all_touched parameter here
+    # to true. I guess this isn't a big deal but it might be worth exploring
+    # this situation if I want to discuss errors somehow.
+    return rasterize(shapes=((geometry, 255),),
+                     out_shape=(height, width),
+                     fill=0,
+                     transform=transform,
+                     dtype=np.uint8)
+
+
+def _write_raster(uncompressed_file_path, mask, transform):
+    """Save a range mask to an uncompressed 8-bit GeoTIFF in RASTER_CRS.
+
+    :param uncompressed_file_path: Destination file path.
+    :param mask: A NumPy uint8 array.
+    :param transform: Geotransform of the raster.
     """
     with rasterio.open(uncompressed_file_path,
-                       'w+',
+                       'w',
                        driver='GTiff',
-                       width=width,
-                       height=height,
+                       width=mask.shape[1],
+                       height=mask.shape[0],
                        count=1,
                        dtype=rasterio.uint8,
-                       crs='EPSG:4326',
+                       crs=RASTER_CRS,
                        transform=transform) as out:
-        out_arr = out.read(1)
-
-        # I don't know if I should be setting the all_touched parameter here
-        # to true. I guess this isn't a big deal but it might be worth exploring
-        # this situation if I want to discuss errors somehow.
-        burned = rasterize(shapes=((geometry, 255),),
-                           fill=0,
-                           out=out_arr,
-                           transform=out.transform)
-        out.write_band(1, burned)
+        out.write_band(1, mask)
 
 
 def _compress_raster(uncompressed_file_path, compressed_file_path):
@@ -261,88 +1249,301 @@ def _upload_to_gee(local_dir_path, gee_dir_path):
     :param gee_dir_path: The destination directory: a path to a directory in the GEE
         file system to upload the rasters to.
     """
+    backend = get_backend()
+
     random_suffix = ''.join(random.choices(string.digits, k=10))
-    gcs_raster_dir_path = GCS_BUCKET_PATH + '/' + random_suffix
-    os.system('gsutil -m cp -r "%s" %s' % (local_dir_path + '/' + '*',
-                                           gcs_raster_dir_path + '/'))
+    gcs_raster_dir_path = '%s/%s/%s' % (GCS_BUCKET_PATH, get_run().bucket_prefix,
+                                        random_suffix)
+    backend.upload_to_bucket(local_dir_path, gcs_raster_dir_path)
 
     # Upload to GEE (from GCS).
     raster_filenames = os.listdir(local_dir_path)
 
+    add_counters(files_uploaded=len(raster_filenames),
+                 bytes_uploaded=sum(os.path.getsize(os.path.join(local_dir_path,
+                                                                 raster_filename))
+                                    for raster_filename in raster_filenames))
+
     for raster_filename in raster_filenames:
         gcs_file_path = gcs_raster_dir_path + '/' + raster_filename
         asset_id = gee_dir_path + '/' + raster_filename[:-4]
 
-        os.system('earthengine upload image --asset_id %s %s' % (asset_id,
-                                                                 gcs_file_path))
+        task_id = backend.ingest_image(gcs_file_path, asset_id)
+        track_task(INGEST, asset_id, task_id,
+                   lambda failure_classes, gcs_file_path=gcs_file_path,
+                   asset_id=asset_id: backend.ingest_image(gcs_file_path, asset_id))
 
 
-def _process_chunk(geodatabase_path, layer_name, forest_dep_df, start_row_no,
-                   chunk_size, range_map_ic_gee_path, is_final_chunk):
-    """Read, filter, dissolve, rasterise and upload a chunk of the range map
-    geodatabase.
+def _preprocess_gdf(botw_gdf, forest_dep_df, range_map_ic_gee_path,
+                    raster_dir_path=None, keep_rasters=False,
+                    aoi_geometry=None, clip_to_aoi=False, mask_export_path=None,
+                    simplification_report_path=None, alt_lims_dict=None):
+    """Filter, repair (if VALIDATE_GEOMETRIES is true), simplify (if
+    SIMPLIFICATION_TOLERANCE_PIXELS isn't 0), dissolve, rasterise and upload the
+    range maps in a GeoDataFrame.
 
-    :param geodatabase_path: Path to an ESRI file geodatabase containing range maps
-        to be analysed.
-    :param layer_name: Name of the layer in the geodatabase at geodatabase_path
-        containing the range maps to be analysed.
-    :param forest_dep_df: Path to a spreadsheet containing species' forest dependency
-        information.
-    :param start_row_no: The index of the first row in the chunk.
-    :param chunk_size: The maximum number of rows to read. (Note that chunk size
-        isn't really constant: in all but the last chunk, rows are dropped.)
+    :param botw_gdf: A GeoDataFrame of range maps in the format of the range map
+        geodatabase.
+    :param forest_dep_df: A pandas DataFrame specifying species' forest dependency.
     :param range_map_ic_gee_path: GEE path to an ImageCollection to upload the
         generated rasters to.
-    :return: The index of the last row which was processed.
+    :param raster_dir_path: Path to a directory to write the rasters to. Anything
+        already in it is deleted. Defaults to the current run's.
+    :param keep_rasters: Whether to keep the rasters after they've been uploaded.
+    :param aoi_geometry: An optional area of interest. If given, only species with a
+        range map which intersects it are pre-processed.
+    :param clip_to_aoi: Whether to clip the range maps to the area of interest.
+    :param mask_export_path: Optional path to a mask store to export the range masks
+        to.
+    :param simplification_report_path: Optional path to a CSV file. If given and the
+        range maps are simplified, a row is appended to it for each range map, with
+        the numbers of vertices before and after simplification and, for the range
+        maps which are checked, the number of pixels simplification changed.
+    :param alt_lims_dict: Optional mapping from scientific names to altitude limits
+        to clip the rasters to. See _rasterise_gdf.
+    :return: A list of tuples describing the generated rasters, as returned by
+        _rasterise_gdf.
     """
-    chunk_slice = slice(start_row_no, start_row_no + chunk_size)
-
-    # Construct a GeoDataFrame from the range map geodatabase.
-    botw_gdf = gpd.read_file(geodatabase_path, layer=layer_name, rows=chunk_slice)
+    if raster_dir_path is None:
+        raster_dir_path = get_run().raster_dir_path
+
+    with span('filter') as filter_span:
+        # Join the GeoDataFrame and the Dataframe.
+        botw_gdf_w_forest_deps = botw_gdf.merge(forest_dep_df, on='SISID')
+        botw_gdf_w_forest_deps = _filter_gdf(botw_gdf_w_forest_deps)
+        if VALIDATE_GEOMETRIES:
+            # The geometries have usually been validated by validate_geometries
+            # already, so this only looks up the repaired ones.
+            botw_gdf_w_forest_deps, _ = _validate_gdf(botw_gdf_w_forest_deps)
+        if aoi_geometry is not None:
+            botw_gdf_w_forest_deps = _select_species_in_aoi(botw_gdf_w_forest_deps,
+                                                            aoi_geometry, clip_to_aoi)
+        filter_span.add(rows=len(botw_gdf_w_forest_deps))
+
+    if len(botw_gdf_w_forest_deps) == 0:
+        print_w_timestamp('All rows filtered out. Moving on to next chunk.')
+        return []
+
+    unsimplified_geometries = no_changed_pixels = None
+    if SIMPLIFICATION_TOLERANCE_PIXELS > 0:
+        with span('simplify') as simplify_span:
+            print_w_timestamp('Simplifying...', end=' ')
+            botw_gdf_w_forest_deps = _to_raster_crs(botw_gdf_w_forest_deps)
+            unsimplified_gdf = botw_gdf_w_forest_deps[
+                botw_gdf_w_forest_deps['SISID'].map(_is_checked_for_simplification)]
+            botw_gdf_w_forest_deps, no_vertices, no_simplified_vertices = \
+                _simplify_gdf(botw_gdf_w_forest_deps)
+            print('Done.')
+            simplify_span.add(vertices=sum(no_vertices),
+                              vertices_removed=sum(no_vertices) -
+                              sum(no_simplified_vertices))
+
+        if len(unsimplified_gdf):
+            with span('simplify.check.dissolve'):
+                unsimplified_geometries = {
+                    (str(row.SISID), str(row.BREEDING)): row.geometry
+                    for row in _dissolve(unsimplified_gdf).itertuples()}
+        no_changed_pixels = {}
+
+    with span('dissolve') as dissolve_span:
+        print_w_timestamp('Dissolving...', end=' ')
+        dissolved = _dissolve(botw_gdf_w_forest_deps)
+        print('Done.')
+        dissolve_span.add(ranges=len(dissolved))
+
+    # If a "rasters" directory exists, delete it (and all of its contents,
+    # recursively). The "rasters" directory is deleted at the very end of this
+    # script. Therefore, if the last execution of this script was aborted,
+    # the "rasters" directory will probably be hanging around.
+    _clear_dir(raster_dir_path)
+
+    sci_name_raster_filename_mapping = _rasterise_gdf(dissolved, raster_dir_path,
+                                                      mask_export_path,
+                                                      unsimplified_geometries,
+                                                      no_changed_pixels,
+                                                      alt_lims_dict)
+
+    if no_changed_pixels is not None:
+        no_vertices_by_range = _sum_by_range(botw_gdf_w_forest_deps, no_vertices)
+        no_simplified_vertices_by_range = _sum_by_range(botw_gdf_w_forest_deps,
+                                                        no_simplified_vertices)
+        report_rows = []
+        for mapping_row in sci_name_raster_filename_mapping:
+            sisid_breeding_dict = map_filename_to_sisid_breeding(mapping_row[1])
+            key = (sisid_breeding_dict['sisid'], sisid_breeding_dict['breeding'])
+            report_rows.append({'sisid': key[0],
+                                'breeding': key[1],
+                                'no_vertices': no_vertices_by_range.get(key),
+                                'no_simplified_vertices':
+                                    no_simplified_vertices_by_range.get(key),
+                                'no_range_pixels': mapping_row[2],
+                                'no_changed_pixels': no_changed_pixels.get(key, '')})
+
+        checked_rows = [report_row for report_row in report_rows
+                        if report_row['no_changed_pixels'] != '']
+        print_w_timestamp('Simplification removed %d of %d vertices.' %
+                          (sum(no_vertices) - sum(no_simplified_vertices),
+                           sum(no_vertices)))
+        if checked_rows:
+            print_w_timestamp('It changed %d pixels in the %d range maps checked, '
+                              'which have %d pixels within them.' %
+                              (sum(row['no_changed_pixels'] for row in checked_rows),
+                               len(checked_rows),
+                               sum(row['no_range_pixels'] for row in checked_rows)))
+        if simplification_report_path:
+            _append_to_simplification_report(report_rows, simplification_report_path)
+
+    with span('upload'):
+        print_w_timestamp('Uploading to Google Earth Engine...')
+        _upload_to_gee(raster_dir_path, range_map_ic_gee_path)
+        print('Done.')
 
-    if not is_final_chunk:
-        last_sisid = botw_gdf['SISID'].iloc[-1]
-        botw_gdf = botw_gdf[botw_gdf.SISID != last_sisid]
+    if not keep_rasters:
+        # Delete compressed rasters.
+        shutil.rmtree(raster_dir_path)
 
-    print_w_timestamp('Read rows %d-%d from "%s" layer.' % (start_row_no,
-                                                            start_row_no + len(
-                                                                botw_gdf.index) - 1,
-                                                            layer_name))
+    return sci_name_raster_filename_mapping
 
-    # Join the GeoDataFrame and the Dataframe.
-    botw_gdf_w_forest_deps = botw_gdf.merge(forest_dep_df, on='SISID')
-    botw_gdf_w_forest_deps = _filter_gdf(botw_gdf_w_forest_deps)
 
-    if len(botw_gdf_w_forest_deps) > 0:
-        print_w_timestamp('Dissolving...', end=' ')
-        dissolved = _dissolve(botw_gdf_w_forest_deps)
-        print('Done.')
+def _create_range_map_ic():
+    """Create an empty ImageCollection in the user's GEE home folder to upload range
+    map rasters to. It's named after the current run.
 
-        # If a "rasters" directory exists, delete it (and all of its contents,
-        # recursively). The "rasters" directory is deleted at the very end of this
-        # script. Therefore, if the last execution of this script was aborted,
-        # the "rasters" directory will probably be hanging around.
-        _clear_dir(RASTER_DIR_PATH)
+    :return: The GEE path to the ImageCollection.
+    """
+    backend = get_backend()
+    gee_home_folder_path = backend.get_home_folder_path()
+
+    # The name starts with the run's task tag so that the tasks which ingest rasters
+    # into the ImageCollection can be identified as the run's. The random suffix
+    # means that a shard can be rerun.
+    range_map_ic_name = get_run().task_tag + ''.join(random.choices(string.digits,
+                                                                    k=10))
+    range_map_ic_gee_path = gee_home_folder_path + '/' + range_map_ic_name
 
-        _rasterise_gdf(dissolved)
+    backend.create_image_collection(range_map_ic_gee_path)
 
-        print_w_timestamp('Uploading to Google Earth Engine...')
-        _upload_to_gee(RASTER_DIR_PATH, range_map_ic_gee_path)
-        print('Done.')
+    return range_map_ic_gee_path
 
-        # Delete compressed rasters.
-        shutil.rmtree(RASTER_DIR_PATH)
-    else:
-        print_w_timestamp('All rows filtered out. Moving on to next chunk.')
 
-    no_rows_processed = len(botw_gdf.index)
-    final_row_no_processed = start_row_no + no_rows_processed - 1
-    return final_row_no_processed
+def _get_run_range_map_ic(resume=False):
+    """Get the ImageCollection to upload the current run's range map rasters to,
+    creating it unless the run is being resumed and already has one. Its path is
+    saved in the run's working directory for when the run is resumed.
 
+    :param resume: Whether to reuse the ImageCollection an earlier attempt at the
+        current run created, if there is one.
+    :return: The GEE path to the ImageCollection.
+    """
+    run = get_run()
+    if resume and os.path.exists(run.range_map_ic_fp):
+        with open(run.range_map_ic_fp) as range_map_ic_file:
+            return range_map_ic_file.read().strip()
+
+    range_map_ic_gee_path = _create_range_map_ic()
+    os.makedirs(run.work_dir_path, exist_ok=True)
+    with open(run.range_map_ic_fp, 'w') as range_map_ic_file:
+        range_map_ic_file.write(range_map_ic_gee_path)
+
+    return range_map_ic_gee_path
+
+
+def _wait_for_uploads_and_empty_bucket():
+    """Wait for every upload to GEE to finish, resubmitting the ones which fail,
+    and then delete the current run's rasters from the raster bucket."""
+    print_w_timestamp('Waiting for all GEE tasks to complete...')
+    no_failed_uploads = wait_for_tracked_tasks(INGEST)
+    print_w_timestamp('Done')
+    if no_failed_uploads:
+        print_w_timestamp('%d rasters couldn\'t be uploaded to GEE.' %
+                          no_failed_uploads)
+    # Empty the run's part of the bucket.
+    get_backend().empty_bucket('%s/%s' % (GCS_BUCKET_PATH, get_run().bucket_prefix))
+
+
+def _process_chunk(geodatabase_path, layer_name, forest_dep_df, row_nos,
+                   range_map_ic_gee_path, aoi_geometry=None, clip_to_aoi=False,
+                   alt_lims_dict=None):
+    """Read, filter, dissolve, rasterise and upload a chunk of the range map
+    geodatabase. The chunk must contain every row of each species in it.
 
-def preprocess(geodatabase_path, layer_name, forest_dep_spreadsheet_path):
+    :param geodatabase_path: Path to an ESRI file geodatabase containing range maps
+        to be analysed.
+    :param layer_name: Name of the layer in the geodatabase at geodatabase_path
+        containing the range maps to be analysed.
+    :param forest_dep_df: Path to a spreadsheet containing species' forest dependency
+        information.
+    :param row_nos: The sorted indices of the rows in the chunk.
+    :param range_map_ic_gee_path: GEE path to an ImageCollection to upload the
+        generated rasters to.
+    :param aoi_geometry: See _preprocess_gdf.
+    :param clip_to_aoi: See _preprocess_gdf.
+    :param alt_lims_dict: See _preprocess_gdf.
+    """
+    with span('read', start_row_no=int(row_nos[0])) as read_span:
+        # Construct a GeoDataFrame from the range map geodatabase.
+        botw_gdf = _read_rows(geodatabase_path, layer_name, row_nos)
+        read_span.add(rows=len(botw_gdf))
+
+    print_w_timestamp('Read %d rows between rows %d and %d from "%s" layer.' %
+                      (len(botw_gdf.index), row_nos[0], row_nos[-1], layer_name))
+
+    run = get_run()
+    sci_name_raster_filename_mapping = _preprocess_gdf(
+        botw_gdf, forest_dep_df, range_map_ic_gee_path, aoi_geometry=aoi_geometry,
+        clip_to_aoi=clip_to_aoi,
+        mask_export_path=run.mask_export_fp if EXPORT_MASK_STORE else None,
+        simplification_report_path=run.simplification_report_fp,
+        alt_lims_dict=alt_lims_dict)
+    _append_to_sci_name_raster_filename_mapping(sci_name_raster_filename_mapping)
+
+
+def validate_geometries(geodatabase_path, layer_name, forest_dep_df, row_nos,
+                        sisids, vertex_counts, report_fp=None):
+    """Validate the geometries of the rows of a geodatabase layer which pass
+    _filter_gdf, repairing the invalid ones and adding them to the geometry cache, so
+    that they're ready before any range maps are dissolved.
+
+    :param geodatabase_path: Path to an ESRI file geodatabase containing range maps.
+    :param layer_name: Name of the layer in the geodatabase at geodatabase_path
+        containing the range maps.
+    :param forest_dep_df: A pandas DataFrame specifying species' forest dependency.
+    :param row_nos: The sorted indices of the rows to validate.
+    :param sisids: The SISID of each row.
+    :param vertex_counts: The number of vertices in each row.
+    :param report_fp: Optional path to a CSV file to append a row to for each range
+        map which was repaired.
+    :return: The number of geometries which were repaired.
+    """
+    no_repaired_geometries = 0
+    chunk_planner = _ChunkPlanner(sisids, vertex_counts)
+    chunk_start = 0
+    while chunk_start < len(row_nos):
+        report_progress('validate', chunk_start, len(row_nos), 'rows')
+        check_cancelled()
+        chunk_size = chunk_planner.start_chunk(chunk_start)
+        chunk_row_nos = row_nos[chunk_start:chunk_start + chunk_size]
+
+        with span('validate.chunk', start_row_no=int(chunk_row_nos[0])):
+            botw_gdf_w_forest_deps = _filter_gdf(
+                _read_rows(geodatabase_path, layer_name, chunk_row_nos)
+                .merge(forest_dep_df, on='SISID'))
+            _, no_chunk_repaired_geometries = _validate_gdf(botw_gdf_w_forest_deps,
+                                                            report_fp)
+            no_repaired_geometries += no_chunk_repaired_geometries
+
+        chunk_planner.finish_chunk()
+        chunk_start += chunk_size
+    report_progress('validate', len(row_nos), len(row_nos), 'rows')
+
+    return no_repaired_geometries
+
+
+def preprocess(geodatabase_path, layer_name, forest_dep_spreadsheet_path, aoi=None,
+               clip_to_aoi=False, resume=False, alt_lims_table_path=None):
     """Read and filter geodatabase, dissolve rows, rasterise, compress and upload
-    compressed rasters to GEE.
+    compressed rasters to GEE. Pre-processing can be cancelled between chunks (see
+    progress.request_cancellation).
 
     :param geodatabase_path: Path to an ESRI file geodatabase containing range maps
         to be analysed.
@@ -350,62 +1551,227 @@ def preprocess(geodatabase_path, layer_name, forest_dep_spreadsheet_path):
         containing the range maps to be analysed.
     :param forest_dep_spreadsheet_path: Path to a spreadsheet containing species'
         forest dependency information.
-    :return:
+    :param aoi: An optional area of interest: a path to a vector file or a bounding
+        box of the form "min_lon,min_lat,max_lon,max_lat". If given, only species
+        with a range map which intersects it are pre-processed.
+    :param clip_to_aoi: Whether to clip the range maps to the area of interest.
+    :param resume: Whether to carry on from where an earlier attempt at the current
+        run stopped. If so, species which are already in the run's scientific name,
+        raster filename mapping file are skipped. Rows are appended to the mapping
+        file a chunk of whole species at a time, so a species is either in it or
+        still to be pre-processed.
+    :param alt_lims_table_path: Optional path to a CSV file containing species'
+        altitude limits. If given and ALTITUDE_PRECLIPPING is true, each range's
+        raster is clipped to the species' altitude limits before it's uploaded.
+    :return: The GEE path to the ImageCollection the rasters were uploaded to.
     """
-    # TODO: This isn't the desired behaviour if the last execution of this script
-    #  died halfway through. It makes more sense just to get rid of this. This
-    #  mapping file should be deleted in gfc_calculator, I guess, after it's no
-    #  longer needed. Although, unless I give this script the capability to start not
-    #  from the very beginning, there isn't really any point in this. I suppose it
-    #  might make sense to add a start row parameter to the parameter list of the
-    #  program. The user would just need to read the row the last execution got up to
-    #  from standard output and and then stick this in. However, the user might not
-    #  get it exactly right. For example, what if the last chunk contained rows i to
-    #  j, but died before processing all of them? It wouldn't be obvious to a user
-    #  which row they need to start from and things would get messy. The solution,
-    #  really, is just not to use this mapping file...
-    if os.path.exists(SCI_NAME_RASTER_FILENAME_MAPPING_FP):
-        os.remove(SCI_NAME_RASTER_FILENAME_MAPPING_FP)
-
-    gee_home_folder_path = _get_gee_home_folder_path()
-
-    range_map_ic_name = ''.join(random.choices(string.digits, k=10))
-    range_map_ic_gee_path = gee_home_folder_path + '/' + range_map_ic_name
-
-    ee.data.createAsset({'type': 'ImageCollection'}, range_map_ic_gee_path)
+    alt_lims_dict = None
+    if ALTITUDE_PRECLIPPING:
+        if not LOCAL_DEM_PATH:
+            raise ValueError('A local DEM must be configured to pre-clip ranges to '
+                             'their altitude limits.')
+        if alt_lims_table_path:
+            from gfc_calculator import _populate_altitude_lims_dict
+            alt_lims_dict = _populate_altitude_lims_dict(alt_lims_table_path)
+        else:
+            print_w_timestamp('No altitude limits table was given, so ranges won\'t '
+                              'be pre-clipped to their altitude limits.')
+
+    run = get_run()
+    os.makedirs(run.work_dir_path, exist_ok=True)
+    preprocessed_sisids = set()
+    if resume:
+        preprocessed_sisids = {sisid for sisid, _ in _read_preprocessed_ranges()}
+    else:
+        if os.path.exists(run.sci_name_raster_filename_mapping_fp):
+            os.remove(run.sci_name_raster_filename_mapping_fp)
+        if os.path.exists(run.mask_export_fp):
+            os.remove(run.mask_export_fp)
+        if os.path.exists(run.simplification_report_fp):
+            os.remove(run.simplification_report_fp)
+    # Every range map still to be pre-processed is validated again, so the report
+    # only lists those.
+    if os.path.exists(run.geometry_report_fp):
+        os.remove(run.geometry_report_fp)
+
+    range_map_ic_gee_path = _get_run_range_map_ic(resume)
 
     forest_dep_df = _create_forest_dep_df(forest_dep_spreadsheet_path)
 
-    with fiona.open(geodatabase_path) as botw_geodatabase_collection:
-        no_rows = len(botw_geodatabase_collection)
-
-    final_row_no_processed = -1
+    layer_index_df = _get_layer_index(geodatabase_path, layer_name)
+
+    aoi_geometry = None
+    if aoi:
+        aoi_geometry = _load_aoi(aoi)
+        no_rows_in_layer = len(layer_index_df)
+        layer_index_df = _select_rows_in_aoi(layer_index_df, aoi_geometry)
+        print_w_timestamp('%d of %d rows may intersect the area of interest.' %
+                          (len(layer_index_df), no_rows_in_layer))
+
+    if run.shard is not None:
+        no_rows_in_layer = len(layer_index_df)
+        layer_index_df = layer_index_df[layer_index_df['SISID'].map(
+            run.includes_sisid)]
+        print_w_timestamp('%d of %d rows are in %s.' % (len(layer_index_df),
+                                                        no_rows_in_layer,
+                                                        run.shard_name))
+
+    if preprocessed_sisids:
+        no_rows_in_layer = len(layer_index_df)
+        layer_index_df = layer_index_df[~layer_index_df['SISID'].astype(str).isin(
+            preprocessed_sisids)]
+        print_w_timestamp('Resuming: %d of %d rows are still to be pre-processed.' %
+                          (len(layer_index_df), no_rows_in_layer))
+
+    # The indices of the rows to be pre-processed.
+    row_nos = layer_index_df.index.values
+    chunk_planner = _ChunkPlanner(layer_index_df['SISID'].values,
+                                  layer_index_df['no_vertices'].values)
+
+    chunk_start = 0
 
     try:
-        while final_row_no_processed < no_rows - 1:
-            start_row_no = final_row_no_processed + 1
-
-            # "If this isn't the last chunk".
-            if no_rows - 1 - final_row_no_processed > CHUNK_SIZE:
-                no_rows_to_read = CHUNK_SIZE
-                is_final_chunk = False
+        if VALIDATE_GEOMETRIES and len(row_nos):
+            print_w_timestamp('Validating geometries...')
+            with span('validate'):
+                no_repaired_geometries = validate_geometries(
+                    geodatabase_path, layer_name, forest_dep_df, row_nos,
+                    layer_index_df['SISID'].values,
+                    layer_index_df['no_vertices'].values, run.geometry_report_fp)
+            if no_repaired_geometries:
+                print_w_timestamp('Repaired %d invalid geometries. See %s.' %
+                                  (no_repaired_geometries, run.geometry_report_fp))
             else:
-                no_rows_to_read = no_rows - 1 - final_row_no_processed
-                is_final_chunk = True
-
-            final_row_no_processed = _process_chunk(geodatabase_path, layer_name,
-                                                    forest_dep_df, start_row_no,
-                                                    no_rows_to_read,
-                                                    range_map_ic_gee_path,
-                                                    is_final_chunk)
+                print_w_timestamp('Every geometry is valid.')
+
+        while chunk_start < len(row_nos):
+            report_progress('preprocess', chunk_start, len(row_nos), 'rows')
+            check_cancelled()
+            chunk_size = chunk_planner.start_chunk(chunk_start)
+            chunk_row_nos = row_nos[chunk_start:chunk_start + chunk_size]
+
+            with span('preprocess.chunk',
+                      start_row_no=int(chunk_row_nos[0])) as chunk_span:
+                _process_chunk(geodatabase_path, layer_name, forest_dep_df,
+                               chunk_row_nos, range_map_ic_gee_path, aoi_geometry,
+                               clip_to_aoi, alt_lims_dict)
+                chunk_span.add(vertices=chunk_planner.chunk_no_vertices)
+
+            chunk_planner.finish_chunk()
+            chunk_start += chunk_size
+        report_progress('preprocess', len(row_nos), len(row_nos), 'rows')
+    finally:
+        _shut_down_rasterisation_pool()
+        with span('wait.uploads'):
+            _wait_for_uploads_and_empty_bucket()
+
+    return range_map_ic_gee_path
+
+
+def preprocess_range_maps(range_maps_gdf, forest_dep_df, raster_dir_path,
+                          keep_rasters=False, aoi=None, clip_to_aoi=False,
+                          mask_export_path=None, simplification_report_path=None,
+                          geometry_report_path=None, mapping_fp=None,
+                          alt_lims_dict=None):
+    """Pre-process range maps which are already in memory, rather than in a
+    geodatabase: validate, filter, dissolve, rasterise, compress and upload them to
+    a new ImageCollection in GEE, a chunk at a time. If the current run is a shard,
+    only the species in the shard are pre-processed.
+
+    :param range_maps_gdf: A GeoDataFrame containing range maps, with the same
+        columns as the range map geodatabase.
+    :param forest_dep_df: A pandas DataFrame specifying species' forest dependency,
+        with a column titled "SIS ID" or "SISID" and a column titled "Forest
+        dependency".
+    :param raster_dir_path: Path to a directory to write the rasters to, a
+        subdirectory per chunk.
+    :param keep_rasters: Whether to keep the rasters after they've been uploaded.
+    :param aoi: An optional area of interest: a shapely geometry in EPSG:4326, a
+        path to a vector file or a bounding box of the form
+        "min_lon,min_lat,max_lon,max_lat". If given, only species with a range map
+        which intersects it are pre-processed.
+    :param clip_to_aoi: Whether to clip the range maps to the area of interest.
+    :param mask_export_path: Optional path to a mask store to export the range masks
+        to.
+    :param simplification_report_path: See _preprocess_gdf.
+    :param geometry_report_path: Optional path to a CSV file to append a row to for
+        each range map which was repaired.
+    :param mapping_fp: Optional path to a scientific name, raster filename mapping
+        file to append each chunk's rows to.
+    :param alt_lims_dict: Optional mapping from scientific names to altitude limits.
+        If given and ALTITUDE_PRECLIPPING is true, each range's raster is clipped to
+        the species' altitude limits before it's uploaded.
+    :return: A tuple (range_map_ic_gee_path, sci_name_raster_filename_mapping), in
+        which sci_name_raster_filename_mapping is a list of tuples, as returned by
+        _rasterise_gdf.
+    """
+    if ALTITUDE_PRECLIPPING and alt_lims_dict is not None:
+        if not LOCAL_DEM_PATH:
+            raise ValueError('A local DEM must be configured to pre-clip ranges to '
+                             'their altitude limits.')
+    else:
+        alt_lims_dict = None
+
+    range_maps_gdf = range_maps_gdf[range_maps_gdf['SISID'].map(
+        get_run().includes_sisid)].copy()
+    range_maps_gdf[CODE_COLS] = range_maps_gdf[CODE_COLS].astype(str)
+    forest_dep_df = _normalise_forest_dep_df(forest_dep_df)
+
+    aoi_geometry = None
+    if aoi is not None:
+        aoi_geometry = _load_aoi(aoi) if isinstance(aoi, str) else aoi
+        range_maps_gdf = _select_species_in_aoi(range_maps_gdf, aoi_geometry)
+
+    range_map_ic_gee_path = _create_range_map_ic()
+
+    # Pre-process a few species at a time so that each dissolve fits in memory. Rows
+    # of the same species need to be adjacent.
+    range_maps_gdf = range_maps_gdf.sort_values('SISID', kind='mergesort')
+    chunk_planner = _ChunkPlanner(range_maps_gdf['SISID'].values,
+                                  range_maps_gdf.geometry.apply(_count_vertices).values)
+    sci_name_raster_filename_mapping = []
+    chunk_no = 0
+    start_row_no = 0
+    try:
+        if VALIDATE_GEOMETRIES:
+            # Repair invalid geometries before anything is dissolved. The repaired
+            # geometries are cached, so _preprocess_gdf only has to look them up.
+            with span('validate'):
+                _, no_repaired_geometries = _validate_gdf(
+                    _filter_gdf(range_maps_gdf.merge(forest_dep_df, on='SISID')),
+                    geometry_report_path)
+            if no_repaired_geometries:
+                print_w_timestamp('Repaired %d invalid geometries.' %
+                                  no_repaired_geometries)
+
+        while start_row_no < len(range_maps_gdf):
+            no_rows = chunk_planner.start_chunk(start_row_no)
+            print_w_timestamp('Pre-processing rows %d-%d of %d.' %
+                              (start_row_no, start_row_no + no_rows - 1,
+                               len(range_maps_gdf)))
+            chunk_gdf = range_maps_gdf.iloc[start_row_no:start_row_no + no_rows]
+            with span('preprocess.chunk', start_row_no=start_row_no) as chunk_span:
+                chunk_mapping = _preprocess_gdf(
+                    chunk_gdf, forest_dep_df, range_map_ic_gee_path,
+                    os.path.join(raster_dir_path, str(chunk_no)),
+                    keep_rasters=keep_rasters, aoi_geometry=aoi_geometry,
+                    clip_to_aoi=clip_to_aoi, mask_export_path=mask_export_path,
+                    simplification_report_path=simplification_report_path,
+                    alt_lims_dict=alt_lims_dict)
+                chunk_span.add(vertices=chunk_planner.chunk_no_vertices)
+            if mapping_fp:
+                _append_to_sci_name_raster_filename_mapping(chunk_mapping, mapping_fp)
+            sci_name_raster_filename_mapping += chunk_mapping
+            chunk_planner.finish_chunk()
+
+            chunk_no += 1
+            start_row_no += no_rows
     finally:
-        print_w_timestamp('Waiting for all GEE tasks to complete...')
-        wait_until_all_tasks_complete()
-        print_w_timestamp('Done')
-        # Empty the bucket.
-        os.system('gsutil -m rm %s' % GCS_BUCKET_PATH + '/' + '**')
+        _shut_down_rasterisation_pool()
+        with span('wait.uploads'):
+            _wait_for_uploads_and_empty_bucket()
 
-        return range_map_ic_gee_path
+    return range_map_ic_gee_path, sci_name_raster_filename_mapping
 
 
 # NOTE: This is just here for testing purposes to make it easy to run this script on
@@ -0,0 +1,119 @@
+# Progress reporting and cooperative cancellation, so that a run can be watched and
+# stopped from another thread, e.g. by the GUI, which runs the pipeline in a
+# background thread.
+#
+# The pipeline reports how far it has got through each stage with report_progress
+# and calls check_cancelled at range boundaries, where stopping leaves the run in a
+# state it can be resumed from (see main.main).
+
+import threading
+import time
+
+# A stage's throughput is only reported once it has been running for this many
+# seconds, as the first few ranges say little about the rest.
+MIN_ELAPSED_S_FOR_ETA = 10
+
+_PROGRESS_CALLBACK = None
+_CANCELLATION_REQUESTED = threading.Event()
+
+
+class RunCancelled(Exception):
+    """Raised by check_cancelled once cancellation has been requested."""
+
+
+def set_progress_callback(callback):
+    """Set the function progress is reported to.
+
+    :param callback: A function taking the arguments stage, no_done, no_total and
+        unit, as passed to report_progress, or None to stop reporting progress.
+    """
+    global _PROGRESS_CALLBACK
+    _PROGRESS_CALLBACK = callback
+
+
+def report_progress(stage, no_done, no_total, unit):
+    """Report how far the pipeline has got through a stage. Nothing happens unless a
+    progress callback has been set.
+
+    :param stage: The name of the stage, e.g. "preprocess".
+    :param no_done: The number of units of work done so far in the stage.
+    :param no_total: The number of units of work in the stage.
+    :param unit: The unit of work, e.g. "ranges".
+    """
+    if _PROGRESS_CALLBACK is not None:
+        _PROGRESS_CALLBACK(stage, no_done, no_total, unit)
+
+
+def request_cancellation():
+    """Ask the pipeline to stop at the next range boundary. Can be called from any
+    thread."""
+    _CANCELLATION_REQUESTED.set()
+
+
+def clear_cancellation():
+    """Forget any earlier request for cancellation, e.g. before a run is started."""
+    _CANCELLATION_REQUESTED.clear()
+
+
+def check_cancelled():
+    """Stop the pipeline if cancellation has been requested.
+
+    :raises RunCancelled: If cancellation has been requested.
+    """
+    if _CANCELLATION_REQUESTED.is_set():
+        raise RunCancelled('The run was cancelled.')
+
+
+class ProgressMonitor(object):
+    """Turns the progress reported by the pipeline into descriptions including the
+    throughput and estimated time remaining of the current stage."""
+
+    def __init__(self):
+        """Initialise a ProgressMonitor."""
+        self._stage = None
+        self._stage_start_time = None
+        self._stage_start_no_done = 0
+
+    def update(self, stage, no_done, no_total, unit):
+        """Record the progress of a stage. The arguments are those passed to the
+        progress callback by report_progress.
+
+        :return: A description of the progress, e.g. "analyse: 120 of 4000 ranges
+            (3%), 2.1 ranges/min, about 30 h 47 min left".
+        """
+        now = time.time()
+        if stage != self._stage:
+            # Work done before the stage was first reported, e.g. in an earlier
+            # attempt at a resumed run, doesn't count towards the throughput.
+            self._stage = stage
+            self._stage_start_time = now
+            self._stage_start_no_done = no_done
+
+        description = '%s: %d of %d %s' % (stage, no_done, no_total, unit)
+        if no_total:
+            description += ' (%d%%)' % (100 * no_done // no_total)
+
+        elapsed_s = now - self._stage_start_time
+        no_done_in_stage = no_done - self._stage_start_no_done
+        if elapsed_s >= MIN_ELAPSED_S_FOR_ETA and no_done_in_stage > 0:
+            per_s = no_done_in_stage / elapsed_s
+            description += ', %.1f %s/min' % (per_s * 60, unit)
+            remaining_s = max(0, no_total - no_done) / per_s
+            description += ', about %s left' % _format_duration(remaining_s)
+
+        return description
+
+
+def _format_duration(duration_s):
+    """Format a duration for people to read.
+
+    :param duration_s: The duration in seconds.
+    :return: A string such as "3 h 5 min" or "40 s".
+    """
+    duration_s = int(round(duration_s))
+    if duration_s < 60:
+        return '%d s' % duration_s
+    hours, minutes = divmod(duration_s // 60, 60)
+    if hours:
+        return '%d h %d min' % (hours, minutes)
+    return '%d min' % minutes
@@ -0,0 +1,358 @@
+# Pre-processing of range maps which are already rasters, e.g. GeoTIFFs held by
+# partners or the rasters kept from a previous run, so that the vector pipeline
+# (reading, filtering, dissolving and rasterising the geodatabase) can be skipped.
+#
+# The rasters are given as a directory or a multi-band VRT, along with a manifest
+# which says which species and season each raster is for, or as a mask store (see
+# mask_store), which needs no manifest. Each raster is normalised to the grid and bit
+# depth of the rasters generated by the preprocessor, cropped to the range and
+# uploaded to GEE as usual.
+
+import csv
+import os
+import shutil
+from fractions import Fraction
+from math import ceil
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, transform_bounds
+
+from cost_model import compute_bbox_area_km2, estimate_range_area_km2
+from mask_store import MaskStore, is_mask_store
+from preprocessor import PIXEL_WIDTH_STR, PIXEL_HEIGHT_STR, RASTER_CRS, \
+    RASTER_CRS_IS_GEOGRAPHIC, NO_RASTERISATION_WORKERS, \
+    _append_to_sci_name_raster_filename_mapping, _clear_dir, _compress_raster, \
+    _get_rasterisation_pool, _get_run_range_map_ic, _read_preprocessed_ranges, \
+    _shut_down_rasterisation_pool, _upload_to_gee, _wait_for_uploads_and_empty_bucket
+from progress import check_cancelled, report_progress
+from runs import get_run
+from tracing import span
+from utilities import map_sisid_breeding_to_filename, print_w_timestamp
+
+MANIFEST_FIELDS = ['sisid', 'breeding', 'sci_name']
+# Rasters are normalised and uploaded this many at a time, so that the disk space
+# needed doesn't depend on the number of range maps.
+RASTER_BATCH_SIZE = 1000
+# Pixel sizes which differ from the configured ones by less than this fraction are
+# treated as equal, to allow for rounding in the rasters' geotransforms.
+PIXEL_SIZE_TOLERANCE = 1e-6
+
+_EPSG_4326 = CRS.from_epsg(4326)
+_RASTER_CRS = CRS.from_user_input(RASTER_CRS)
+
+# The mask stores opened by this process, by path.
+_mask_stores = {}
+
+
+def _get_mask_store(mask_store_path):
+    """Get a MaskStore, opening it the first time it's needed in this process.
+
+    :param mask_store_path: Path to a mask store.
+    :return: A MaskStore.
+    """
+    if mask_store_path not in _mask_stores:
+        _mask_stores[mask_store_path] = MaskStore(mask_store_path)
+    return _mask_stores[mask_store_path]
+
+
+def _read_mask_store_manifest(mask_store_path, manifest_path=None):
+    """List the ranges in a mask store.
+
+    :param mask_store_path: Path to a mask store.
+    :param manifest_path: Optional path to a CSV file with the columns "sisid",
+        "breeding" and "sci_name". If given, only the ranges in it are listed, and
+        its scientific names are used instead of those in the store.
+    :return: A list of dictionaries with the keys "sisid", "breeding", "sci_name",
+        "path" and "band", in which "band" is None.
+    """
+    mask_store = _get_mask_store(mask_store_path)
+    if manifest_path:
+        with open(manifest_path, newline='') as manifest_file:
+            ranges = [(int(row['sisid']), int(row['breeding']), row['sci_name'])
+                      for row in csv.DictReader(manifest_file)]
+    else:
+        ranges = [(sisid, breeding,
+                   mask_store.get_info(sisid, breeding)['sci_name'])
+                  for sisid, breeding in mask_store.keys()]
+
+    return [{'sisid': str(sisid), 'breeding': str(breeding), 'sci_name': sci_name,
+             'path': mask_store_path, 'band': None}
+            for sisid, breeding, sci_name in ranges]
+
+
+def _read_manifest(manifest_path, range_rasters_path):
+    """Read the manifest of a set of range map rasters.
+
+    :param manifest_path: Path to a CSV file with the columns "sisid", "breeding"
+        ("1" for a breeding range and "0" for a non-breeding range) and "sci_name".
+        If the rasters are in a directory, an optional "filename" column gives the
+        name of each raster in it. If it's absent, the rasters must be named as the
+        preprocessor names them, e.g. "1234_1_compressed.tif". If the rasters are
+        the bands of a VRT, an optional "band" column gives the number of each
+        range's band. If it's absent, row i of the manifest is band i.
+    :param range_rasters_path: Path to the directory or VRT containing the rasters.
+    :return: A list of dictionaries with the keys "sisid", "breeding", "sci_name",
+        "path" and "band".
+    """
+    is_vrt = not os.path.isdir(range_rasters_path)
+    with open(manifest_path, newline='') as manifest_file:
+        reader = csv.DictReader(manifest_file)
+        missing_fields = [field for field in MANIFEST_FIELDS
+                          if field not in (reader.fieldnames or [])]
+        if missing_fields:
+            raise ValueError('The range raster manifest %s has no %s column.' %
+                             (manifest_path, ', '.join(missing_fields)))
+
+        manifest = []
+        for row_no, row in enumerate(reader):
+            sisid = str(int(row['sisid']))
+            breeding = str(int(row['breeding']))
+            if is_vrt:
+                path = range_rasters_path
+                band = int(row.get('band') or row_no + 1)
+            else:
+                filename = row.get('filename') or \
+                    map_sisid_breeding_to_filename(sisid, breeding, False)
+                path = os.path.join(range_rasters_path, filename)
+                band = 1
+            manifest.append({'sisid': sisid, 'breeding': breeding,
+                             'sci_name': row['sci_name'], 'path': path,
+                             'band': band})
+
+    return manifest
+
+
+def _resample_onto_grid(mask, transform, crs):
+    """Resample a range mask onto the grid the preprocessor rasterises range maps
+    onto, unless it's already on it.
+
+    :param mask: A NumPy uint8 array which is 1 inside the range and 0 outside it.
+    :param transform: The affine transform of mask.
+    :param crs: The CRS of mask.
+    :return: A tuple (mask, transform) in which mask is a NumPy uint8 array which is
+        1 inside the range and 0 outside it and transform is its affine transform in
+        RASTER_CRS.
+    """
+    pixel_width = float(Fraction(PIXEL_WIDTH_STR))
+    pixel_height = float(Fraction(PIXEL_HEIGHT_STR))
+
+    on_grid = crs == _RASTER_CRS and \
+        abs(abs(transform.a) / pixel_width - 1) < PIXEL_SIZE_TOLERANCE and \
+        abs(abs(transform.e) / pixel_height - 1) < PIXEL_SIZE_TOLERANCE
+    if on_grid:
+        return mask, transform
+
+    # Range map rasters may have their origin at the bottom left.
+    xs = (transform.c, transform.c + transform.a * mask.shape[1])
+    ys = (transform.f, transform.f + transform.e * mask.shape[0])
+    left, bottom, right, top = transform_bounds(crs, _RASTER_CRS, min(xs), min(ys),
+                                                max(xs), max(ys))
+    width = max(1, ceil((right - left) / pixel_width))
+    height = max(1, ceil((top - bottom) / pixel_height))
+    dst_transform = from_origin(left, top, pixel_width, pixel_height)
+    resampled_mask = np.zeros((height, width), dtype=np.uint8)
+    reproject(mask, resampled_mask, src_transform=transform, src_crs=crs,
+              dst_transform=dst_transform, dst_crs=_RASTER_CRS,
+              resampling=Resampling.nearest)
+    return resampled_mask, dst_transform
+
+
+def _read_range_mask(range_raster_path, band):
+    """Read a range map raster of any data type and CRS onto the grid the
+    preprocessor rasterises range maps onto. Nonzero pixels which aren't nodata are
+    inside the range.
+
+    :param range_raster_path: Path to a raster.
+    :param band: The number of the band containing the range map.
+    :return: A tuple (mask, transform), as returned by _resample_onto_grid.
+    """
+    with rasterio.open(range_raster_path) as src:
+        data = src.read(band, masked=True)
+        mask = (data.filled(0) != 0).astype(np.uint8)
+        return _resample_onto_grid(mask, src.transform, src.crs or _EPSG_4326)
+
+
+def _normalise_range_raster(raster_dir_path, range_dict):
+    """Normalise a range map raster to the grid and bit depth of the rasters
+    generated by the preprocessor, crop it to the range and compress it. This may be
+    run in a worker process.
+
+    :param raster_dir_path: Path to the directory to write the raster to.
+    :param range_dict: A dictionary describing the raster, as returned by
+        _read_manifest.
+    :return: A tuple (compressed_filename, no_range_pixels, no_pixels, bounds), or
+        a string explaining why the raster is invalid.
+    """
+    if range_dict['band'] is None:
+        mask_store = _get_mask_store(range_dict['path'])
+        try:
+            mask = mask_store.read_mask(range_dict['sisid'], range_dict['breeding'])
+        except KeyError:
+            return '%s contains no mask for it.' % range_dict['path']
+        mask, transform = _resample_onto_grid(
+            mask, mask_store.get_transform(range_dict['sisid'],
+                                           range_dict['breeding']),
+            CRS.from_user_input(mask_store.get_info(range_dict['sisid'],
+                                                    range_dict['breeding'])['crs']))
+        source = range_dict['path']
+    else:
+        try:
+            mask, transform = _read_range_mask(range_dict['path'],
+                                               range_dict['band'])
+        except (rasterio.errors.RasterioError, IndexError) as e:
+            return 'Can\'t read band %d of %s: %s' % (range_dict['band'],
+                                                     range_dict['path'], e)
+        source = 'Band %d of %s' % (range_dict['band'], range_dict['path'])
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return '%s contains no range.' % source
+
+    # Crop the raster to the range.
+    mask = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    transform = transform * transform.translation(cols[0], rows[0])
+    height, width = mask.shape
+
+    uncompressed_file_path = os.path.join(
+        raster_dir_path, map_sisid_breeding_to_filename(range_dict['sisid'],
+                                                        range_dict['breeding'],
+                                                        True))
+    # Write the raster in the same format as _generate_raster in the preprocessor.
+    with rasterio.open(uncompressed_file_path, 'w', driver='GTiff', width=width,
+                       height=height, count=1, dtype=rasterio.uint8,
+                       crs=RASTER_CRS, transform=transform) as out:
+        out.write_band(1, mask * np.uint8(255))
+        bounds = out.bounds
+
+    compressed_filename = map_sisid_breeding_to_filename(range_dict['sisid'],
+                                                         range_dict['breeding'],
+                                                         False)
+    compressed_file_path = os.path.join(raster_dir_path, compressed_filename)
+    _compress_raster(uncompressed_file_path, compressed_file_path)
+    os.remove(uncompressed_file_path)
+    if os.path.exists(compressed_file_path + '.aux.xml'):
+        os.remove(compressed_file_path + '.aux.xml')
+
+    return compressed_filename, int(np.count_nonzero(mask)), width * height, \
+        tuple(bounds)
+
+
+def _normalise_range_rasters(range_dicts, raster_dir_path):
+    """Normalise a batch of range map rasters in parallel.
+
+    :param range_dicts: A list of dictionaries describing the rasters, as returned
+        by _read_manifest.
+    :param raster_dir_path: Path to the directory to write the rasters to.
+    :return: A list of tuples describing the normalised rasters, in the same format
+        as those returned by _rasterise_gdf in the preprocessor. Invalid rasters are
+        left out.
+    """
+    if NO_RASTERISATION_WORKERS > 1 and len(range_dicts) > 1:
+        pool = _get_rasterisation_pool()
+        futures = [pool.submit(_normalise_range_raster, raster_dir_path, range_dict)
+                   for range_dict in range_dicts]
+        results = [future.result() for future in futures]
+    else:
+        results = [_normalise_range_raster(raster_dir_path, range_dict)
+                   for range_dict in range_dicts]
+
+    sci_name_raster_filename_mapping = []
+    for range_dict, result in zip(range_dicts, results):
+        if isinstance(result, str):
+            print_w_timestamp('Skipping %s (%s): %s' %
+                              (range_dict['sci_name'], range_dict['breeding'],
+                               result))
+            continue
+
+        compressed_filename, no_range_pixels, no_pixels, bounds = result
+        bbox_area_km2 = compute_bbox_area_km2(bounds, not RASTER_CRS_IS_GEOGRAPHIC)
+        sci_name_raster_filename_mapping.append(
+            (range_dict['sci_name'], compressed_filename, no_range_pixels,
+             bbox_area_km2,
+             estimate_range_area_km2(bbox_area_km2, no_range_pixels, no_pixels)))
+
+    return sci_name_raster_filename_mapping
+
+
+def preprocess_rasters(range_rasters_path, manifest_path, resume=False):
+    """Normalise, compress and upload range map rasters to GEE instead of generating
+    them from a geodatabase. The ranges aren't filtered by forest dependency,
+    presence, origin or season: every range in the manifest is analysed.
+    Pre-processing can be cancelled between batches (see
+    progress.request_cancellation).
+
+    :param range_rasters_path: Path to a directory of range map rasters, to a VRT
+        in which each band is a range map or to a mask store. The rasters may be in
+        any CRS and of any data type. Nonzero pixels are inside the range.
+    :param manifest_path: Path to a CSV file saying which species and season each
+        raster is for. See _read_manifest. Optional for a mask store, which says
+        this itself.
+    :param resume: Whether to carry on from where an earlier attempt at the current
+        run stopped, skipping the rasters which are already in the run's scientific
+        name, raster filename mapping file.
+    :return: The GEE path to the ImageCollection the rasters were uploaded to.
+    """
+    run = get_run()
+    os.makedirs(run.work_dir_path, exist_ok=True)
+    preprocessed_ranges = set()
+    if resume:
+        preprocessed_ranges = _read_preprocessed_ranges()
+    elif os.path.exists(run.sci_name_raster_filename_mapping_fp):
+        os.remove(run.sci_name_raster_filename_mapping_fp)
+
+    if is_mask_store(range_rasters_path):
+        manifest = _read_mask_store_manifest(range_rasters_path, manifest_path)
+    else:
+        manifest = _read_manifest(manifest_path, range_rasters_path)
+    if run.shard is not None:
+        no_ranges = len(manifest)
+        manifest = [range_dict for range_dict in manifest
+                    if run.includes_sisid(range_dict['sisid'])]
+        print_w_timestamp('%d of %d range maps are in %s.' % (len(manifest),
+                                                              no_ranges,
+                                                              run.shard_name))
+    if preprocessed_ranges:
+        no_ranges = len(manifest)
+        manifest = [range_dict for range_dict in manifest
+                    if (range_dict['sisid'], range_dict['breeding'])
+                    not in preprocessed_ranges]
+        print_w_timestamp('Resuming: %d of %d range maps are still to be '
+                          'pre-processed.' % (len(manifest), no_ranges))
+
+    range_map_ic_gee_path = _get_run_range_map_ic(resume)
+    raster_dir_path = run.raster_dir_path
+
+    try:
+        for batch_start in range(0, len(manifest), RASTER_BATCH_SIZE):
+            report_progress('preprocess', batch_start, len(manifest), 'ranges')
+            check_cancelled()
+            batch = manifest[batch_start:batch_start + RASTER_BATCH_SIZE]
+            print_w_timestamp('Normalising range rasters %d-%d of %d.' %
+                              (batch_start, batch_start + len(batch) - 1,
+                               len(manifest)))
+            _clear_dir(raster_dir_path)
+
+            with span('normalise', ranges=len(batch)):
+                sci_name_raster_filename_mapping = _normalise_range_rasters(
+                    batch, raster_dir_path)
+
+            if sci_name_raster_filename_mapping:
+                with span('upload'):
+                    print_w_timestamp('Uploading to Google Earth Engine...')
+                    _upload_to_gee(raster_dir_path, range_map_ic_gee_path)
+                    print('Done.')
+            _append_to_sci_name_raster_filename_mapping(
+                sci_name_raster_filename_mapping)
+        report_progress('preprocess', len(manifest), len(manifest), 'ranges')
+    finally:
+        _shut_down_rasterisation_pool()
+        shutil.rmtree(raster_dir_path, ignore_errors=True)
+        with span('wait.uploads'):
+            _wait_for_uploads_and_empty_bucket()
+
+    return range_map_ic_gee_path
@@ -0,0 +1,239 @@
+# Every run of the pipeline has a run ID. Everything a run creates - the
+# ImageCollection its rasters are uploaded to, its prefixes in the GCS buckets, the
+# descriptions of its GEE tasks and its local working directory - is named after it,
+# so that several runs, or several shards of one run on different machines, can
+# share an account and buckets without clobbering or waiting for each other.
+#
+# A run can be split into shards with --shard i/N. Species are assigned to shards
+# by a stable hash of their SISIDs, so every machine agrees on the partition
+# without communicating, and the shards' results can be merged afterwards.
+
+import hashlib
+import os
+import random
+import re
+import string
+from datetime import datetime
+
+MODULE_PARENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+RUNS_DIR_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'runs')
+SHARD_NAME_PATTERN = re.compile(r'^shard-(\d+)-of-(\d+)$')
+
+
+def _generate_run_id():
+    """Generate a run ID from the current date and time and a random suffix, so
+    that runs started at the same time on different machines get different IDs.
+
+    :return: A string, e.g. "20201019T120000-abcd".
+    """
+    return '%s-%s' % (datetime.now().strftime('%Y%m%dT%H%M%S'),
+                      ''.join(random.choices(string.ascii_lowercase, k=4)))
+
+
+def parse_shard(shard_str):
+    """Parse a shard specification.
+
+    :param shard_str: A string of the form "i/N", where N is the number of shards
+        and i, between 1 and N, is the number of this shard.
+    :return: A tuple (i, N).
+    """
+    try:
+        shard_no, no_shards = (int(part) for part in shard_str.split('/'))
+    except ValueError:
+        raise ValueError('The shard "%s" isn\'t of the form "i/N".' % shard_str)
+    if not 1 <= shard_no <= no_shards:
+        raise ValueError('The shard number in "%s" must be between 1 and the number '
+                         'of shards.' % shard_str)
+    return shard_no, no_shards
+
+
+def parse_shard_name(shard_name):
+    """Parse the name of a shard, as given by Run.shard_name.
+
+    :param shard_name: A string, e.g. "shard-1-of-4".
+    :return: A tuple (i, N), or None if shard_name isn't the name of a shard.
+    """
+    match = SHARD_NAME_PATTERN.match(shard_name)
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_shard_no(sisid, no_shards):
+    """Get the number of the shard a species belongs to. This only depends on the
+    SISID, so it's the same on every machine and in every Python process.
+
+    :param sisid: The SISID of the species.
+    :param no_shards: The number of shards.
+    :return: A shard number between 1 and no_shards.
+    """
+    digest = hashlib.sha1(str(int(sisid)).encode()).hexdigest()
+    return int(digest, 16) % no_shards + 1
+
+
+class Run(object):
+    """The run ID and shard of a run, and the names derived from them."""
+
+    def __init__(self, run_id=None, shard=None):
+        """Initialise a Run.
+
+        :param run_id: The run ID. Only letters, digits and "-" may be used. Every
+            shard of a run must be given the same run ID. If None, one is
+            generated.
+        :param shard: Optional tuple (i, N), as returned by parse_shard. If given,
+            only the species in shard i of N are analysed.
+        """
+        self.run_id = run_id or _generate_run_id()
+        # "_" is reserved for separating the run ID from the shard name and
+        # task tags from the rest of task descriptions. See owns_task.
+        if not all(char.isalnum() or char == '-' for char in self.run_id):
+            raise ValueError('The run ID "%s" may only contain letters, digits and '
+                             '"-".' % self.run_id)
+        self.shard = shard
+
+    @property
+    def shard_name(self):
+        """The name of the shard, e.g. "shard-1-of-4", or None if the run isn't
+        sharded."""
+        if self.shard is None:
+            return None
+        return 'shard-%d-of-%d' % self.shard
+
+    @property
+    def label(self):
+        """A name for the run which is unique to the shard, e.g. to name its GEE
+        assets after or to partition the results store by."""
+        if self.shard is None:
+            return self.run_id
+        return '%s_%s' % (self.run_id, self.shard_name)
+
+    @property
+    def task_tag(self):
+        """The prefix of the descriptions of the run's GEE tasks, and of the names
+        of its GEE assets."""
+        return self.label + '__'
+
+    @property
+    def bucket_prefix(self):
+        """The prefix of everything the run writes to a GCS bucket. Every shard's
+        prefix starts with the run ID, so that the shards can be merged."""
+        if self.shard is None:
+            return self.run_id
+        return '%s/%s' % (self.run_id, self.shard_name)
+
+    @property
+    def work_dir_path(self):
+        """Path to the run's local working directory."""
+        if self.shard is None:
+            return os.path.join(RUNS_DIR_PATH, self.run_id)
+        return os.path.join(RUNS_DIR_PATH, self.run_id, self.shard_name)
+
+    @property
+    def sci_name_raster_filename_mapping_fp(self):
+        """Path to the run's scientific name, raster filename mapping file."""
+        return os.path.join(self.work_dir_path,
+                            'sci_name_raster_filename_mapping.csv')
+
+    @property
+    def raster_dir_path(self):
+        """Path to the directory the run's rasters are written to before they're
+        uploaded."""
+        return os.path.join(self.work_dir_path, 'rasters')
+
+    @property
+    def range_map_ic_fp(self):
+        """Path to the file holding the GEE path to the ImageCollection the run's
+        rasters are uploaded to."""
+        return os.path.join(self.work_dir_path, 'range_map_ic.txt')
+
+    @property
+    def mask_export_fp(self):
+        """Path to the mask store the run's range map masks are exported to, if
+        preprocessor.EXPORT_MASK_STORE is true."""
+        return os.path.join(self.work_dir_path, 'range_masks.gfcmask')
+
+    @property
+    def simplification_report_fp(self):
+        """Path to the report of how simplifying the run's range maps changed them."""
+        return os.path.join(self.work_dir_path, 'simplification_report.csv')
+
+    @property
+    def geometry_report_fp(self):
+        """Path to the report of the run's range map geometries which were repaired."""
+        return os.path.join(self.work_dir_path, 'geometry_report.csv')
+
+    @property
+    def failed_ranges_report_fp(self):
+        """Path to the report of the range maps which the run couldn't analyse."""
+        return os.path.join(self.work_dir_path, 'failed_ranges.csv')
+
+    @property
+    def results_dir_path(self):
+        """Path to the directory the run's results are downloaded to."""
+        return os.path.join(self.work_dir_path, 'gee-results')
+
+    def get_output_file_path(self, file_path):
+        """Get the path to write an output file to. The outputs of a shard are
+        written to its working directory instead of the usual place, so that shards
+        running on the same machine don't overwrite each other's outputs.
+
+        :param file_path: The usual path to the output file.
+        :return: A path.
+        """
+        if self.shard is None:
+            return file_path
+        return os.path.join(self.work_dir_path, os.path.basename(file_path))
+
+    def get_task_description(self, name):
+        """Get the description to give a GEE task started by the run.
+
+        :param name: A name for the task, e.g. the asset ID of a range map.
+        :return: A description which identifies the task as the run's.
+        """
+        return self.task_tag + name
+
+    def owns_task(self, task):
+        """Check whether a GEE task was started by the run. Export tasks are
+        identified by their descriptions, which start with the run's task tag.
+        Ingestion tasks are identified by the asset IDs in their descriptions, as
+        the run's assets are in an ImageCollection whose name starts with the tag.
+
+        :param task: A task dictionary, as returned by the list_tasks method of a
+            backend.
+        :return: True if the task was started by the run.
+        """
+        description = task.get('description', '')
+        return description.startswith(self.task_tag) or \
+            '/' + self.task_tag in description
+
+    def includes_sisid(self, sisid):
+        """Check whether a species is analysed in this run.
+
+        :param sisid: The SISID of the species.
+        :return: True if the run isn't sharded or the species is in its shard.
+        """
+        if self.shard is None:
+            return True
+        shard_no, no_shards = self.shard
+        return get_shard_no(sisid, no_shards) == shard_no
+
+
+_RUN = Run()
+
+
+def get_run():
+    """Get the current run.
+
+    :return: A Run.
+    """
+    return _RUN
+
+
+def set_run(run):
+    """Set the current run. Its working directory is created if it doesn't exist.
+
+    :param run: A Run.
+    """
+    global _RUN
+    _RUN = run
+    os.makedirs(run.work_dir_path, exist_ok=True)
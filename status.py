@@ -0,0 +1,132 @@
+# Reports on the state of runs from their working directories and, optionally,
+# their GEE tasks. Only the task listing needs the backend, so the rest takes
+# milliseconds.
+
+import csv
+import os
+from collections import Counter
+
+from runs import RUNS_DIR_PATH, Run, parse_shard_name
+
+
+def list_run_ids():
+    """List the IDs of the runs which have a working directory on this machine.
+
+    :return: A sorted list of run IDs.
+    """
+    if not os.path.isdir(RUNS_DIR_PATH):
+        return []
+    return sorted(name for name in os.listdir(RUNS_DIR_PATH)
+                  if os.path.isdir(os.path.join(RUNS_DIR_PATH, name)))
+
+
+def _list_shards(run_id):
+    """List the shards of a run which have a working directory on this machine.
+
+    :param run_id: The run ID.
+    :return: A sorted list of tuples (i, N), as returned by runs.parse_shard.
+    """
+    run_dir_path = os.path.join(RUNS_DIR_PATH, run_id)
+    shards = []
+    for name in os.listdir(run_dir_path):
+        shard = parse_shard_name(name)
+        if shard:
+            shards.append(shard)
+    return sorted(shards)
+
+
+def _count_csv_rows(file_path, header=False):
+    """Count the rows of a CSV file.
+
+    :param file_path: Path to the file.
+    :param header: Whether the file has a header row, which isn't counted.
+    :return: The number of rows, or 0 if the file doesn't exist.
+    """
+    if not os.path.exists(file_path):
+        return 0
+    with open(file_path, newline='') as csv_file:
+        no_rows = sum(1 for _ in csv.reader(csv_file))
+    return max(0, no_rows - 1) if header else no_rows
+
+
+def get_run_status(run):
+    """Describe the state of a run from its working directory.
+
+    :param run: A Run.
+    :return: A dictionary with the keys "run", "range_map_ic", "ranges_preprocessed",
+        "failed_ranges", "repaired_geometries" and "mask_export". "range_map_ic" is
+        None if the run hasn't started uploading range maps.
+    """
+    range_map_ic_gee_path = None
+    if os.path.exists(run.range_map_ic_fp):
+        with open(run.range_map_ic_fp) as range_map_ic_file:
+            range_map_ic_gee_path = range_map_ic_file.read().strip()
+
+    return {'run': run.label,
+            'range_map_ic': range_map_ic_gee_path,
+            'ranges_preprocessed':
+                _count_csv_rows(run.sci_name_raster_filename_mapping_fp),
+            'failed_ranges': _count_csv_rows(run.failed_ranges_report_fp, True),
+            'repaired_geometries': _count_csv_rows(run.geometry_report_fp, True),
+            'mask_export': os.path.exists(run.mask_export_fp)}
+
+
+def count_run_tasks(run):
+    """Count a run's GEE tasks by stage and state, using the current backend.
+
+    :param run: A Run.
+    :return: A Counter mapping tuples (stage, state) to numbers of tasks, in which
+        stage is "export" for analysis tasks and "ingest" for upload tasks.
+    """
+    from backends import get_backend
+
+    task_counts = Counter()
+    for task in get_backend().list_tasks():
+        if run.owns_task(task):
+            stage = 'export' if task['description'].startswith(run.task_tag) \
+                else 'ingest'
+            task_counts[(stage, task['state'])] += 1
+    return task_counts
+
+
+def print_status(run_id=None, shard=None, show_tasks=False):
+    """Print the state of a run, of each of its shards or, if no run ID is given, a
+    list of the runs on this machine.
+
+    :param run_id: Optional run ID.
+    :param shard: Optional tuple (i, N), as returned by runs.parse_shard. If None
+        and the run is sharded, every shard with a working directory on this
+        machine is described.
+    :param show_tasks: Whether to also count the run's GEE tasks by state. This
+        needs the backend to be set up, e.g. by main.start_run.
+    """
+    if run_id is None:
+        for listed_run_id in list_run_ids():
+            print(listed_run_id)
+        return
+
+    if not os.path.isdir(os.path.join(RUNS_DIR_PATH, run_id)):
+        raise ValueError('There\'s no run %s on this machine.' % run_id)
+
+    if shard is not None:
+        runs = [Run(run_id, shard)]
+    else:
+        runs = [Run(run_id, listed_shard) for listed_shard in _list_shards(run_id)] \
+            or [Run(run_id)]
+
+    for run in runs:
+        run_status = get_run_status(run)
+        print('%s:' % run_status['run'])
+        print('  Range map ImageCollection: %s' %
+              (run_status['range_map_ic'] or 'not created yet'))
+        print('  Range maps pre-processed: %d' % run_status['ranges_preprocessed'])
+        print('  Range maps which failed: %d' % run_status['failed_ranges'])
+        print('  Geometries repaired: %d' % run_status['repaired_geometries'])
+        print('  Mask store export: %s' %
+              (run.mask_export_fp if run_status['mask_export'] else 'none'))
+        if show_tasks:
+            task_counts = count_run_tasks(run)
+            if not task_counts:
+                print('  No GEE tasks.')
+            for (stage, state), no_tasks in sorted(task_counts.items()):
+                print('  %s tasks %s: %d' % (stage.capitalize(), state, no_tasks))
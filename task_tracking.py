@@ -0,0 +1,218 @@
+# Tracks the GEE task which ingests each range map raster and the task which exports
+# the results for each range map, so that failed tasks can be resubmitted instead of
+# their ranges silently going missing from the results.
+#
+# Failures are classified from their error messages. Tasks which failed for
+# transient reasons or because a quota was exceeded are resubmitted after an
+# exponentially increasing delay. Exports which ran out of memory or time are
+# resubmitted with a more conservative setting (see gfc_calculator). Ranges whose
+# tasks still fail after MAX_NO_ATTEMPTS attempts are listed in a report.
+
+import csv
+import os
+import time
+from collections import OrderedDict
+
+from backends import get_backend
+from utilities import map_filename_to_sisid_breeding, print_w_timestamp, \
+    wait_until_all_tasks_complete
+
+INGEST = 'ingest'
+EXPORT = 'export'
+
+QUOTA = 'quota'
+MEMORY = 'memory'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+# Failures are classified by the first class with a pattern which occurs in the
+# error message. Failures which don't match any pattern are treated as transient.
+# Quota errors are matched first, as some of them, e.g. "Too many concurrent
+# aggregations", could otherwise be mistaken for a lack of memory, and resubmitted at
+# a coarser scale.
+FAILURE_PATTERNS = [
+    (QUOTA, ('quota', 'too many tasks', 'too many concurrent', 'rate limit')),
+    (MEMORY, ('memory limit', 'out of memory', 'too many pixels',
+              'computation timed out')),
+    (PERMANENT, ('not found', 'does not exist', 'permission', 'invalid',
+                 'cannot be parsed', 'cancelled'))]
+RETRYABLE_FAILURE_CLASSES = (QUOTA, MEMORY, TRANSIENT)
+
+FAILED_STATES = ('FAILED', 'CANCELLED')
+MAX_NO_ATTEMPTS = 4
+# The delay before the first resubmission of a task, which doubles with every
+# attempt. Tasks which hit a quota wait QUOTA_BACKOFF_FACTOR times longer.
+INITIAL_BACKOFF_S = 30
+QUOTA_BACKOFF_FACTOR = 4
+
+FAILED_RANGES_REPORT_FIELDS = ['stage', 'sisid', 'breeding', 'asset_id',
+                               'failure_class', 'attempts', 'error_message']
+
+
+class _TrackedTask(object):
+
+    def __init__(self, stage, asset_id, task_id, resubmit):
+        """Initialise a _TrackedTask.
+
+        :param stage: INGEST or EXPORT.
+        :param asset_id: GEE asset ID of the range map the task is for.
+        :param task_id: The ID of the task, or None if it isn't known. If None, the
+            task is found by looking for asset_id in task descriptions.
+        :param resubmit: A function which resubmits the task and returns the ID of
+            the new task. It's passed a list of the classes of the failures so far.
+        """
+        self.stage = stage
+        self.asset_id = asset_id
+        self.task_id = task_id
+        self.resubmit = resubmit
+        self.no_attempts = 1
+        self.failure_classes = []
+        self.error_message = None
+        self.given_up = False
+
+
+# Maps (stage, asset ID) to _TrackedTask objects.
+_tracked_tasks = OrderedDict()
+
+
+def clear_tracked_tasks():
+    """Stop tracking every task, e.g. at the start of a run."""
+    _tracked_tasks.clear()
+
+
+def track_task(stage, asset_id, task_id, resubmit):
+    """Start tracking a task which has just been submitted.
+
+    :param stage: INGEST or EXPORT.
+    :param asset_id: GEE asset ID of the range map the task is for.
+    :param task_id: The ID of the task, or None if it isn't known.
+    :param resubmit: See _TrackedTask.
+    """
+    _tracked_tasks[(stage, asset_id)] = _TrackedTask(stage, asset_id, task_id,
+                                                     resubmit)
+
+
+def classify_failure(error_message):
+    """Classify the failure of a task from its error message.
+
+    :param error_message: The error message reported for the task, or None.
+    :return: QUOTA, MEMORY, TRANSIENT or PERMANENT.
+    """
+    error_message = (error_message or '').lower()
+    for failure_class, patterns in FAILURE_PATTERNS:
+        if any(pattern in error_message for pattern in patterns):
+            return failure_class
+    return TRANSIENT
+
+
+def _find_task(tracked_task, tasks_by_id, tasks):
+    """Find the current state of a tracked task.
+
+    :param tracked_task: A _TrackedTask.
+    :param tasks_by_id: A dictionary mapping task IDs to task dictionaries.
+    :param tasks: A list of task dictionaries, as returned by the list_tasks method
+        of a backend, most recent first.
+    :return: A task dictionary, or None if the task can't be found.
+    """
+    if tracked_task.task_id is not None:
+        return tasks_by_id.get(tracked_task.task_id)
+    for task in tasks:
+        if tracked_task.asset_id in task.get('description', ''):
+            return task
+    return None
+
+
+def wait_for_tracked_tasks(stage):
+    """Wait until every tracked task of a stage has finished, resubmitting tasks
+    which fail for reasons which might not recur, with exponential backoff. Waiting
+    for EXPORT tasks can be cancelled (see progress.request_cancellation), as they
+    carry on running and are picked up again when the run is resumed. Waiting for
+    INGEST tasks can't, as the rasters they read are deleted once they've finished.
+
+    :param stage: INGEST or EXPORT.
+    :return: The number of tasks of the stage which failed for good.
+    """
+    backend = get_backend()
+    while True:
+        wait_until_all_tasks_complete('wait.' + stage, cancellable=stage == EXPORT)
+
+        tasks = backend.list_tasks()
+        tasks_by_id = {task['id']: task for task in tasks}
+        tasks = sorted(tasks, key=lambda task: task.get('start_time') or 0,
+                       reverse=True)
+
+        tasks_to_resubmit = []
+        for tracked_task in _tracked_tasks.values():
+            if tracked_task.stage != stage or tracked_task.given_up:
+                continue
+            task = _find_task(tracked_task, tasks_by_id, tasks)
+            if task is None or task['state'] not in FAILED_STATES:
+                continue
+
+            tracked_task.error_message = task.get('error_message')
+            failure_class = classify_failure(tracked_task.error_message)
+            tracked_task.failure_classes.append(failure_class)
+            if failure_class in RETRYABLE_FAILURE_CLASSES and \
+                    tracked_task.no_attempts < MAX_NO_ATTEMPTS:
+                tasks_to_resubmit.append(tracked_task)
+            else:
+                tracked_task.given_up = True
+                print_w_timestamp('The %s task for %s failed (%s): %s' %
+                                  (stage, tracked_task.asset_id, failure_class,
+                                   tracked_task.error_message))
+
+        if not tasks_to_resubmit:
+            break
+
+        backoff_s = max(INITIAL_BACKOFF_S * 2 ** (tracked_task.no_attempts - 1) *
+                        (QUOTA_BACKOFF_FACTOR
+                         if tracked_task.failure_classes[-1] == QUOTA else 1)
+                        for tracked_task in tasks_to_resubmit)
+        print_w_timestamp('Resubmitting %d failed %s tasks in %d seconds...' %
+                          (len(tasks_to_resubmit), stage, backoff_s))
+        time.sleep(backoff_s)
+
+        for tracked_task in tasks_to_resubmit:
+            tracked_task.task_id = tracked_task.resubmit(
+                tracked_task.failure_classes)
+            tracked_task.no_attempts += 1
+
+    return len(get_failed_asset_ids(stage))
+
+
+def get_failed_asset_ids(stage):
+    """Get the asset IDs of the range maps whose tasks of a stage failed for good.
+
+    :param stage: INGEST or EXPORT.
+    :return: A set of GEE asset IDs.
+    """
+    return {tracked_task.asset_id for tracked_task in _tracked_tasks.values()
+            if tracked_task.stage == stage and tracked_task.given_up}
+
+
+def write_failed_ranges_report(report_file_path):
+    """Write a report of the range maps whose tasks failed for good. Nothing is
+    written if none did.
+
+    :param report_file_path: Path to write the report to.
+    :return: The number of range maps in the report.
+    """
+    failed_tasks = [tracked_task for tracked_task in _tracked_tasks.values()
+                    if tracked_task.given_up]
+    if not failed_tasks:
+        return 0
+
+    with open(report_file_path, 'w', newline='') as report_file:
+        dw = csv.DictWriter(report_file, fieldnames=FAILED_RANGES_REPORT_FIELDS)
+        dw.writeheader()
+        for tracked_task in failed_tasks:
+            sisid_breeding_dict = map_filename_to_sisid_breeding(
+                os.path.basename(tracked_task.asset_id) + '.tif')
+            dw.writerow({'stage': tracked_task.stage,
+                         'sisid': sisid_breeding_dict['sisid'],
+                         'breeding': sisid_breeding_dict['breeding'],
+                         'asset_id': tracked_task.asset_id,
+                         'failure_class': tracked_task.failure_classes[-1],
+                         'attempts': tracked_task.no_attempts,
+                         'error_message': tracked_task.error_message})
+
+    return len(failed_tasks)
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+from affine import Affine
+
+from mask_store import MaskStore, MaskStoreWriter
+
+TRANSFORM = Affine(0.1, 0, 10, 0, -0.1, 20)
+
+
+def _create_packed_mask(seed):
+    mask = np.random.default_rng(seed).integers(0, 2, (5, 11), dtype=np.uint8)
+    return mask, np.packbits(mask, axis=1)
+
+
+def test_reopened_store_keeps_masks_if_writer_is_not_closed(tmp_path):
+    store_path = str(tmp_path / 'range_masks.gfcmask')
+    mask, packed_mask = _create_packed_mask(0)
+    with MaskStoreWriter(store_path) as writer:
+        writer.add(1, 1, 'Species one', packed_mask, mask.shape[1], TRANSFORM,
+                   mask.sum())
+
+    # Simulate a crash after a mask has been added to the reopened store.
+    writer = MaskStoreWriter(store_path)
+    _, other_packed_mask = _create_packed_mask(1)
+    writer.add(2, 0, 'Species two', other_packed_mask, mask.shape[1], TRANSFORM, 1)
+    writer._file.close()
+
+    store = MaskStore(store_path)
+    assert store.keys() == [(1, 1)]
+    np.testing.assert_array_equal(store.read_mask(1, 1), mask)
+
+
+def test_reopened_store_appends_masks(tmp_path):
+    store_path = str(tmp_path / 'range_masks.gfcmask')
+    masks = [_create_packed_mask(seed) for seed in range(3)]
+    for sisid, (mask, packed_mask) in enumerate(masks):
+        with MaskStoreWriter(store_path) as writer:
+            writer.add(sisid, 1, 'Species', packed_mask, mask.shape[1], TRANSFORM,
+                       mask.sum())
+
+    store = MaskStore(store_path)
+    assert store.keys() == [(0, 1), (1, 1), (2, 1)]
+    for sisid, (mask, _) in enumerate(masks):
+        np.testing.assert_array_equal(store.read_mask(sisid, 1), mask)
+
+
+def test_reopening_store_does_not_grow_it_quadratically(tmp_path):
+    no_reopens = 50
+    masks = [_create_packed_mask(seed) for seed in range(no_reopens)]
+    single_writer_store_path = str(tmp_path / 'single_writer.gfcmask')
+    with MaskStoreWriter(single_writer_store_path) as writer:
+        for sisid, (mask, packed_mask) in enumerate(masks):
+            writer.add(sisid, 1, 'Species', packed_mask, mask.shape[1], TRANSFORM,
+                       mask.sum())
+
+    store_path = str(tmp_path / 'reopened.gfcmask')
+    for sisid, (mask, packed_mask) in enumerate(masks):
+        with MaskStoreWriter(store_path) as writer:
+            writer.add(sisid, 1, 'Species', packed_mask, mask.shape[1], TRANSFORM,
+                       mask.sum())
+
+    # Each reopen only adds a little to the index, rather than a copy of it.
+    assert os.path.getsize(store_path) < \
+        os.path.getsize(single_writer_store_path) + no_reopens * 64
+    store = MaskStore(store_path)
+    assert store.keys() == [(sisid, 1) for sisid in range(no_reopens)]
+    for sisid, (mask, _) in enumerate(masks):
+        np.testing.assert_array_equal(store.read_mask(sisid, 1), mask)
@@ -0,0 +1,68 @@
+import os
+from configparser import ConfigParser
+
+import pytest
+
+from backends import LocalBackend, get_backend, set_backend
+from postprocessor import MODULE_PARENT_DIR_PATH, _create_results_dfs, \
+    _get_results_fields, _write_results_store, load_results, merge_shards
+
+GFC_FINAL_YR = 2003
+
+
+def _create_results_dicts(sisids):
+    fields = _get_results_fields(GFC_FINAL_YR)
+    return [dict({field: 1.0 for field in fields[3:]}, sisid=str(sisid),
+                 sci_name='species %d' % sisid, breeding='1')
+            for sisid in sisids], fields
+
+
+def _write_results(results_store_path, sisids, run_id, gfc_version):
+    results_dicts, fields = _create_results_dicts(sisids)
+    wide_df, long_df = _create_results_dfs(results_dicts, fields, GFC_FINAL_YR,
+                                           run_id, gfc_version)
+    _write_results_store(wide_df, long_df, str(results_store_path))
+
+
+def test_load_results_filters_numeric_partition_values(tmp_path):
+    _write_results(tmp_path, [1, 2], '12345', '2019')
+    _write_results(tmp_path, [3], '67890', '2020')
+
+    results_df = load_results(str(tmp_path), run_id=12345, gfc_version=2019)
+
+    assert sorted(results_df['sisid']) == [1, 2]
+    assert set(results_df['gfc_version']) == {'2019'}
+    assert set(results_df['run_id']) == {'12345'}
+    assert len(load_results(str(tmp_path), long_format=True,
+                            gfc_version='2020')) == GFC_FINAL_YR - 2000 + 1
+
+
+def test_rewriting_results_replaces_partition(tmp_path):
+    _write_results(tmp_path, [1, 2], 'run-a', '2019')
+    _write_results(tmp_path, [3], 'run-b', '2019')
+    _write_results(tmp_path, [1, 2], 'run-a', '2019')
+
+    assert sorted(load_results(str(tmp_path), run_id='run-a')['sisid']) == [1, 2]
+    assert sorted(load_results(str(tmp_path))['sisid']) == [1, 2, 3]
+
+
+def test_merging_shards_requires_every_shard(tmp_path):
+    config_parser = ConfigParser()
+    config_parser.read(os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini'))
+    run_dir_path = os.path.join(str(tmp_path), 'gcs',
+                                config_parser['DEFAULT']['GCS bucket name for results'],
+                                'sharded-run')
+    for shard_name in ('shard-1-of-4', 'shard-3-of-4'):
+        os.makedirs(os.path.join(run_dir_path, shard_name))
+
+    backend = get_backend()
+    set_backend(LocalBackend(str(tmp_path)))
+    try:
+        with pytest.raises(ValueError, match='shards 2, 4'):
+            merge_shards('sharded-run', 'gl_table.csv')
+
+        os.makedirs(os.path.join(run_dir_path, 'shard-2-of-3'))
+        with pytest.raises(ValueError, match='disagree'):
+            merge_shards('sharded-run', 'gl_table.csv')
+    finally:
+        set_backend(backend)
@@ -0,0 +1,42 @@
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+import preprocessor
+from gfc_calculator import _choose_scale
+
+
+def _write_dem(dem_path):
+    # The altitude rises from 0 m in the west to 4000 m in the east.
+    dem = np.tile(np.linspace(0, 4000, 400, dtype=np.float32), (400, 1))
+    with rasterio.open(dem_path, 'w', driver='GTiff', width=400, height=400, count=1,
+                       dtype='float32', crs='EPSG:4326',
+                       transform=from_origin(0, 4, 0.01, 0.01)) as dst:
+        dst.write(dem, 1)
+
+
+def test_pre_clipping_does_not_change_analysis_scale(tmp_path, monkeypatch):
+    dem_path = str(tmp_path / 'dem.tif')
+    _write_dem(dem_path)
+    monkeypatch.setattr(preprocessor, 'LOCAL_DEM_PATH', dem_path)
+    monkeypatch.setattr(preprocessor, 'NO_RASTERISATION_WORKERS', 1)
+    dissolved = gpd.GeoDataFrame({'SISID': [1], 'BREEDING': [1],
+                                  'SCINAME': ['Species one']},
+                                 geometry=[box(0.1, 0.1, 3.9, 3.9)], crs='EPSG:4326')
+
+    mappings = []
+    for alt_lims_dict in (None, {'Species one': (0, 500)}):
+        raster_dir_path = tmp_path / ('clipped' if alt_lims_dict else 'unclipped')
+        raster_dir_path.mkdir()
+        mappings.append(preprocessor._rasterise_gdf(dissolved, str(raster_dir_path),
+                                                    alt_lims_dict=alt_lims_dict)[0])
+    unclipped_mapping, clipped_mapping = mappings
+
+    # Clipping removed most of the range from the raster...
+    assert clipped_mapping[2] < unclipped_mapping[2] / 4
+    assert clipped_mapping[3] < unclipped_mapping[3] / 4
+    # ...but not from the area the scale is chosen from.
+    assert clipped_mapping[4] == unclipped_mapping[4]
+    assert _choose_scale(clipped_mapping[4]) == _choose_scale(unclipped_mapping[4])
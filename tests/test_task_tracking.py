@@ -0,0 +1,13 @@
+from task_tracking import MEMORY, PERMANENT, QUOTA, TRANSIENT, classify_failure
+
+
+def test_concurrent_aggregations_are_a_quota_failure():
+    assert classify_failure('Too many concurrent aggregations.') == QUOTA
+
+
+def test_classify_failure():
+    assert classify_failure('User memory limit exceeded.') == MEMORY
+    assert classify_failure('Computation timed out.') == MEMORY
+    assert classify_failure('Asset not found.') == PERMANENT
+    assert classify_failure('Internal error.') == TRANSIENT
+    assert classify_failure(None) == TRANSIENT
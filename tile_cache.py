@@ -0,0 +1,167 @@
+# An on-disk cache of decoded blocks of local rasters, such as the GFC layers and the
+# DEM, so that each block is only decompressed (and, for the DEM, reprojected) once.
+#
+# Each block is saved as an uncompressed .npy file named after a hash of its key and
+# is read back by memory-mapping it, so several processes reading the same block
+# share one copy of it in the page cache. A file's modification time records when it
+# was last used, and the least recently used blocks are deleted once the cache is
+# bigger than its size cap. The cache is emptied whenever its version, e.g. the GFC
+# asset ID, changes.
+
+import hashlib
+import os
+from configparser import ConfigParser
+
+import numpy as np
+
+MODULE_PARENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+CONFIG_FILE_PATH = os.path.join(MODULE_PARENT_DIR_PATH, 'config.ini')
+
+config_parser = ConfigParser()
+config_parser.read(CONFIG_FILE_PATH)
+
+TILE_CACHE_DIR_PATH = config_parser['DEFAULT'].get('Local tile cache path', '') or \
+    os.path.join(MODULE_PARENT_DIR_PATH, 'tile-cache')
+# 0 turns the cache off.
+TILE_CACHE_SIZE_MB = config_parser['DEFAULT'].getfloat('Local tile cache size (MB)',
+                                                       10000)
+# The blocks are decoded from the local copies of these datasets, so they're
+# invalidated when either changes.
+TILE_CACHE_VERSION = '%s|%s' % (
+    config_parser['DEFAULT'].get('GFC image GEE asset ID', ''),
+    config_parser['DEFAULT'].get('Final year covered by GFC dataset', ''))
+VERSION_FILENAME = 'version.txt'
+TILE_EXTENSION = '.npy'
+
+_TILE_CACHE = None
+
+
+def _remove_tile(tile_fp):
+    """Delete a cached block, if no other process has already.
+
+    :param tile_fp: Path to the block.
+    """
+    try:
+        os.remove(tile_fp)
+    except OSError:
+        # It's already gone or, on Windows, another process has it mapped.
+        pass
+
+
+def get_source_key(path):
+    """Identify a local raster by its path, size and modification time, so that
+    blocks of a file which has since changed aren't used.
+
+    :param path: Path to a raster.
+    :return: A tuple which can be used in a block's key.
+    """
+    return os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)
+
+
+class TileCache(object):
+    """An on-disk cache of decoded raster blocks."""
+
+    def __init__(self, dir_path, max_size_mb, version):
+        """Initialise a TileCache, emptying the cache if it was made for a different
+        version.
+
+        :param dir_path: Path to the directory the blocks are saved in. It's created
+            if it doesn't exist.
+        :param max_size_mb: The size the cache may grow to before blocks are evicted.
+        :param version: A string identifying the data the blocks are decoded from.
+        """
+        self._dir_path = dir_path
+        self._max_size_bytes = max_size_mb * 1e6
+        os.makedirs(dir_path, exist_ok=True)
+
+        version_fp = os.path.join(dir_path, VERSION_FILENAME)
+        cached_version = None
+        if os.path.exists(version_fp):
+            with open(version_fp) as version_file:
+                cached_version = version_file.read()
+        if cached_version != version:
+            for tile_fp in self._list_tile_fps():
+                _remove_tile(tile_fp)
+            with open(version_fp, 'w') as version_file:
+                version_file.write(version)
+
+        self._size_bytes = sum(os.path.getsize(tile_fp)
+                               for tile_fp in self._list_tile_fps())
+        # The size cap may have been lowered.
+        if self._size_bytes > self._max_size_bytes:
+            self._evict()
+
+    def _list_tile_fps(self):
+        return [os.path.join(self._dir_path, filename)
+                for filename in os.listdir(self._dir_path)
+                if filename.endswith(TILE_EXTENSION)]
+
+    def _evict(self):
+        """Delete the least recently used blocks until the cache is no bigger than
+        its size cap. Other processes may be adding blocks too, so the size is
+        recounted first."""
+        tile_fps_and_stats = []
+        for tile_fp in self._list_tile_fps():
+            try:
+                tile_fps_and_stats.append((tile_fp, os.stat(tile_fp)))
+            except OSError:
+                continue
+        tile_fps_and_stats.sort(key=lambda tile_fp_and_stat:
+                                tile_fp_and_stat[1].st_mtime)
+
+        self._size_bytes = sum(stat.st_size for _, stat in tile_fps_and_stats)
+        for tile_fp, stat in tile_fps_and_stats:
+            if self._size_bytes <= self._max_size_bytes:
+                break
+            _remove_tile(tile_fp)
+            self._size_bytes -= stat.st_size
+
+    def get(self, key, read_tile):
+        """Get a block from the cache, decoding and adding it if it isn't there.
+
+        :param key: A tuple of strings and numbers identifying the block, including
+            the source it's read from, e.g. using get_source_key.
+        :param read_tile: A function which takes no arguments and returns the block
+            as a NumPy array.
+        :return: A read-only NumPy array. If the block was already in the cache, it's
+            memory-mapped.
+        """
+        tile_fp = os.path.join(self._dir_path,
+                               hashlib.sha1(repr(key).encode('utf-8')).hexdigest() +
+                               TILE_EXTENSION)
+        try:
+            tile = np.load(tile_fp, mmap_mode='r')
+            # Mark the block as recently used.
+            os.utime(tile_fp)
+            return tile
+        except (OSError, ValueError):
+            # It isn't cached, or it was evicted or cut short by another process.
+            pass
+
+        tile = read_tile()
+        # Write to a temporary file first, in case several processes are decoding
+        # the same block at once.
+        temp_file_path = '%s.%d' % (tile_fp, os.getpid())
+        with open(temp_file_path, 'wb') as tile_file:
+            np.save(tile_file, tile)
+        os.replace(temp_file_path, tile_fp)
+
+        self._size_bytes += os.path.getsize(tile_fp)
+        if self._size_bytes > self._max_size_bytes:
+            self._evict()
+
+        tile.flags.writeable = False
+        return tile
+
+
+def get_tile_cache():
+    """Get the tile cache configured in the configuration file, creating it the first
+    time.
+
+    :return: A TileCache, or None if the cache is turned off.
+    """
+    global _TILE_CACHE
+    if _TILE_CACHE is None and TILE_CACHE_SIZE_MB > 0:
+        _TILE_CACHE = TileCache(TILE_CACHE_DIR_PATH, TILE_CACHE_SIZE_MB,
+                                TILE_CACHE_VERSION)
+    return _TILE_CACHE
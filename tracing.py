@@ -0,0 +1,280 @@
+"""Lightweight tracing of the pipeline's stages.
+
+Code is instrumented with nested spans:
+
+    with span('rasterise', sisid=sisid) as rasterise_span:
+        ...
+        rasterise_span.add(pixels=width * height)
+
+When tracing is enabled with enable_tracing, every span is written to a JSON-lines
+file when it finishes, recording its wall-clock time, CPU time, the peak resident set
+size of the process so far and any counters (vertices, pixels, bytes written, etc.)
+added to it. When tracing is disabled, span returns a shared object which does
+nothing, so instrumented code runs at almost full speed.
+"""
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # The resource module isn't available on Windows.
+    resource = None
+
+# The number of rows in the table printed by print_summary.
+NO_SUMMARY_ROWS = 20
+
+_tracer = None
+
+
+def get_peak_rss_mb():
+    """Get the peak resident set size of the process.
+
+    :return: The peak resident set size in mebibytes, or None if it can't be
+        determined.
+    """
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kibibytes everywhere else.
+        return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().peak_wset / 2 ** 20
+
+
+class _NullSpan(object):
+    """A span which does nothing, returned by span when tracing is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, attributes):
+        self._tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.counters = {}
+        self.span_id = None
+        self.parent_id = None
+        self.children_wall_s = 0.0
+        self._start_wall = None
+        self._start_cpu = None
+        self._start_timestamp = None
+
+    def __enter__(self):
+        self._tracer.push(self)
+        self._start_timestamp = time.time()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, *_):
+        wall_s = time.perf_counter() - self._start_wall
+        cpu_s = time.process_time() - self._start_cpu
+        self._tracer.pop(self, wall_s, cpu_s, exc_type)
+        return False
+
+    def add(self, **counters):
+        """Add to the span's counters.
+
+        :param counters: Amounts to add to each counter, e.g. pixels=1000.
+        """
+        for counter_name, amount in counters.items():
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + amount
+
+
+class _Tracer(object):
+
+    def __init__(self, trace_file_path):
+        # The file is line buffered so that nothing is left in the buffer when a
+        # worker process is forked.
+        self._trace_file = open(trace_file_path, 'w', buffering=1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_span_id = 0
+        # Totals for each span name, used to print the summary.
+        self.aggregates = OrderedDict()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current_span(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def push(self, span_):
+        stack = self._stack()
+        with self._lock:
+            span_.span_id = self._next_span_id
+            self._next_span_id += 1
+        span_.parent_id = stack[-1].span_id if stack else None
+        stack.append(span_)
+
+    def pop(self, span_, wall_s, cpu_s, exc_type):
+        stack = self._stack()
+        stack.remove(span_)
+        if stack:
+            stack[-1].children_wall_s += wall_s
+
+        self_wall_s = wall_s - span_.children_wall_s
+        peak_rss_mb = get_peak_rss_mb()
+
+        self.write({'type': 'span',
+                    'name': span_.name,
+                    'id': span_.span_id,
+                    'parent_id': span_.parent_id,
+                    'start': span_._start_timestamp,
+                    'wall_s': wall_s,
+                    'self_wall_s': self_wall_s,
+                    'cpu_s': cpu_s,
+                    'peak_rss_mb': peak_rss_mb,
+                    'error': exc_type.__name__ if exc_type else None,
+                    'attributes': span_.attributes,
+                    'counters': span_.counters})
+
+        with self._lock:
+            aggregate = self.aggregates.setdefault(span_.name, {
+                'calls': 0, 'wall_s': 0.0, 'self_wall_s': 0.0, 'cpu_s': 0.0,
+                'peak_rss_mb': None, 'counters': {}})
+            aggregate['calls'] += 1
+            aggregate['wall_s'] += wall_s
+            aggregate['self_wall_s'] += self_wall_s
+            aggregate['cpu_s'] += cpu_s
+            if peak_rss_mb is not None:
+                aggregate['peak_rss_mb'] = max(aggregate['peak_rss_mb'] or 0,
+                                               peak_rss_mb)
+            for counter_name, amount in span_.counters.items():
+                aggregate['counters'][counter_name] = \
+                    aggregate['counters'].get(counter_name, 0) + amount
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._trace_file.write(line + '\n')
+
+    def close(self):
+        self._trace_file.close()
+
+
+def enable_tracing(trace_file_path):
+    """Start writing spans to a JSON-lines file.
+
+    :param trace_file_path: Path to write the trace to. Any existing file is
+        overwritten.
+    """
+    global _tracer
+    disable_tracing()
+    _tracer = _Tracer(trace_file_path)
+
+
+def disable_tracing():
+    """Stop tracing and close the trace file."""
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def detach_tracing():
+    """Stop tracing without closing the trace file. This is called in worker
+    processes, which inherit the tracer when they're forked but mustn't write to the
+    parent process's trace file.
+    """
+    global _tracer
+    _tracer = None
+
+
+def is_enabled():
+    """Check whether tracing is enabled, e.g. to skip computing expensive counters.
+
+    :return: True if tracing is enabled.
+    """
+    return _tracer is not None
+
+
+def span(name, **attributes):
+    """Create a span to be used as a context manager around a stage.
+
+    :param name: The name of the stage. Spans with the same name are aggregated in
+        the summary.
+    :param attributes: Extra information to record, e.g. the SISID of a range map.
+    :return: A context manager.
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(_tracer, name, attributes)
+
+
+def add_counters(**counters):
+    """Add to the counters of the innermost span which is open in this thread.
+
+    :param counters: Amounts to add to each counter, e.g. bytes_uploaded=1000.
+    """
+    if _tracer is None:
+        return
+    current_span = _tracer.current_span()
+    if current_span is not None:
+        current_span.add(**counters)
+
+
+def log(message):
+    """Record a message in the trace, attached to the innermost open span.
+
+    :param message: The message.
+    """
+    if _tracer is None:
+        return
+    current_span = _tracer.current_span()
+    _tracer.write({'type': 'log',
+                   'time': time.time(),
+                   'span_id': current_span.span_id if current_span else None,
+                   'message': message})
+
+
+def print_summary(no_rows=NO_SUMMARY_ROWS):
+    """Print a table of the stages which took the most time, excluding time spent in
+    nested stages.
+
+    :param no_rows: The maximum number of stages to print.
+    """
+    if _tracer is None or not _tracer.aggregates:
+        return
+
+    total_self_wall_s = sum(aggregate['self_wall_s']
+                            for aggregate in _tracer.aggregates.values())
+    hot_spots = sorted(_tracer.aggregates.items(),
+                       key=lambda item: item[1]['self_wall_s'], reverse=True)
+
+    print('%-24s %8s %10s %10s %6s %10s %10s  %s' % ('stage', 'calls', 'wall (s)',
+                                                     'self (s)', '%', 'CPU (s)',
+                                                     'RSS (MiB)', 'counters'))
+    for name, aggregate in hot_spots[:no_rows]:
+        percentage = 100 * aggregate['self_wall_s'] / total_self_wall_s \
+            if total_self_wall_s else 0
+        peak_rss_str = '%.0f' % aggregate['peak_rss_mb'] \
+            if aggregate['peak_rss_mb'] is not None else '-'
+        counters_str = ', '.join('%s=%d' % (counter_name, amount)
+                                 for counter_name, amount
+                                 in sorted(aggregate['counters'].items()))
+        print('%-24s %8d %10.2f %10.2f %6.1f %10.2f %10s  %s' % (
+            name, aggregate['calls'], aggregate['wall_s'], aggregate['self_wall_s'],
+            percentage, aggregate['cpu_s'], peak_rss_str, counters_str))
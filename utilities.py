@@ -1,9 +1,14 @@
-import os
+import time
 from datetime import datetime
 
-import ee
+from backends import get_backend
+from progress import check_cancelled, report_progress
+from runs import get_run
+from tracing import log
 
-SCI_NAME_RASTER_FILENAME_MAPPING_FP = 'out/sci_name_raster_filename_mapping.csv'
+# How often the state of the tasks is checked while waiting for them in a way which
+# can be cancelled.
+TASK_POLL_INTERVAL_S = 30
 
 
 def map_sisid_breeding_to_filename(sisid: str, breeding: str, uncompressed: bool):
@@ -47,31 +52,50 @@ def print_w_timestamp(str_to_print, end='\n'):
     :param end: The terminating character of the combined string.
     """
     print('[%s] %s' % (str(datetime.now().time()), str_to_print), end=end)
+    # When tracing is enabled, the message is also recorded in the trace.
+    log(str_to_print)
 
 
 def get_pending_or_running_task_ids():
-    """Get a list of the names of all GEE tasks which are either pending or running.
+    """Get a list of the names of the current run's GEE tasks which are either
+    pending or running. Other runs' tasks are ignored.
 
-    :return: A list of the names of all GEE tasks which are either pending or running.
+    :return: A list of the names of the current run's GEE tasks which are either
+        pending or running.
     """
     task_ids = []
 
-    tasks = ee.data.listOperations()
+    run = get_run()
+    tasks = get_backend().list_tasks()
 
     for task in tasks:
-        state = task['metadata']['state']
-        if state == 'RUNNING' or state == 'PENDING':
-            task_id = os.path.basename(task['name'])
-            task_ids.append(task_id)
+        state = task['state']
+        if (state == 'RUNNING' or state == 'PENDING') and run.owns_task(task):
+            task_ids.append(task['id'])
 
     return task_ids
 
 
-def wait_until_all_tasks_complete():
-    """Continually check whether all running tasks have finished. Delay further
-    execution until everything is done.
+def wait_until_all_tasks_complete(progress_stage=None, cancellable=False):
+    """Continually check whether all of the current run's running tasks have
+    finished. Delay further execution until everything is done.
+
+    :param progress_stage: Optional name of a stage to report the number of finished
+        tasks as the progress of. See progress.report_progress.
+    :param cancellable: Whether to stop waiting if cancellation is requested. If so,
+        the state of the tasks is polled rather than waited on, so that cancellation
+        isn't held up by a long task. The tasks carry on running either way.
     """
     task_ids = get_pending_or_running_task_ids()
+    no_tasks = len(task_ids)
     while task_ids:
-        os.system('earthengine task wait %s' % task_ids[0])
+        if progress_stage:
+            report_progress(progress_stage, no_tasks - len(task_ids), no_tasks,
+                            'tasks')
+        if cancellable:
+            check_cancelled()
+            time.sleep(TASK_POLL_INTERVAL_S)
+        else:
+            get_backend().wait_for_task(task_ids[0])
         task_ids = get_pending_or_running_task_ids()
+        no_tasks = max(no_tasks, len(task_ids))